@@ -17,6 +17,7 @@ from json import dump
 from netCDF4 import Dataset
 from utils.product_fun import get_satellite_name_from_product_name, get_sensing_datetime_from_product_name, \
     get_pixels_from_nc, write_all_pixels_to_nc, create_band, append_to_valid_pixel_expression
+from utils.provenance import invalidate_derived_output, write_derived_provenance
 osr.UseExceptions()
 
 # the url to post new data notification to
@@ -66,6 +67,8 @@ def apply(env, params, l2product_files, date):
             os.makedirs(out_path, exist_ok=True)
             bands_list = list(filter(None, params[PARAMS_SECTION][key].split(",")))
             bands, bands_min, bands_max = parse_bands(bands_list)
+            provenance = invalidate_derived_output(env, params, os.path.dirname(os.path.dirname(l2product_file)),
+                                                   PARAMS_SECTION, input_file, [l2product_file])
 
             if os.path.exists(input_file):
                 if ("synchronise" in params["General"].keys() and params['General']['synchronise'] == "false") or \
@@ -109,6 +112,8 @@ def apply(env, params, l2product_files, date):
                         else:
                             convert_nc("geotiff", input_file, geotiff_outfile, val, 6, bands_min[idx], bands_max[idx],
                                        satellite, date, env)
+                write_derived_provenance(os.path.dirname(os.path.dirname(l2product_file)), PARAMS_SECTION,
+                                         input_file, provenance)
 
             if "bucket" not in params[PARAMS_SECTION]:
                 raise ValueError("S3 Bucket must be defined in parameters file")
@@ -2,8 +2,18 @@
 # -*- coding: utf-8 -*-
 
 import os
-from utils.auxil import load_environment, log
 import subprocess
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+from netCDF4 import Dataset
+from scipy.spatial import cKDTree
+
+from utils.auxil import load_environment, log
+from utils.product_fun import get_band_names_from_nc, get_sensing_datetime_from_product_name, nearest_index
+from utils.provenance import get_file_fingerprint
+from utils.timeseries import get_store_bands, get_store_file, read_window_history
 
 # The name of the xml file for gpt
 GPT_XML_FILENAME = "pixelextraction.xml"
@@ -11,6 +21,23 @@ GPT_XML_FILENAME = "pixelextraction.xml"
 # key of the params section for this adapter
 PARAMS_SECTION = "PIXELEXTRACTION"
 OUT_DIR = "PixelExtraction"
+# Extraction method, either "gpt" (SNAP PixEx operator), "native" (window reads in python) or "timeseries" (window
+# reads from the pixel time-series stores)
+DEFAULT_METHOD = "gpt"
+# A pattern for the name of the time-series file of a station (completed with station name)
+STATION_FILENAME = "{}.csv"
+# A pattern for the name of the history file of a station read from a store (completed with station, processor, band)
+HISTORY_FILENAME = "{}_{}_{}.csv"
+# A pattern for the index of the products stored in the time-series file of a station (completed with station file)
+STATION_INDEX_FILENAME = "{}.index"
+# Columns of the time-series files of the native extractor. The files are kept as csv in long format (one row per
+# product and band, one column per statistic), which is appended to in place and read by pandas without SNAP
+STATION_COLUMNS = ["datetime", "product", "processor", "band", "latitude", "longitude", "row", "col", "window_size",
+                   "count", "mean", "median", "std", "min", "max"]
+# Guards the appending to station files from concurrent product groups
+station_file_lock = Lock()
+# The products stored in each station file with their fingerprints, read once per process from the index sidecars
+station_indices = {}
 
 
 def apply(env, params, l2product_files, date):
@@ -46,15 +73,37 @@ def apply(env, params, l2product_files, date):
     if "products" not in params[PARAMS_SECTION]:
         raise ValueError("Products must be defined in the PIXEL section.")
 
-    files = []
+    files, processors = [], []
     for product in params[PARAMS_SECTION]["products"].replace(" ", "").split(","):
         if product.upper() in l2product_files.keys():
             files.append(l2product_files[product.upper()])
+            processors.append(product.upper())
 
     if len(files) == 0:
         return
 
     out_path = os.path.dirname(os.path.dirname(files[0]))
+
+    method = params[PARAMS_SECTION].get("method", DEFAULT_METHOD).lower()
+    if method in ["native", "timeseries"]:
+        stations = list(filter(None, params[PARAMS_SECTION].get("stations", "").replace(" ", "").split(",")))
+        if not stations:
+            stations = ["station_{}".format(i) for i in range(len(coords))]
+        if len(stations) != len(coords):
+            raise ValueError("The number of stations must match the number of coordinates in the PIXEL section.")
+        bands = None
+        if "bands" in params[PARAMS_SECTION]:
+            bands = list(filter(None, params[PARAMS_SECTION]["bands"].replace(" ", "").split(",")))
+        coords = [(float(lat), float(lon)) for lat, lon in coords]
+        if method == "timeseries":
+            extract_histories(env, params, processors, os.path.join(out_path, OUT_DIR), stations, coords,
+                              int(window_size), bands)
+        else:
+            extract_pixels(env, files, processors, os.path.join(out_path, OUT_DIR), stations, coords,
+                           int(window_size), bands)
+        return
+    elif method != "gpt":
+        raise ValueError("Unknown pixel extraction method: {}".format(method))
     gpt_xml_file = os.path.join(out_path, OUT_DIR, "_reproducibility", GPT_XML_FILENAME)
 
     if not os.path.isfile(gpt_xml_file):
@@ -94,3 +143,208 @@ def rewrite_xml(gpt_xml_file, files, folder, coords, window_size):
     with open(gpt_xml_file, "w") as f:
         f.write(xml)
 
+
+def extract_pixels(env, files, processors, out_dir, stations, coords, window_size, bands=None):
+    """
+    Extract windows around the given coordinates from all products of a group in one pass and append the window
+    statistics to one time-series file per station.
+
+    Parameters
+    -------------
+
+    files
+        List of product files to extract from
+    processors
+        List with the name of the processor which created each product file
+    out_dir
+        Folder of the station time-series files
+    stations
+        List of station names, one per coordinate
+    coords
+        List of (lat, lon) tuples
+    window_size
+        Edge length of the extracted window in pixels
+    bands
+        | **Default: None**
+        | List of bands to extract, if None all bands of the products are extracted
+    """
+    rows = {station: [] for station in stations}
+    fingerprints = {os.path.basename(product_file): get_file_fingerprint(product_file) for product_file in files}
+    indices = {}
+    for product_file, processor in zip(files, processors):
+        product_name = os.path.basename(product_file)
+        with Dataset(product_file) as src:
+            lats, lons = get_lat_lon_arrays(src)
+            grid_key = (lats.shape, lons.shape, float(lats.flat[0]), float(lats.flat[-1]), float(lons.flat[0]),
+                        float(lons.flat[-1]))
+            if grid_key not in indices:
+                indices[grid_key] = GeoIndex(lats, lons)
+            positions = indices[grid_key].locate_all(coords)
+
+            product_bands = [band for band in get_band_names_from_nc(src) if band in src.variables
+                             and band not in ["lat", "lon", "latitude", "longitude"]]
+            if bands is not None:
+                product_bands = [band for band in product_bands if band in bands]
+
+            date = get_sensing_datetime_from_product_name(product_name)
+            for station, (lat, lon), position in zip(stations, coords, positions):
+                if position is None:
+                    log(env["General"]["log"], "Station {} is not covered by {}.".format(station, product_name),
+                        indent=1)
+                    continue
+                row, col = position
+                windows = read_windows(src, product_bands, row, col, window_size)
+                for band, window in windows.items():
+                    rows[station].append(window_statistics(window, {
+                        "datetime": date, "product": product_name, "processor": processor, "band": band,
+                        "latitude": lat, "longitude": lon, "row": row, "col": col, "window_size": window_size}))
+
+    os.makedirs(out_dir, exist_ok=True)
+    for station, station_rows in rows.items():
+        if station_rows:
+            station_file = os.path.join(out_dir, STATION_FILENAME.format(station))
+            append_station_rows(station_file, station_rows, fingerprints)
+            log(env["General"]["log"], "Appended {} rows to {}.".format(len(station_rows), station_file), indent=1)
+
+
+def extract_histories(env, params, processors, out_dir, stations, coords, window_size, bands=None):
+    """
+    Write the complete history of the window around each station from the pixel time-series stores, with one chunked
+    read per store and station. The history files are rewritten, so they always match the stores.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for processor in processors:
+        for band in get_store_bands(params, processor):
+            if bands is not None and band not in bands:
+                continue
+            store_file = get_store_file(env, params, processor, band)
+            if not os.path.isfile(store_file):
+                log(env["General"]["log"], "No time-series store for {} {}.".format(processor, band), indent=1)
+                continue
+            for station, (lat, lon) in zip(stations, coords):
+                try:
+                    times, products, windows = read_window_history(store_file, lat, lon, window_size)
+                except RuntimeError:
+                    log(env["General"]["log"], "Station {} is not covered by {}.".format(station, store_file),
+                        indent=1)
+                    continue
+                rows = [window_statistics(window, {
+                    "datetime": time.strftime(r"%Y%m%dT%H%M%S"), "product": product, "processor": processor,
+                    "band": band, "latitude": lat, "longitude": lon, "row": None, "col": None,
+                    "window_size": window_size}) for time, product, window in zip(times, products, windows)]
+                history_file = os.path.join(out_dir, HISTORY_FILENAME.format(station, processor, band))
+                pd.DataFrame(rows, columns=STATION_COLUMNS).to_csv("{}.incomplete".format(history_file), index=False)
+                os.replace("{}.incomplete".format(history_file), history_file)
+                log(env["General"]["log"], "Wrote {} dates to {}.".format(len(rows), history_file), indent=1)
+
+
+def get_lat_lon_arrays(nc):
+    """Return the latitude and longitude arrays of a product (1D for regular grids, 2D otherwise)."""
+    lat_var_name = "lat" if "lat" in nc.variables else "latitude"
+    lon_var_name = "lon" if "lon" in nc.variables else "longitude"
+    if lat_var_name not in nc.variables or lon_var_name not in nc.variables:
+        raise RuntimeError("Cannot guess the name of the lat and lon variables for this product, please implement.")
+    return np.asarray(nc.variables[lat_var_name][:]), np.asarray(nc.variables[lon_var_name][:])
+
+
+class GeoIndex(object):
+    """Geolocation index of a product grid, built once and used to locate all coordinates."""
+
+    def __init__(self, lats, lons):
+        self.lats, self.lons = lats, lons
+        self.regular = lats.ndim == 1
+        if not self.regular:
+            self.tree = cKDTree(np.column_stack((lats.ravel(), lons.ravel())))
+            self.max_dist = max(np.nanmax(np.abs(np.diff(lats, axis=0))), np.nanmax(np.abs(np.diff(lons, axis=1))))
+
+    def locate_all(self, coords):
+        """Return the (row, col) of the pixel covering each (lat, lon), or None if it is outside of the grid."""
+        if self.regular:
+            return [self._locate_regular(lat, lon) for lat, lon in coords]
+        dists, idxs = self.tree.query(np.array(coords, dtype=np.float64))
+        return [tuple(int(i) for i in np.unravel_index(idx, self.lats.shape)) if dist <= self.max_dist else None
+                for dist, idx in zip(dists, idxs)]
+
+    def _locate_regular(self, lat, lon):
+        row, col = nearest_index(self.lats, lat), nearest_index(self.lons, lon)
+        if row is None or col is None:
+            return None
+        return row, col
+
+
+def read_windows(src, bands, row, col, window_size):
+    """Read only the window around (row, col) of each band. Masked pixels are returned as NaN."""
+    half = window_size // 2
+    windows = {}
+    for band in bands:
+        variable = src.variables[band]
+        height, width = variable.shape
+        window = variable[max(0, row - half):min(height, row + half + 1), max(0, col - half):min(width, col + half + 1)]
+        windows[band] = np.ma.filled(np.ma.asarray(window, dtype=np.float64), np.nan)
+    return windows
+
+
+def window_statistics(window, row):
+    """Add the statistics of the valid pixels of a window to a time-series row."""
+    valid = window[~np.isnan(window)]
+    row["count"] = valid.size
+    for key, fun in [("mean", np.mean), ("median", np.median), ("std", np.std), ("min", np.min), ("max", np.max)]:
+        row[key] = fun(valid) if valid.size else np.nan
+    return row
+
+
+def append_station_rows(station_file, rows, fingerprints):
+    """
+    Append rows to the time-series file of a station. The products which are already stored are looked up in the index
+    sidecar of the file instead of reading the file, and are skipped. Rows of products whose file changed since they
+    were stored (e.g. reprocessed with other params) are replaced, which is the only case in which the file is
+    rewritten.
+    """
+    df = pd.DataFrame(rows, columns=STATION_COLUMNS)
+    with station_file_lock:
+        index = read_station_index(station_file)
+        stale = set(product for product in set(df["product"])
+                    if index.get(product) not in [None, fingerprints[product]])
+        df = df[[product not in index or product in stale for product in df["product"]]]
+        if not len(df):
+            return
+        if stale:
+            stored = pd.read_csv(station_file)
+            stored[~stored["product"].isin(stale)].to_csv("{}.incomplete".format(station_file), index=False)
+            os.replace("{}.incomplete".format(station_file), station_file)
+        df.to_csv(station_file, mode="a", header=not os.path.isfile(station_file), index=False)
+        index.update({product: fingerprints[product] for product in set(df["product"])})
+        write_station_index(station_file, index, None if stale else set(df["product"]))
+
+
+def read_station_index(station_file):
+    """Return the products stored in a station file with their fingerprints, None for products stored before the
+    index existed. The index is read from its sidecar only if another process changed it."""
+    index_file = STATION_INDEX_FILENAME.format(station_file)
+    version = os.stat(index_file).st_mtime_ns if os.path.isfile(index_file) else None
+    if station_file in station_indices and station_indices[station_file][0] == version:
+        return station_indices[station_file][1]
+    index = {}
+    if version is not None:
+        with open(index_file, "r") as f:
+            for line in f:
+                product, fingerprint = line.rstrip("\n").split("\t")
+                index[product] = fingerprint or None
+    elif os.path.isfile(station_file):
+        index = {product: None for product in pd.read_csv(station_file, usecols=["product"])["product"]}
+    station_indices[station_file] = (version, index)
+    return index
+
+
+def write_station_index(station_file, index, appended=None):
+    """Append the given products to the index sidecar of a station file, or rewrite it if appended is None."""
+    index_file = STATION_INDEX_FILENAME.format(station_file)
+    if appended is not None and os.path.isfile(index_file):
+        with open(index_file, "a") as f:
+            f.writelines("{}\t{}\n".format(product, index[product]) for product in sorted(appended))
+    else:
+        with open("{}.incomplete".format(index_file), "w") as f:
+            f.writelines("{}\t{}\n".format(product, fingerprint or "")
+                         for product, fingerprint in sorted(index.items()))
+        os.replace("{}.incomplete".format(index_file), index_file)
+    station_indices[station_file] = (os.stat(index_file).st_mtime_ns, index)
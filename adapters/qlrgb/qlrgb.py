@@ -14,11 +14,18 @@ from netCDF4 import Dataset
 
 from utils.auxil import log
 from utils.product_fun import get_band_names_from_nc, get_name_width_height_from_nc, \
-    get_lons_lats, get_lat_lon_from_x_y_from_nc, read_pixels_from_nc, get_np_data_type
+    get_lons_lats, get_lat_lon_from_x_y_from_nc
+from utils.provenance import invalidate_derived_output, write_derived_provenance
+from utils.quicklook_fun import DEFAULT_QL_DPI, DEFAULT_QL_FORMAT, get_figure_template, get_ql_format, render_lock, \
+    save_figure
 
 # key of the params section for this adapter
 PARAMS_SECTION = "QLRGB"
 QL_PATH = "{}/QuickLooks/{}-{}"
+# Default gamma applied to the scaled rgb values
+DEFAULT_GAMMA = 1.0
+# Value of pixels which are invalid, zero or above the max value
+WHITE = 250
 plt.switch_backend('agg')
 mpl.pyplot.switch_backend('agg')
 canvas_area = []
@@ -41,13 +48,16 @@ def apply(env, params, l2product_files, date):
     """
 
     wkt = params['General']['wkt']
+    ql_format, dpi = get_ql_format(params, PARAMS_SECTION)
+    annotate = params[PARAMS_SECTION].get("annotate", "True").lower() != "false"
     for key in params[PARAMS_SECTION].keys():
         processor = key[0:key.find("_")].upper()
         if processor in l2product_files.keys():
             ql_name = key[key.find("_") + 1:]
             log(env["General"]["log"], "Creating {} quicklooks for {}".format(ql_name, processor))
-            bands = list(filter(None, params[PARAMS_SECTION][key].split(",")))[0:-1]
-            bandmax = list(filter(None, params[PARAMS_SECTION][key].split(",")))[-1]
+            values = list(filter(None, params[PARAMS_SECTION][key].split(",")))
+            bands, bandmax = values[0:3], values[3]
+            gamma = float(values[4]) if len(values) > 4 else DEFAULT_GAMMA
             if params['General']['sensor'] == "OLCI":
                 bands = [band.replace('radiance', 'reflectance') for band in bands]
 
@@ -55,21 +65,28 @@ def apply(env, params, l2product_files, date):
             path = os.path.dirname(os.path.dirname(l2product_files[processor]))
             ql_path = QL_PATH.format(path, folder, ql_name)
             product_name = os.path.splitext(os.path.basename(l2product_files[processor]))[0]
-            ql_file = os.path.join(ql_path, "{}-{}.pdf".format(product_name, ql_name))
+            ql_file = os.path.join(ql_path, "{}-{}.{}".format(product_name, ql_name, ql_format))
+            provenance = invalidate_derived_output(env, params, path, PARAMS_SECTION, ql_file,
+                                                   [l2product_files[processor]])
             if os.path.exists(ql_file):
                 if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
                     log(env["General"]["log"], "Removing file: ${}".format(ql_file))
                     os.remove(ql_file)
-                    plot_pic(env, l2product_files[processor], ql_file, wkt, rgb_layers=bands, max_val=float(bandmax))
+                    plot_pic(env, l2product_files[processor], ql_file, wkt, rgb_layers=bands, max_val=float(bandmax),
+                             gamma=gamma, ql_format=ql_format, dpi=dpi, annotate=annotate)
                 else:
                     log(env["General"]["log"],
                         "Skipping QLRGB. Target already exists: {}".format(os.path.basename(ql_file)))
             else:
                 os.makedirs(os.path.dirname(ql_file), exist_ok=True)
-                plot_pic(env, l2product_files[processor], ql_file, wkt, rgb_layers=bands, max_val=float(bandmax))
+                plot_pic(env, l2product_files[processor], ql_file, wkt, rgb_layers=bands, max_val=float(bandmax),
+                         gamma=gamma, ql_format=ql_format, dpi=dpi, annotate=annotate)
+            write_derived_provenance(path, PARAMS_SECTION, ql_file, provenance)
 
 
-def plot_pic(env, input_file, output_file, wkt=None, crop_ext=None, rgb_layers=None, grid=True, max_val=0.10):
+def plot_pic(env, input_file, output_file, wkt=None, crop_ext=None, rgb_layers=None, grid=True, max_val=0.10,
+             gamma=DEFAULT_GAMMA, ql_format=DEFAULT_QL_FORMAT, dpi=DEFAULT_QL_DPI, annotate=True):
+    """ Plot an RGB quicklook. Without annotation, the image is written directly with Pillow (no map, no gridlines). """
     linewidth = 0.8
     gridlabel_size = 5
 
@@ -79,17 +96,15 @@ def plot_pic(env, input_file, output_file, wkt=None, crop_ext=None, rgb_layers=N
             if rgbls not in product_band_names:
                 raise RuntimeError("{} not in product bands. Edit the parameter file.".format(rgbls))
 
-        # Create a new product With RGB bands only
-        data_type = get_np_data_type(src, rgb_layers[0])
-
-        # read rgb bands
+        # read rgb bands, downsampled to the size of the quicklook
         _, width, height = get_name_width_height_from_nc(src)
-        red_arr = read_pixels_from_nc(src, rgb_layers[0], 0, 0, width, height, dtype=data_type)
-        red_arr = red_arr.reshape(height, width)
-        green_arr = read_pixels_from_nc(src, rgb_layers[1], 0, 0, width, height, dtype=data_type)
-        green_arr = green_arr.reshape(height, width)
-        blue_arr = read_pixels_from_nc(src, rgb_layers[2], 0, 0, width, height, dtype=data_type)
-        blue_arr = blue_arr.reshape(height, width)
+        step = get_downsampling_step(width, height, dpi)
+        img = Image.fromarray(compose_rgb(read_rgb_cube(src, rgb_layers, step), max_val, gamma))
+
+        if not annotate:
+            log(env["General"]["log"], 'Saving image {}'.format(os.path.basename(output_file)))
+            img.save(output_file, format=ql_format.upper())
+            return
 
         # read lat and lon information
         lat_min, lon_min = get_lat_lon_from_x_y_from_nc(src, 0, height-1)
@@ -142,29 +157,6 @@ def plot_pic(env, input_file, output_file, wkt=None, crop_ext=None, rgb_layers=N
 
         product_area = [[lon_min - lon_ext, lat_min - lat_ext], [lon_max + lon_ext, lat_max + lat_ext]]
 
-        # Initialize plot
-        fig = plt.figure()
-        subplot_axes = fig.add_subplot(111, projection=ccrs.PlateCarree())  # ccrs.Mercator())
-
-        # adjust image brightness scaling (empirical...)
-        rgb_array = np.zeros((height, width, 3), 'float32')  # uint8
-        rgb_array[..., 0] = red_arr
-        rgb_array[..., 1] = green_arr
-        rgb_array[..., 2] = blue_arr
-
-        scale_factor = 250 / max_val
-
-        for i_rgb in range(rgb_array.shape[-1]):
-            zero_ind = np.where(rgb_array[:, :, i_rgb] == 0)
-            nan_ind = np.where(rgb_array[:, :, i_rgb] == -1)
-            exc_ind = np.where(rgb_array[:, :, i_rgb] > max_val)
-            rgb_array[:, :, i_rgb] = rgb_array[:, :, i_rgb] * scale_factor
-            rgb_array[:, :, i_rgb][zero_ind] = 250
-            rgb_array[:, :, i_rgb][nan_ind] = 250
-            rgb_array[:, :, i_rgb][exc_ind] = 250
-
-        img = Image.fromarray(rgb_array.astype(np.uint8))
-
         global canvas_area
         if wkt:
             lons, lats = get_lons_lats(wkt)
@@ -172,23 +164,65 @@ def plot_pic(env, input_file, output_file, wkt=None, crop_ext=None, rgb_layers=N
         else:
             canvas_area = product_area
 
-        subplot_axes.set_extent([canvas_area[0][0], canvas_area[1][0], canvas_area[0][1], canvas_area[1][1]])
-        subplot_axes.imshow(img,
-                            extent=[product_area[0][0], product_area[1][0], product_area[0][1], product_area[1][1]],
-                            transform=ccrs.PlateCarree(), origin='upper', interpolation='nearest', zorder=1)
+        # Initialize plot from a figure template, which holds the projection and the gridlines of all quicklooks with
+        # the same canvas and raster size, and only replace the image data
+        template_key = (PARAMS_SECTION, tuple(map(tuple, canvas_area)), tuple(map(tuple, product_area)), width, height,
+                        grid)
+        with render_lock:
+            template = get_figure_template(template_key, lambda: create_pic_template(
+                canvas_area, x_ticks, y_ticks, grid, linewidth, gridlabel_size))
+            if template["image"] is None:
+                template["image"] = template["axes"].imshow(
+                    img, extent=[product_area[0][0], product_area[1][0], product_area[0][1], product_area[1][1]],
+                    transform=ccrs.PlateCarree(), origin='upper', interpolation='nearest', zorder=1)
+            else:
+                template["image"].set_data(img)
+
+            # Save plot
+            log(env["General"]["log"], 'Saving image {}'.format(os.path.basename(output_file)))
+            save_figure(template["fig"], output_file, ql_format, dpi)
+
+
+def get_downsampling_step(width, height, dpi):
+    """Return the stride with which a raster is read so that it does not exceed the pixel size of the figure."""
+    max_size = int(max(plt.rcParams['figure.figsize']) * dpi)
+    return max(1, int(np.ceil(max(width, height) / max_size)))
+
+
+def read_rgb_cube(src, rgb_layers, step=1):
+    """Read three bands with the given stride into one float32 cube of shape (3, h, w). Masked pixels are set to 0."""
+    return np.stack([np.ma.filled(src.variables[band][::step, ::step], 0).astype(np.float32) for band in rgb_layers])
+
+
+def compose_rgb(cube, max_val, gamma=DEFAULT_GAMMA):
+    """
+    Scale an rgb cube of shape (3, h, w) to uint8 with shape (h, w, 3). Values are scaled to 250 at max_val and
+    gamma corrected. Pixels which are 0, -1, NaN or above max_val are white.
+    """
+    invalid = (cube == 0) | (cube == -1) | ~(cube <= max_val)
+    scaled = np.clip(cube / np.float32(max_val), 0, 1)
+    if gamma != 1:
+        scaled **= np.float32(1 / gamma)
+    scaled *= WHITE
+    scaled[invalid] = WHITE
+    return np.moveaxis(scaled.astype(np.uint8), 0, -1)
+
+
+def create_pic_template(canvas_area, x_ticks, y_ticks, grid, linewidth, gridlabel_size):
+    """Create a figure template with the projection and the gridlines of an RGB quicklook."""
+    fig = plt.figure()
+    subplot_axes = fig.add_subplot(111, projection=ccrs.PlateCarree())  # ccrs.Mercator())
+    subplot_axes.set_extent([canvas_area[0][0], canvas_area[1][0], canvas_area[0][1], canvas_area[1][1]])
 
-        # Add gridlines
-        if grid:
-            gridlines = subplot_axes.gridlines(draw_labels=True, linewidth=linewidth, color='black', alpha=1.0,
-                                               linestyle=':', zorder=2)  # , n_steps=3)
+    # Add gridlines
+    if grid:
+        gridlines = subplot_axes.gridlines(draw_labels=True, linewidth=linewidth, color='black', alpha=1.0,
+                                           linestyle=':', zorder=2)  # , n_steps=3)
 
-            gridlines.xlocator = mpl.ticker.FixedLocator(x_ticks)
-            gridlines.ylocator = mpl.ticker.FixedLocator(y_ticks)
+        gridlines.xlocator = mpl.ticker.FixedLocator(x_ticks)
+        gridlines.ylocator = mpl.ticker.FixedLocator(y_ticks)
 
-            gridlines.xlabel_style = {'size': gridlabel_size, 'color': 'black'}
-            gridlines.ylabel_style = {'size': gridlabel_size, 'color': 'black'}
+        gridlines.xlabel_style = {'size': gridlabel_size, 'color': 'black'}
+        gridlines.ylabel_style = {'size': gridlabel_size, 'color': 'black'}
 
-        # Save plot
-        log(env["General"]["log"], 'Saving image {}'.format(os.path.basename(output_file)))
-        plt.savefig(output_file, dpi=300)
-        plt.close()
+    return {"fig": fig, "axes": subplot_axes, "image": None}
@@ -9,6 +9,7 @@ Individual bands are plotted geospatially using matplotlib and exported to .png
 import cartopy.crs as ccrs
 import cartopy.io.srtm as srtm
 import cartopy.io.img_tiles as maps
+import hashlib
 import math
 import matplotlib as mpl
 import matplotlib.cm as cm
@@ -18,13 +19,16 @@ import matplotlib.ticker as ticker
 import numpy as np
 import os
 import re
-from cartopy.io import PostprocessedRasterSource, LocatedImage
+from cartopy.io import Downloader, PostprocessedRasterSource, LocatedImage, RasterSource
 from netCDF4 import Dataset
 
 import adapters.qlsingleband.colour_scales as colscales
 from utils.auxil import log
 from utils.product_fun import get_lons_lats, get_lat_lon_from_x_y_from_nc, get_band_names_from_nc, \
     get_name_width_height_from_nc, read_pixels_from_nc
+from utils.provenance import invalidate_derived_output, write_derived_provenance
+from utils.quicklook_fun import DEFAULT_QL_DPI, DEFAULT_QL_FORMAT, get_figure_template, get_ql_format, render_lock, \
+    save_figure
 
 plt.switch_backend('agg')
 mpl.pyplot.switch_backend('agg')
@@ -33,6 +37,8 @@ canvas_area = []
 # key of the params section for this adapter
 PARAMS_SECTION = "QLSINGLEBAND"
 QL_PATH = "{}/QuickLooks/{}-{}"
+# A pattern for the name of the cached basemap files (completed with basemap type and canvas hash)
+BASEMAP_FILENAME = "{}_{}.npz"
 
 
 def apply(env, params, l2product_files, date):
@@ -51,6 +57,7 @@ def apply(env, params, l2product_files, date):
         Run date
     """
     wkt = params['General']['wkt']
+    ql_format, dpi = get_ql_format(params, PARAMS_SECTION)
 
     for key in params[PARAMS_SECTION].keys():
         processor = key.upper()
@@ -70,7 +77,9 @@ def apply(env, params, l2product_files, date):
                 path = os.path.dirname(os.path.dirname(l2product_files[processor]))
                 ql_path = QL_PATH.format(path, folder, band)
 
-                ql_file = os.path.join(ql_path, "{}-{}.pdf".format(product_name, band))
+                ql_file = os.path.join(ql_path, "{}-{}.{}".format(product_name, band, ql_format))
+                provenance = invalidate_derived_output(env, params, path, PARAMS_SECTION, ql_file,
+                                                       [l2product_files[processor]])
                 if os.path.exists(ql_file):
                     if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
                         log(env["General"]["log"], "Removing file: ${}".format(ql_file))
@@ -78,7 +87,7 @@ def apply(env, params, l2product_files, date):
                         param_range = None if float(bandmin) == 0 == float(bandmax) else [float(bandmin),
                                                                                           float(bandmax)]
                         plot_map(env, l2product_files[processor], ql_file, band, wkt, "srtm_hillshade",
-                                 param_range=param_range)
+                                 param_range=param_range, ql_format=ql_format, dpi=dpi)
                     else:
                         log(env["General"]["log"],
                             "Skipping QLSINGLEBAND. Target already exists: {}".format(os.path.basename(ql_file)))
@@ -86,12 +95,14 @@ def apply(env, params, l2product_files, date):
                     param_range = None if float(bandmin) == 0 == float(bandmax) else [float(bandmin), float(bandmax)]
                     os.makedirs(os.path.dirname(ql_file), exist_ok=True)
                     plot_map(env, l2product_files[processor], ql_file, band, wkt, "srtm_hillshade",
-                             param_range=param_range)
+                             param_range=param_range, ql_format=ql_format, dpi=dpi)
+                write_derived_provenance(path, PARAMS_SECTION, ql_file, provenance)
 
 
 def plot_map(env, input_file, output_file, band_name, wkt=None, basemap='srtm_elevation', crop_ext=None,
-             param_range=None, cloud_layer=None, suspect_layer=None, water_layer=None, grid=True, shadow_layer=None):
-    """ basemap options are srtm_hillshade, srtm_elevation, quadtree_rgb, nobasemap """
+             param_range=None, cloud_layer=None, suspect_layer=None, water_layer=None, grid=True, shadow_layer=None,
+             ql_format=DEFAULT_QL_FORMAT, dpi=DEFAULT_QL_DPI):
+    """ basemap options are srtm_hillshade, srtm_elevation, quadtree_rgb, nobasemap; formats are pdf, png, webp """
 
     # mpl.rc('font', family='Times New Roman')
     # mpl.rc('text', usetex=True)
@@ -282,138 +293,252 @@ def plot_map(env, input_file, output_file, band_name, wkt=None, basemap='srtm_el
             rel_ticks = [0.00, 0.2, 0.4, 0.6, 0.8, 1.00]
             ticks = [rel_tick * (param_range[1] - param_range[0]) + param_range[0] for rel_tick in rel_ticks]
 
-        # Initialize plot
-        fig = plt.figure(figsize=((aspect_ratio * 3) + (2 * legend_extension), 3))
-        subplot_axes = fig.add_subplot(111, projection=ccrs.PlateCarree())  # ccrs.PlateCarree()) ccrs.Mercator())
-
-        if wkt:
-            subplot_axes.set_extent([canvas_area[0][0], canvas_area[1][0], canvas_area[0][1], canvas_area[1][1]])
-
-        ##############################
-        # ### SRTM plot version ######
-        ##############################
-
-        if basemap in ['srtm_hillshade', 'srtm_elevation']:
-            if canvas_area[1][1] <= 60 and canvas_area[0][1] >= -60:
-                if lat_range < 50 and lon_range < 50:
-                    log(env["General"]["log"],
-                        '   larger image side is ' + str(round(max(lon_range, lat_range), 1)) + ' km, applying SRTM1')
-                    source = srtm.SRTM1Source
-                else:
-                    log(env["General"]["log"],
-                        '   larger image side is ' + str(round(max(lon_range, lat_range), 1)) + ' km, applying SRTM3')
-                    source = srtm.SRTM3Source
-
-                #  Add shading if requested
-                if basemap == 'srtm_hillshade':
-                    log(env["General"]["log"], '   preparing SRTM hillshade basemap')
-                    srtm_raster = PostprocessedRasterSource(source(max_nx=8, max_ny=8), shade)
-                    color_vals = [[0.8, 0.8, 0.8, 1], [1.0, 1.0, 1.0, 1]]
-                    shade_grey = colors.LinearSegmentedColormap.from_list("ShadeGrey", color_vals)
-                    base_cols = shade_grey
-                else:  # elif basemap == 'srtm_elevation':
-                    log(env["General"]["log"], '   preparing SRTM elevation basemap')
-                    srtm_raster = PostprocessedRasterSource(source(max_nx=6, max_ny=6), elevate)
-                    color_vals = [[0.7, 0.7, 0.7, 1], [0.90, 0.90, 0.90, 1], [0.97, 0.97, 0.97, 1], [1.0, 1.0, 1.0, 1]]
-                    elev_grey = colors.LinearSegmentedColormap.from_list("ElevGrey", color_vals)
-                    base_cols = elev_grey
-
-                # Plot the background
+        # Initialize plot from a figure template, which holds the static layers (projection, basemap, gridlines and
+        # colorbar axes) of all quicklooks with the same canvas and raster size
+        template_key = (PARAMS_SECTION, tuple(map(tuple, canvas_area)), width, height, basemap, grid, wkt is not None)
+        with render_lock:
+            template = get_figure_template(template_key, lambda: create_map_template(
+                env, basemap, wkt, aspect_ratio, legend_extension, lon_range, lat_range, x_ticks, y_ticks, grid,
+                linewidth, gridlabel_size))
+            fig, subplot_axes, cax = template["fig"], template["axes"], template["cax"]
+            data_artists = []
+
+            # Plot parameter
+            # Fun fact: interpolation='none' causes interpolation if opened in OSX Preview:
+            # https://stackoverflow.com/questions/54250441/pdf-python-plot-is-blurry-image-interpolation
+            parameter = subplot_axes.imshow(band_arr, extent=[min_lon, max_lon, min_lat, max_lat],
+                                            transform=ccrs.PlateCarree(), origin='upper', cmap=color_type,
+                                            # interpolation='none',
+                                            vmin=param_range[0], vmax=param_range[1], zorder=10)
+            data_artists.append(parameter)
+
+            # Plot flags
+            if cloud_layer:
+                cloud_colmap = colscales.cloud_color()
+                cloud_colmap.set_bad('w', 0)
+                data_artists.append(subplot_axes.imshow(masked_cloud_arr, extent=[min_lon, max_lon, min_lat, max_lat],
+                                                        transform=ccrs.PlateCarree(), origin='upper',
+                                                        cmap=cloud_colmap, interpolation='none', zorder=20))
+
+            if shadow_layer:
+                shadow_colmap = colscales.shadow_color()
+                shadow_colmap.set_bad('w', 0)
+                data_artists.append(subplot_axes.imshow(masked_shadow_arr, extent=[min_lon, max_lon, min_lat, max_lat],
+                                                        transform=ccrs.PlateCarree(), origin='upper',
+                                                        cmap=shadow_colmap, interpolation='none', zorder=20))
+
+            if suspect_layer:
+                suspect_colmap = colscales.suspect_color()
+                suspect_colmap.set_bad('w', 0)
+                data_artists.append(subplot_axes.imshow(masked_suspect_arr, extent=[min_lon, max_lon, min_lat, max_lat],
+                                                        transform=ccrs.PlateCarree(), origin='upper',
+                                                        cmap=suspect_colmap, interpolation='none', zorder=20))
+
+            # Create colorbar
+            log(env["General"]["log"], '   creating colorbar')
+            cax.cla()
+
+            # discrete colorbar option for Forel-Ule classes
+            if 'Forel-Ule' in title_str:
+                cbar = fig.colorbar(parameter, cax=cax, orientation=bar_orientation, norm=norm, boundaries=boundaries,
+                                    ticks=ticks, format=tick_format)
+                cbar.ax.tick_params(labelsize=6)
+            else:
+                cbar = fig.colorbar(parameter, cax=cax, ticks=ticks, format=tick_format, orientation=bar_orientation)
+                cbar.ax.tick_params(labelsize=8)
+
+            # Save plot and remove the data layers from the template
+            cax.set_title(legend_str, y=1.05, fontsize=8)
+            log(env["General"]["log"], 'Writing {}'.format(os.path.basename(output_file)))
+            try:
+                save_figure(fig, output_file, ql_format, dpi, bbox_inches='tight')
+            finally:
+                for artist in data_artists:
+                    artist.remove()
+
+
+def create_map_template(env, basemap, wkt, aspect_ratio, legend_extension, lon_range, lat_range, x_ticks, y_ticks,
+                        grid, linewidth, gridlabel_size):
+    """Create a figure template with the projection, the basemap, the gridlines and the colorbar axes of a map."""
+    fig = plt.figure(figsize=((aspect_ratio * 3) + (2 * legend_extension), 3))
+    subplot_axes = fig.add_subplot(111, projection=ccrs.PlateCarree())  # ccrs.PlateCarree()) ccrs.Mercator())
+
+    if wkt:
+        subplot_axes.set_extent([canvas_area[0][0], canvas_area[1][0], canvas_area[0][1], canvas_area[1][1]])
+
+    ##############################
+    # ### SRTM plot version ######
+    ##############################
+
+    if basemap in ['srtm_hillshade', 'srtm_elevation']:
+        if canvas_area[1][1] <= 60 and canvas_area[0][1] >= -60:
+            if lat_range < 50 and lon_range < 50:
+                log(env["General"]["log"],
+                    '   larger image side is ' + str(round(max(lon_range, lat_range), 1)) + ' km, applying SRTM1')
+                source = srtm.SRTM1Source
+            else:
+                log(env["General"]["log"],
+                    '   larger image side is ' + str(round(max(lon_range, lat_range), 1)) + ' km, applying SRTM3')
+                source = srtm.SRTM3Source
+
+            #  Add shading if requested
+            if basemap == 'srtm_hillshade':
+                log(env["General"]["log"], '   preparing SRTM hillshade basemap')
+                srtm_raster = get_srtm_raster(env, basemap, source, 8, shade)
+                color_vals = [[0.8, 0.8, 0.8, 1], [1.0, 1.0, 1.0, 1]]
+                shade_grey = colors.LinearSegmentedColormap.from_list("ShadeGrey", color_vals)
+                base_cols = shade_grey
+            else:  # elif basemap == 'srtm_elevation':
+                log(env["General"]["log"], '   preparing SRTM elevation basemap')
+                srtm_raster = get_srtm_raster(env, basemap, source, 6, elevate)
+                color_vals = [[0.7, 0.7, 0.7, 1], [0.90, 0.90, 0.90, 1], [0.97, 0.97, 0.97, 1], [1.0, 1.0, 1.0, 1]]
+                elev_grey = colors.LinearSegmentedColormap.from_list("ElevGrey", color_vals)
+                base_cols = elev_grey
+
+            # Plot the background
+            if srtm_raster is not None:
                 subplot_axes.add_raster(srtm_raster, cmap=base_cols)
-
             else:
-                log(env["General"]["log"], '   no SRTM data outside 55 deg N/S, proceeding without basemap')
+                log(env["General"]["log"], '   SRTM basemap not available, proceeding without basemap')
                 basemap = 'nobasemap'
 
-        ##################################
-        # ### non-SRTM plot version ######
-        ##################################
-
-        if basemap in ['quadtree_rgb', 'nobasemap']:
-
-            if basemap == 'nobasemap':
-                log(env["General"]["log"], '   proceeding without basemap')
-            if basemap == 'quadtree_rgb':
-                log(env["General"]["log"], '   preparing Quadtree tiles basemap')
-
-                # background = maps.GoogleTiles(style='street')
-                # background = maps.GoogleTiles(style='satellite')
-                # background = maps.GoogleTiles(style='terrain')
-                # background = maps.MapQuestOpenAerial()
-                # background = maps.OSM()
-                background = maps.QuadtreeTiles()
-                # crs = maps.GoogleTiles().crs
-                # crs = maps.QuadtreeTiles().crs
-
-                # Add background
-                subplot_axes.add_image(background, 10)
-
-        ##############################
-        # ### both plot versions #####
-        ##############################
-
-        # Plot parameter
-        # Fun fact: interpolation='none' causes interpolation if opened in OSX Preview:
-        # https://stackoverflow.com/questions/54250441/pdf-python-plot-is-blurry-image-interpolation
-        parameter = subplot_axes.imshow(band_arr, extent=[min_lon, max_lon, min_lat, max_lat],
-                                        transform=ccrs.PlateCarree(), origin='upper', cmap=color_type,
-                                        # interpolation='none',
-                                        vmin=param_range[0], vmax=param_range[1], zorder=10)
-
-        # Plot flags
-        if cloud_layer:
-            cloud_colmap = colscales.cloud_color()
-            cloud_colmap.set_bad('w', 0)
-            _ = plt.imshow(masked_cloud_arr, extent=[min_lon, max_lon, min_lat, max_lat],
-                           transform=ccrs.PlateCarree(), origin='upper', cmap=cloud_colmap, interpolation='none',
-                           zorder=20)
+        else:
+            log(env["General"]["log"], '   no SRTM data outside 55 deg N/S, proceeding without basemap')
+            basemap = 'nobasemap'
 
-        if shadow_layer:
-            shadow_colmap = colscales.shadow_color()
-            shadow_colmap.set_bad('w', 0)
-            _ = plt.imshow(masked_shadow_arr, extent=[min_lon, max_lon, min_lat, max_lat],
-                           transform=ccrs.PlateCarree(), origin='upper', cmap=shadow_colmap, interpolation='none',
-                           zorder=20)
+    ##################################
+    # ### non-SRTM plot version ######
+    ##################################
 
-        if suspect_layer:
-            suspect_colmap = colscales.suspect_color()
-            suspect_colmap.set_bad('w', 0)
-            _ = plt.imshow(masked_suspect_arr, extent=[min_lon, max_lon, min_lat, max_lat],
-                           transform=ccrs.PlateCarree(), origin='upper', cmap=suspect_colmap, interpolation='none',
-                           zorder=20)
-
-        # Add gridlines
-        if grid:
-            gridlines = subplot_axes.gridlines(draw_labels=True, linewidth=linewidth, color='black', alpha=1.0,
-                                               linestyle=':', zorder=23)  # , n_steps=3)
-            gridlines.xlocator = mpl.ticker.FixedLocator(x_ticks)
-            gridlines.ylocator = mpl.ticker.FixedLocator(y_ticks)
-
-            gridlines.xlabel_style = {'size': gridlabel_size, 'color': 'black'}
-            gridlines.ylabel_style = {'size': gridlabel_size, 'color': 'black'}
-
-        # Create colorbar
-        log(env["General"]["log"], '   creating colorbar')
-        fig = plt.gcf()
-        fig.subplots_adjust(top=1, bottom=0, left=0,
-                            right=(aspect_ratio * 3) / ((aspect_ratio * 3) + (1.2 * legend_extension)),
-                            wspace=0.05, hspace=0.05)
-        cax = fig.add_axes([(aspect_ratio * 3) / ((aspect_ratio * 3) + (0.6 * legend_extension)), 0.15, 0.03, 0.7])
-
-        # discrete colorbar option for Forel-Ule classes
-        if 'Forel-Ule' in title_str:
-            cbar = fig.colorbar(parameter, cax=cax, orientation=bar_orientation, norm=norm, boundaries=boundaries,
-                                ticks=ticks, format=tick_format)
-            cbar.ax.tick_params(labelsize=6)
-        else:
-            cbar = fig.colorbar(parameter, cax=cax, ticks=ticks, format=tick_format, orientation=bar_orientation)
-            cbar.ax.tick_params(labelsize=8)
-
-        # Save plot
-        plt.title(legend_str, y=1.05, fontsize=8)
-        log(env["General"]["log"], 'Writing {}'.format(os.path.basename(output_file)))
-        plt.savefig(output_file, bbox_inches='tight', dpi=300)
-        plt.close()
+    if basemap in ['quadtree_rgb', 'nobasemap']:
+
+        if basemap == 'nobasemap':
+            log(env["General"]["log"], '   proceeding without basemap')
+        if basemap == 'quadtree_rgb':
+            log(env["General"]["log"], '   preparing Quadtree tiles basemap')
+
+            # background = maps.GoogleTiles(style='street')
+            # background = maps.GoogleTiles(style='satellite')
+            # background = maps.GoogleTiles(style='terrain')
+            # background = maps.MapQuestOpenAerial()
+            # background = maps.OSM()
+            background = maps.QuadtreeTiles()
+            # crs = maps.GoogleTiles().crs
+            # crs = maps.QuadtreeTiles().crs
+
+            # Add background
+            subplot_axes.add_image(background, 10)
+
+    # Add gridlines
+    if grid:
+        gridlines = subplot_axes.gridlines(draw_labels=True, linewidth=linewidth, color='black', alpha=1.0,
+                                           linestyle=':', zorder=23)  # , n_steps=3)
+        gridlines.xlocator = mpl.ticker.FixedLocator(x_ticks)
+        gridlines.ylocator = mpl.ticker.FixedLocator(y_ticks)
+
+        gridlines.xlabel_style = {'size': gridlabel_size, 'color': 'black'}
+        gridlines.ylabel_style = {'size': gridlabel_size, 'color': 'black'}
+
+    # Reserve space for the colorbar
+    fig.subplots_adjust(top=1, bottom=0, left=0,
+                        right=(aspect_ratio * 3) / ((aspect_ratio * 3) + (1.2 * legend_extension)),
+                        wspace=0.05, hspace=0.05)
+    cax = fig.add_axes([(aspect_ratio * 3) / ((aspect_ratio * 3) + (0.6 * legend_extension)), 0.15, 0.03, 0.7])
+
+    return {"fig": fig, "axes": subplot_axes, "cax": cax}
+
+
+class CachedRasterSource(RasterSource):
+    """A raster source which serves a single, already rendered basemap image."""
+
+    def __init__(self, located_image):
+        self.located_image = located_image
+
+    def validate_projection(self, projection):
+        return isinstance(projection, ccrs.PlateCarree)
+
+    def fetch_raster(self, projection, extent, target_resolution):
+        return [self.located_image]
+
+
+class LocalSRTMDownloader(Downloader):
+    """
+    Resolves SRTM tiles from a local DEM directory (files named like N46E007.hgt) before falling back to the
+    cartopy data directory. In offline mode missing tiles are never downloaded.
+    """
+
+    def __init__(self, downloader, dem_path=None, offline=False):
+        pre_downloaded_path_template = downloader.pre_downloaded_path_template
+        if dem_path:
+            pre_downloaded_path_template = os.path.join(dem_path, "{y}{x}.hgt")
+        super().__init__(downloader.url_template, downloader.target_path_template, pre_downloaded_path_template)
+        self.downloader = downloader
+        self.offline = offline
+
+    def url(self, format_dict):
+        return self.downloader.url(format_dict)
+
+    def acquire_resource(self, target_path, format_dict):
+        if self.offline:
+            raise RuntimeError("SRTM tile {} is not available locally and basemaps are set to offline."
+                               .format(os.path.basename(target_path)))
+        return self.downloader.acquire_resource(target_path, format_dict)
+
+
+def get_basemap_settings(env):
+    """Returns the basemap cache directory, the local DEM directory and the offline flag from the environment."""
+    if not env.has_section("BASEMAP"):
+        return None, None, False
+    cache_path = env["BASEMAP"].get("cache_path", "") or None
+    dem_path = env["BASEMAP"].get("dem_path", "") or None
+    offline = env["BASEMAP"].get("offline", "False").lower() == "true"
+    return cache_path, dem_path, offline
+
+
+def get_srtm_raster(env, basemap, source, max_tiles, postprocess):
+    """
+    Returns a raster source for the SRTM basemap of the current canvas area. Rendered basemaps are stored once per
+    perimeter in the basemap cache of the environment and reused by all later quicklooks. Returns None if the
+    basemap is neither cached nor can be created without network access in offline mode, or if the canvas area spans
+    too many SRTM tiles.
+    """
+    cache_path, dem_path, offline = get_basemap_settings(env)
+    canvas_extent = (canvas_area[0][0], canvas_area[1][0], canvas_area[0][1], canvas_area[1][1])
+
+    cache_file = None
+    if cache_path:
+        key = "{}_{}_{}".format(source.__name__, max_tiles, ",".join("{:.6f}".format(c) for c in canvas_extent))
+        cache_file = os.path.join(cache_path, BASEMAP_FILENAME.format(basemap, hashlib.md5(key.encode()).hexdigest()))
+        if os.path.isfile(cache_file):
+            log(env["General"]["log"], '   reading cached basemap {}'.format(os.path.basename(cache_file)))
+            with np.load(cache_file) as cached:
+                return CachedRasterSource(LocatedImage(cached['image'], tuple(cached['extent'])))
+
+    raster = source(max_nx=max_tiles, max_ny=max_tiles)
+    raster.downloader = LocalSRTMDownloader(raster.downloader, dem_path, offline)
+    raster = PostprocessedRasterSource(raster, postprocess)
+    if cache_file is None and not offline:
+        return raster
+
+    try:
+        located_images = raster.fetch_raster(ccrs.PlateCarree(), canvas_extent, None)
+    except (Exception, ):
+        if offline:
+            return None
+        raise
+    if not located_images:
+        # cartopy returns no image if the canvas area spans more than max_tiles SRTM tiles in any direction
+        log(env["General"]["log"], '   SRTM basemap spans more than {} tiles'.format(max_tiles))
+        return None
+    located_image = located_images[0]
+
+    if cache_file is not None:
+        log(env["General"]["log"], '   caching basemap {}'.format(os.path.basename(cache_file)))
+        os.makedirs(cache_path, exist_ok=True)
+        with open(cache_file + ".incomplete", "wb") as f:
+            np.savez_compressed(f, image=np.asarray(located_image.image), extent=np.array(located_image.extent))
+        os.replace(cache_file + ".incomplete", cache_file)
+    return CachedRasterSource(located_image)
 
 
 def elevate(located_elevations):
@@ -0,0 +1,288 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Temporal compositing combines the per-date outputs of a processor into daily, weekly, monthly or whole-run products,
+with per-pixel count, mean, min, max, median and percentiles. All outputs must be on the common grid of the perimeter.
+The products are streamed in blocks of rows, so memory is constant in the number of dates, and every product is opened
+once per pass over a band. Median and percentiles are interpolated from per-pixel histograms between the per-pixel
+minimum and maximum, in a second pass over as many rows as fit into the histogram memory.
+
+A composite records its input products with their fingerprints and its options. An existing composite is rebuilt from
+the union of its recorded and the new products of its period if that set, an input or the options changed, so later
+runs complete and refresh the composites of earlier runs.
+"""
+
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+from netCDF4 import Dataset
+
+from utils.auxil import log
+from utils.intermediate import is_intermediate
+from utils.product_fun import get_sensing_date_from_product_name
+from utils.provenance import get_file_fingerprint
+
+# Key of the params section for compositing
+PARAMS_SECTION = "COMPOSITE"
+# The name of the folder to which the composites will be saved
+OUT_DIR = "L3COMPOSITE"
+# A pattern for the name of the composite files (completed with processor, period start and period end)
+OUT_FILENAME = "L3COMPOSITE_{}_{}_{}.nc"
+# Keys of the params section which are not processor names
+OPTION_KEYS = ["period", "statistics", "bins"]
+# Supported compositing periods
+PERIODS = ["day", "week", "month", "run"]
+DEFAULT_PERIOD = "month"
+DEFAULT_STATISTICS = "count,mean,median"
+# Number of histogram bins per pixel used to estimate median and percentiles
+DEFAULT_BINS = 128
+# Number of rows read from every product at once
+BLOCK_ROWS = 32
+# Bytes of per-pixel histograms held at once, bounds the rows of a band which are covered by one histogram pass
+HISTOGRAM_MEMORY = 512e6
+
+
+def apply(env, params, l2product_files, l2_path):
+    """
+    Composite the outputs of all product groups of a run.
+
+    Parameters
+    -------------
+
+    env
+        Dictionary of environment parameters, loaded from input file
+    params
+        Dictionary of parameters, loaded from input file
+    l2product_files
+        Dictionary of the Level 2 product files of each product group
+    l2_path
+        The output folder in which to save the composites
+    """
+    period = params[PARAMS_SECTION].get("period", DEFAULT_PERIOD).strip().lower()
+    if period not in PERIODS:
+        raise RuntimeError("Unknown compositing period {}, use one of: {}".format(period, ", ".join(PERIODS)))
+    statistics = list(filter(None, params[PARAMS_SECTION].get("statistics", DEFAULT_STATISTICS).replace(" ", "")
+                             .split(",")))
+    bins = int(params[PARAMS_SECTION].get("bins", DEFAULT_BINS))
+
+    composites = []
+    for key in params[PARAMS_SECTION].keys():
+        if key in OPTION_KEYS:
+            continue
+        processor = key.upper()
+        bands = list(filter(None, params[PARAMS_SECTION][key].replace(" ", "").split(",")))
+        product_files = sorted(set(files[processor] for files in l2product_files.values() if processor in files
+                                   and files[processor] and not is_intermediate(files[processor])))
+        for (start, end), period_files in sorted(group_by_period(product_files, period).items()):
+            output_file = os.path.join(l2_path, OUT_DIR, OUT_FILENAME.format(processor, start, end))
+            if os.path.isfile(output_file):
+                if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
+                    log(env["General"]["log"], "Removing file: ${}".format(output_file), indent=1)
+                    os.remove(output_file)
+                else:
+                    inputs, options = read_composite_inputs(output_file)
+                    period_files = sorted(set(period_files) | set(filter(os.path.isfile, inputs.keys())))
+                    if inputs == get_fingerprints(period_files) and options == get_options(bands, statistics, bins):
+                        log(env["General"]["log"], "Skipping COMPOSITE, target already exists: {}".format(
+                            os.path.basename(output_file)), indent=1)
+                        composites.append(output_file)
+                        continue
+                    log(env["General"]["log"], "Updating COMPOSITE, its products or options changed: {}".format(
+                        os.path.basename(output_file)), indent=1)
+            log(env["General"]["log"], "Compositing {} products of {} from {} to {}.".format(
+                len(period_files), processor, start, end), indent=1)
+            composites.append(composite(env, period_files, output_file, bands, statistics, bins))
+    return composites
+
+
+def group_by_period(product_files, period):
+    """Group product files by the first and last day of the compositing period of their sensing date."""
+    groups = {}
+    for product_file in product_files:
+        date = datetime.strptime(get_sensing_date_from_product_name(os.path.basename(product_file)), r"%Y%m%d").date()
+        if period == "day":
+            key = (date, date)
+        elif period == "week":
+            key = (date - timedelta(days=date.weekday()), date + timedelta(days=6 - date.weekday()))
+        elif period == "month":
+            next_month = (date.replace(day=28) + timedelta(days=4)).replace(day=1)
+            key = (date.replace(day=1), next_month - timedelta(days=1))
+        else:
+            key = None
+        groups.setdefault(key, []).append((date, product_file))
+    if period == "run" and groups:
+        dates = [date for date, _ in groups[None]]
+        groups = {(min(dates), max(dates)): groups.pop(None)}
+    return {(start.strftime(r"%Y%m%d"), end.strftime(r"%Y%m%d")): [product_file for _, product_file in sorted(values)]
+            for (start, end), values in groups.items()}
+
+
+def get_fingerprints(product_files):
+    return {product_file: get_file_fingerprint(product_file) for product_file in product_files}
+
+
+def get_options(bands, statistics, bins):
+    return {"bands": bands, "statistics": statistics, "bins": bins}
+
+
+def read_composite_inputs(output_file):
+    """Return the fingerprints of the input products and the options recorded in a composite, empty for composites
+    written before they were recorded."""
+    with Dataset(output_file) as src:
+        attributes = src.__dict__
+        return json.loads(attributes.get("inputs", "{}")), json.loads(attributes.get("options", "null"))
+
+
+def composite(env, product_files, output_file, bands, statistics, bins=DEFAULT_BINS, block_rows=BLOCK_ROWS):
+    """Composite bands of products on a common grid into one product with one variable per band and statistic."""
+    inputs = get_fingerprints(product_files)
+    reference = next((product_file for product_file in product_files if has_bands(product_file, bands)), None)
+    if reference is None:
+        raise RuntimeError("None of the products to composite into {} has the bands {}.".format(
+            os.path.basename(output_file), ", ".join(bands)))
+    with Dataset(reference) as src:
+        height, width = src.variables[bands[0]].shape
+        lat, lon = np.asarray(src.variables['lat'][:]), np.asarray(src.variables['lon'][:])
+    # grids match if their coordinates differ by less than a tenth of a pixel
+    tolerance = max(abs(float(lat[-1]) - float(lat[0])) / max(1, len(lat) - 1),
+                    abs(float(lon[-1]) - float(lon[0])) / max(1, len(lon) - 1)) / 10
+    for product_file in list(product_files):
+        if not is_on_grid(product_file, bands, height, width, lat, lon, tolerance):
+            log(env["General"]["log"], "Skipping {}, bands are missing or not on the grid of {}.".format(
+                os.path.basename(product_file), os.path.basename(reference)), indent=2)
+            product_files.remove(product_file)
+
+    blocks = [(y0, min(height, y0 + block_rows)) for y0 in range(0, height, block_rows)]
+    needs_histogram = CompositeAccumulator.needs_histogram(statistics)
+    # the number of blocks per histogram pass, all blocks are written at once without histograms
+    step = max(1, int(HISTOGRAM_MEMORY // (block_rows * width * bins * 4))) if needs_histogram else max(1, len(blocks))
+
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    temp_file = "{}.incomplete".format(output_file)
+    with Dataset(temp_file, mode='w') as dst:
+        dst.createDimension('lat', height)
+        dst.createDimension('lon', width)
+        for name, values in [('lat', lat), ('lon', lon)]:
+            dst.createVariable(name, 'f8', (name, ))
+            dst[name][:] = values
+        dst.setncatts({"products": ",".join(os.path.basename(product_file) for product_file in product_files),
+                       "product_count": len(product_files), "inputs": json.dumps(inputs, sort_keys=True),
+                       "options": json.dumps(get_options(bands, statistics, bins))})
+        for band in bands:
+            for statistic in statistics:
+                dtype = 'i4' if statistic == "count" else 'f4'
+                dst.createVariable("{}_{}".format(band, statistic), dtype, ('lat', 'lon'),
+                                   fill_value=0 if statistic == "count" else np.nan, zlib=True, complevel=6)
+            accumulators = [CompositeAccumulator((y1 - y0, width), bins) for y0, y1 in blocks]
+            read_blocks(product_files, band, blocks, [accumulator.add for accumulator in accumulators])
+            for i in range(0, len(blocks), step):
+                if needs_histogram:
+                    read_blocks(product_files, band, blocks[i:i + step],
+                                [accumulator.add_to_histogram for accumulator in accumulators[i:i + step]])
+                for (y0, y1), accumulator in zip(blocks[i:i + step], accumulators[i:i + step]):
+                    for statistic in statistics:
+                        dst["{}_{}".format(band, statistic)][y0:y1, :] = accumulator.result(statistic)
+                # release the histograms of the written rows before the next histogram pass
+                accumulators[i:i + step] = [None] * len(accumulators[i:i + step])
+    os.replace(temp_file, output_file)
+    return output_file
+
+
+def has_bands(product_file, bands):
+    with Dataset(product_file) as src:
+        return all(band in src.variables and len(src.variables[band].shape) == 2 for band in bands) and \
+            'lat' in src.variables and 'lon' in src.variables
+
+
+def is_on_grid(product_file, bands, height, width, lat, lon, tolerance):
+    """Check that a product has all bands with the given shape on the given lat and lon coordinates."""
+    with Dataset(product_file) as src:
+        if not all(band in src.variables and src.variables[band].shape == (height, width) for band in bands):
+            return False
+        if 'lat' not in src.variables or 'lon' not in src.variables or src.variables['lat'].shape != lat.shape or \
+                src.variables['lon'].shape != lon.shape:
+            return False
+        return np.allclose(src.variables['lat'][:], lat, rtol=0, atol=tolerance) and \
+            np.allclose(src.variables['lon'][:], lon, rtol=0, atol=tolerance)
+
+
+def read_blocks(product_files, band, blocks, consumers):
+    """Pass the blocks of rows of a band of every product to their consumers, opening each product once."""
+    for product_file in product_files:
+        with Dataset(product_file) as src:
+            for (y0, y1), consume in zip(blocks, consumers):
+                consume(read_block(src, band, y0, y1))
+
+
+def read_block(src, band, y0, y1):
+    """Read rows y0 to y1 of a band of an open product as float64, with invalid pixels set to NaN."""
+    return np.ma.filled(src.variables[band][y0:y1, :].astype(np.float64), np.nan)
+
+
+class CompositeAccumulator(object):
+    """
+    Per-pixel statistics over a stream of equally shaped blocks. Count, sum, min and max are accumulated with add().
+    For median and percentiles the same blocks are then passed once more to add_to_histogram().
+    """
+
+    def __init__(self, shape, bins=DEFAULT_BINS):
+        self.bins = bins
+        self.count = np.zeros(shape, dtype=np.int32)
+        self.sum = np.zeros(shape, dtype=np.float64)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        self.histogram = None
+
+    def add(self, block):
+        valid = np.isfinite(block)
+        self.count += valid
+        self.sum += np.where(valid, block, 0)
+        self.min = np.where(valid, np.minimum(self.min, block), self.min)
+        self.max = np.where(valid, np.maximum(self.max, block), self.max)
+
+    @staticmethod
+    def needs_histogram(statistics):
+        return any(statistic == "median" or statistic.startswith("p") for statistic in statistics)
+
+    def add_to_histogram(self, block):
+        if self.histogram is None:
+            self.histogram = np.zeros(self.count.shape + (self.bins, ), dtype=np.int32)
+        valid = np.isfinite(block)
+        span = np.where(self.max > self.min, self.max - self.min, 1)
+        index = np.clip(((np.where(valid, block, 0) - self.min) / span * self.bins).astype(np.int64), 0,
+                        self.bins - 1)
+        rows, cols = np.nonzero(valid)
+        np.add.at(self.histogram, (rows, cols, index[rows, cols]), 1)
+
+    def quantile(self, q):
+        """Interpolate the q quantile (0 to 1) from the histograms."""
+        result = np.full(self.count.shape, np.nan)
+        has_values = self.count > 0
+        cumulative = np.cumsum(self.histogram, axis=-1)
+        target = q * self.count
+        index = np.minimum((cumulative < target[..., None]).sum(axis=-1), self.bins - 1)
+        below = np.where(index > 0, np.take_along_axis(cumulative, np.maximum(index - 1, 0)[..., None], -1)[..., 0], 0)
+        in_bin = np.take_along_axis(self.histogram, index[..., None], -1)[..., 0]
+        fraction = np.clip((target - below) / np.maximum(in_bin, 1), 0, 1)
+        width = np.where(self.max > self.min, self.max - self.min, 0) / self.bins
+        result[has_values] = (self.min + (index + fraction) * width)[has_values]
+        return result
+
+    def result(self, statistic):
+        has_values = self.count > 0
+        if statistic == "count":
+            return self.count
+        elif statistic == "mean":
+            return np.where(has_values, self.sum / np.maximum(self.count, 1), np.nan)
+        elif statistic == "min":
+            return np.where(has_values, self.min, np.nan)
+        elif statistic == "max":
+            return np.where(has_values, self.max, np.nan)
+        elif statistic == "median":
+            return self.quantile(0.5)
+        elif statistic.startswith("p") and statistic[1:].isdigit():
+            return self.quantile(int(statistic[1:]) / 100)
+        raise RuntimeError("Unknown compositing statistic {}".format(statistic))
@@ -8,12 +8,17 @@ Documentation for COAH API can be found `here. <https://scihub.copernicus.eu/twi
 """
 
 import os
-import requests
+import shutil
 from requests.auth import HTTPBasicAuth
 
 from requests.status_codes import codes
 from xml.etree import ElementTree
 from zipfile import ZipFile
+
+from dias_apis.paging import fetch_pages, search_windows
+from dias_apis.scheduler import request_with_retry, throttle
+from dias_apis.selective import is_required_file, write_bands_file
+from dias_apis.unzip import extract_stream, get_skip_patterns, is_streaming_enabled
 from utils.auxil import log
 
 # Documentation for COAH API can be found here:
@@ -25,6 +30,8 @@ api_endpoint = "https://scihub.copernicus.eu/dhus"
 search_address = api_endpoint + "/search?q={}&start={}&rows={}"
 # download address
 download_address = api_endpoint + "/odata/v1/Products('{}')/$value"
+# address of the root node of the file tree of a product
+product_node_address = api_endpoint + "/odata/v1/Products('{}')/Nodes('{}')"
 
 
 def authenticate(env):
@@ -34,14 +41,34 @@ def authenticate(env):
 def get_download_requests(auth, start, end, sensor, resolution, wkt, env):
     query = "instrumentshortname:{}+AND+producttype:{}+AND+beginPosition:[{}+TO+{}]+AND+footprint:\"Intersects({})\""
     datatype = get_dataset_id(sensor, resolution)
-    query = query.format(sensor.lower().split("-")[0], datatype, start, end, wkt)
-    uuids, product_names, timelinesss, beginpositions, endpositions = search(auth, query, env)
+
+    def search_window(window_start, window_end):
+        return search(auth, query.format(sensor.lower().split("-")[0], datatype, window_start, window_end, wkt), env)
+    uuids, product_names, timelinesss, beginpositions, endpositions = search_windows(search_window, start, end, env,
+                                                                                     "COAH")
+    uuids, product_names = timeliness_filter(uuids, product_names, timelinesss, beginpositions, endpositions)
+    return [{'uuid': uuid} for uuid in uuids], product_names
+
+
+def get_updated_files(auth, start, end, sensor, resolution, wkt, published_after, env):
+    query = "instrumentshortname:{}+AND+producttype:{}+AND+beginPosition:[{}+TO+{}]+AND+footprint:\"Intersects({})\"" \
+            "+AND+ingestiondate:[{}+TO+NOW]"
+    datatype = get_dataset_id(sensor, resolution)
+
+    def search_window(window_start, window_end):
+        return search(auth, query.format(sensor.lower().split("-")[0], datatype, window_start, window_end, wkt,
+                                         published_after), env)
+    uuids, product_names, timelinesss, beginpositions, endpositions = search_windows(search_window, start, end, env,
+                                                                                     "COAH")
     uuids, product_names = timeliness_filter(uuids, product_names, timelinesss, beginpositions, endpositions)
     return [{'uuid': uuid} for uuid in uuids], product_names
 
 
 def do_download(auth, download_request, product_path, env):
-    download(auth, download_request['uuid'], product_path, env)
+    if download_request.get('bands') is not None:
+        download_nodes(auth, download_request['uuid'], product_path, download_request['bands'], env)
+    else:
+        download(auth, download_request['uuid'], product_path, env)
 
 
 def get_dataset_id(sensor, resolution):
@@ -60,7 +87,8 @@ def get_dataset_id(sensor, resolution):
 def timeliness_filter(uuids, product_names, timelinesss, beginpositions, endpositions):
     num_products = len(uuids)
     uuids_filtered, product_names_filtered, positions, timelinesss_filtered = [], [], [], []
-    if len(timelinesss) == num_products:
+    # products without timeliness (e.g. Sentinel-2) are not filtered for timeliness
+    if len(timelinesss) == num_products and None not in timelinesss:
         for i in range(num_products):
             curr_pos = (beginpositions[i], endpositions[i])
             if curr_pos in positions:
@@ -88,38 +116,53 @@ def timeliness_filter(uuids, product_names, timelinesss, beginpositions, endposi
 
 
 def search(auth, query, env):
+    """Search all pages of a query, the pages after the first one are fetched in parallel."""
     log(env["General"]["log"], "Search for products: {}".format(query))
-    uuids, filenames = [], []
-    timelinesss, beginpositions, endpositions = [], [], []
-    start, rows = 0, 100
-    while True:
-        # Problems with the SSL verification? See https://urllib3.readthedocs.io/en/latest/user-guide.html#ssl
-        # In the worst case, add 'verify=False' to requests
-        response = requests.get(search_address.format(query, start, rows), auth=auth, verify=False)
-        if response.status_code == codes.OK:
-            root = ElementTree.fromstring(response.text)
-            for entry in root.findall(prepend_ns("entry")):
-                for str_property in entry.findall(prepend_ns("str")):
-                    if str_property.attrib['name'] == "uuid":
-                        uuids.append(str_property.text)
-                    elif str_property.attrib['name'] == "filename":
-                        filenames.append(str_property.text)
-                    elif str_property.attrib['name'] == "timeliness":
-                        timelinesss.append(str_property.text)
-                for date_property in entry.findall(prepend_ns("date")):
-                    if date_property.attrib['name'] == "beginposition":
-                        beginpositions.append(date_property.text)
-                    elif date_property.attrib['name'] == "endposition":
-                        endpositions.append(date_property.text)
-            has_next_page = False
-            for link in root.findall(prepend_ns('link')):
-                if link.attrib['rel'] == "next":
-                    start = start + rows
-                    has_next_page = True
-            if not has_next_page:
-                return uuids, filenames, timelinesss, beginpositions, endpositions
-        else:
-            raise RuntimeError("Unexpeted response: {}".format(response.text))
+    rows = 100
+    entries, total_results = search_page(auth, query, 0, rows, env)
+    if total_results is None:
+        # without a total count the pages can only be followed one after another
+        start = rows
+        while len(entries) == start:
+            page_entries, _ = search_page(auth, query, start, rows, env)
+            entries += page_entries
+            start += rows
+    else:
+        for page_entries, _ in fetch_pages(lambda start: search_page(auth, query, start, rows, env),
+                                           list(range(rows, total_results, rows)), env, "COAH"):
+            entries += page_entries
+    # pages may overlap if products are ingested during the search
+    uuids, filenames, timelinesss, beginpositions, endpositions, seen = [], [], [], [], [], set()
+    for uuid, filename, timeliness, beginposition, endposition in entries:
+        if uuid in seen:
+            continue
+        seen.add(uuid)
+        uuids.append(uuid)
+        filenames.append(filename)
+        timelinesss.append(timeliness)
+        beginpositions.append(beginposition)
+        endpositions.append(endposition)
+    return uuids, filenames, timelinesss, beginpositions, endpositions
+
+
+def search_page(auth, query, start, rows, env):
+    """Return the entries of one page of a search and the total number of results, if the API reports it."""
+    # Problems with the SSL verification? See https://urllib3.readthedocs.io/en/latest/user-guide.html#ssl
+    # In the worst case, add 'verify=False' to requests
+    response = request_with_retry(env, "COAH", "GET", search_address.format(query, start, rows), auth=auth,
+                                  verify=False)
+    if response.status_code != codes.OK:
+        raise RuntimeError("Unexpeted response: {}".format(response.text))
+    root = ElementTree.fromstring(response.text)
+    entries = []
+    for entry in root.findall(prepend_ns("entry")):
+        properties = {}
+        for str_property in entry.findall(prepend_ns("str")) + entry.findall(prepend_ns("date")):
+            properties[str_property.attrib['name']] = str_property.text
+        entries.append((properties.get("uuid"), properties.get("filename"), properties.get("timeliness"),
+                        properties.get("beginposition"), properties.get("endposition")))
+    total_results = root.findtext(prepend_os("totalResults"))
+    return entries, int(total_results) if total_results is not None and total_results.isdigit() else None
 
 
 def download(auth, uuid, filename, env):
@@ -127,10 +170,16 @@ def download(auth, uuid, filename, env):
     log(env["General"]["log"], ("Downloading file from {}.".format(download_address.format(uuid))))
     # Problems with the SSL verification? See https://urllib3.readthedocs.io/en/latest/user-guide.html#ssl
     # In the worst case, add 'verify=False' to requests
-    response = requests.get(download_address.format(uuid), auth=auth, stream=True, verify=False)
-    if response.status_code == codes.OK:
+    response = request_with_retry(env, "COAH", "GET", download_address.format(uuid), auth=auth, stream=True,
+                                  verify=False)
+    if response.status_code == codes.OK and is_streaming_enabled(env):
+        members = extract_stream(throttle(env, "COAH", response.iter_content(chunk_size=2**20)), filename,
+                                 get_skip_patterns(env))
+        log(env["General"]["log"], "Extracted {} members, skipped {}.".format(
+            len(members), len([member for member in members if member["skipped"]])), indent=1)
+    elif response.status_code == codes.OK:
         with open(filename + '.zip', 'wb') as down_stream:
-            for chunk in response.iter_content(chunk_size=2**20):
+            for chunk in throttle(env, "COAH", response.iter_content(chunk_size=2**20)):
                 down_stream.write(chunk)
         with ZipFile(filename + '.zip', 'r') as zip_file:
             zip_file.extractall(os.path.dirname(filename))
@@ -139,6 +188,55 @@ def download(auth, uuid, filename, env):
         log(env["General"]["log"], ("Unexpected response (HTTP {}) on download request: {}".format(response.status_code, response.text)))
 
 
+def download_nodes(auth, uuid, filename, bands, env):
+    """Download the files of a product which are needed for the given bands one by one from its file tree."""
+    temp_filename = "{}.incomplete".format(filename)
+    if os.path.isdir(temp_filename):
+        shutil.rmtree(temp_filename)
+    log(env["General"]["log"], "Downloading files for bands {} from {}.".format(
+        ", ".join(bands), product_node_address.format(uuid, os.path.basename(filename))))
+    skipped = 0
+    for path, node_address in list_nodes(auth, product_node_address.format(uuid, os.path.basename(filename)), "", env):
+        if not is_required_file(path, bands):
+            skipped += 1
+            continue
+        os.makedirs(os.path.dirname(os.path.join(temp_filename, path)), exist_ok=True)
+        # Problems with the SSL verification? See https://urllib3.readthedocs.io/en/latest/user-guide.html#ssl
+        # In the worst case, add 'verify=False' to requests
+        response = request_with_retry(env, "COAH", "GET", node_address + "/$value", auth=auth, stream=True,
+                                      verify=False)
+        if response.status_code != codes.OK:
+            raise RuntimeError("Unexpected response (HTTP {}) on download request: {}".format(
+                response.status_code, response.text))
+        with open(os.path.join(temp_filename, path), 'wb') as down_stream:
+            for chunk in throttle(env, "COAH", response.iter_content(chunk_size=2**20)):
+                down_stream.write(chunk)
+    log(env["General"]["log"], "Skipped {} files of bands which are not needed.".format(skipped), indent=1)
+    write_bands_file(temp_filename, bands)
+    if os.path.isdir(filename):
+        shutil.rmtree(filename)
+    os.replace(temp_filename, filename)
+
+
+def list_nodes(auth, node_address, path, env):
+    """Return the relative path and the address of every file below a node of the file tree of a product."""
+    # Problems with the SSL verification? See https://urllib3.readthedocs.io/en/latest/user-guide.html#ssl
+    # In the worst case, add 'verify=False' to requests
+    response = request_with_retry(env, "COAH", "GET", node_address + "/Nodes?$format=json", auth=auth,
+                                  verify=False)
+    if response.status_code != codes.OK:
+        raise RuntimeError("Unexpected response: {}".format(response.text))
+    files = []
+    for node in response.json()['d']['results']:
+        node_path = os.path.join(path, node['Name'])
+        child_address = node['__metadata']['uri']
+        if int(node.get('ChildrenNumber', 0)) > 0:
+            files += list_nodes(auth, child_address, node_path, env)
+        else:
+            files.append((node_path, child_address))
+    return files
+
+
 def prepend_ns(s):
     return '{http://www.w3.org/2005/Atom}' + s
 
@@ -15,6 +15,10 @@ from requests.status_codes import codes
 from tqdm import tqdm
 from zipfile import ZipFile
 from pathlib import Path
+
+from dias_apis.paging import fetch_pages, search_windows
+from dias_apis.scheduler import request_with_retry, throttle
+from dias_apis.unzip import extract_stream, get_skip_patterns, is_streaming_enabled
 from utils.auxil import log
 
 # Documentation for CREODIAS API can be found here:
@@ -26,6 +30,9 @@ search_address = "https://finder.creodias.eu/resto/api/collections/{}/search.jso
 # download address
 download_address = "https://zipper.creodias.eu/download/{}?token={}"
 
+# number of products per page of a search
+max_records = 1000
+
 # token address
 token_address = 'https://identity.cloudferro.com/auth/realms/Creodias-new/protocol/openid-connect/token' 
 
@@ -35,23 +42,31 @@ def authenticate(env):
 
 
 def get_download_requests(auth, startDate, completionDate, sensor, resolution, wkt, env):
-    query = "maxRecords={}&startDate={}&completionDate={}&instrument={}&geometry={}&productType={}&processingLevel={}"
-    maxRecords = 1000
+    query = "maxRecords={}&startDate={}&completionDate={}&instrument={}&geometry={}&productType={}&processingLevel={}" \
+            "&sortParam=startDate&sortOrder=ascending"
     geometry = wkt.replace(" ", "", 1).replace(" ", "+")
     satellite, instrument, productType, processingLevel = get_dataset_id(sensor, resolution)
-    query = query.format(maxRecords, startDate, completionDate, instrument, geometry, productType, processingLevel)
-    uuids, product_names, timelinesss, beginpositions, endpositions = search(satellite, query, env)
+
+    def search_window(window_start, window_end):
+        return search(satellite, query.format(max_records, window_start, window_end, instrument, geometry, productType,
+                                              processingLevel), env)
+    uuids, product_names, timelinesss, beginpositions, endpositions = search_windows(
+        search_window, startDate, completionDate, env, "CREODIAS")
     uuids, product_names = timeliness_filter(uuids, product_names, timelinesss, beginpositions, endpositions)
     return [{'uuid': uuid} for uuid in uuids], product_names
 
 
-def get_updated_files(auth, startDate, completionDate, sensor, resolution, wkt, publishedAfter):
-    query = "maxRecords={}&startDate={}&completionDate={}&instrument={}&geometry={}&productType={}&processingLevel={}&publishedAfter={}"
-    maxRecords = 1000
+def get_updated_files(auth, startDate, completionDate, sensor, resolution, wkt, publishedAfter, env):
+    query = "maxRecords={}&startDate={}&completionDate={}&instrument={}&geometry={}&productType={}&processingLevel={}" \
+            "&publishedAfter={}&sortParam=startDate&sortOrder=ascending"
     geometry = wkt.replace(" ", "", 1).replace(" ", "+")
     satellite, instrument, productType, processingLevel = get_dataset_id(sensor, resolution)
-    query = query.format(maxRecords, startDate, completionDate, instrument, geometry, productType, processingLevel, publishedAfter)
-    uuids, product_names, timelinesss, beginpositions, endpositions = search(satellite, query)
+
+    def search_window(window_start, window_end):
+        return search(satellite, query.format(max_records, window_start, window_end, instrument, geometry, productType,
+                                              processingLevel, publishedAfter), env)
+    uuids, product_names, timelinesss, beginpositions, endpositions = search_windows(
+        search_window, startDate, completionDate, env, "CREODIAS")
     uuids, product_names = timeliness_filter(uuids, product_names, timelinesss, beginpositions, endpositions)
     return [{'uuid': uuid} for uuid in uuids], product_names
 
@@ -99,23 +114,46 @@ def get_dataset_id(sensor, resolution):
 
 
 def search(satellite, query, env):
+    """Search all pages of a query, the pages after the first one are fetched in parallel."""
     log(env["General"]["log"], "Search for products: {}".format(query))
-    uuids, filenames = [], []
-    timelinesss, beginpositions, endpositions = [], [], []
     log(env["General"]["log"], "Calling: {}".format(search_address.format(satellite, query)), indent=1)
-    while True:
-        response = requests.get(search_address.format(satellite, query))
-        if response.status_code == codes.OK:
-            root = response.json()
-            for feature in root['features']:
-                uuids.append(feature['id'])
-                filenames.append(feature['properties']['title'])
-                timelinesss.append(feature['properties']['timeliness'] if satellite != "Landsat8" else feature['properties']['title'][-2:])
-                beginpositions.append(feature['properties']['startDate'])
-                endpositions.append(feature['properties']['completionDate'])
-            return uuids, filenames, timelinesss, beginpositions, endpositions
-        else:
-            raise RuntimeError("Unexpected response: {}".format(response.text))
+    root = search_page(satellite, query, 1, env)
+    features = root['features']
+    total_results = root.get('properties', {}).get('totalResults')
+    if total_results is None:
+        # without a total count the pages can only be followed one after another
+        page = 1
+        while len(root['features']) == max_records:
+            page += 1
+            root = search_page(satellite, query, page, env)
+            features += root['features']
+    else:
+        for page_root in fetch_pages(lambda page: search_page(satellite, query, page, env),
+                                     list(range(2, (int(total_results) - 1) // max_records + 2)), env, "CREODIAS"):
+            features += page_root['features']
+
+    # pages may overlap if products are published during the search
+    uuids, filenames, timelinesss, beginpositions, endpositions, seen = [], [], [], [], [], set()
+    for feature in features:
+        if feature['id'] in seen:
+            continue
+        seen.add(feature['id'])
+        uuids.append(feature['id'])
+        filenames.append(feature['properties']['title'])
+        timelinesss.append(feature['properties']['timeliness'] if satellite != "Landsat8"
+                           else feature['properties']['title'][-2:])
+        beginpositions.append(feature['properties']['startDate'])
+        endpositions.append(feature['properties']['completionDate'])
+    return uuids, filenames, timelinesss, beginpositions, endpositions
+
+
+def search_page(satellite, query, page, env):
+    address = search_address.format(satellite, "{}&page={}".format(query, page))
+    response = request_with_retry(env, "CREODIAS", "GET", address)
+    if response.status_code == codes.OK:
+        return response.json()
+    else:
+        raise RuntimeError("Unexpected response: {}".format(response.text))
 
 
 def do_download(auth, download_request, product_path, env):
@@ -131,14 +169,24 @@ def do_download(auth, download_request, product_path, env):
     token = get_token(username, password, totp)
     os.makedirs(os.path.dirname(product_path), exist_ok=True)
     url = download_address.format(download_request['uuid'], token)
+    if is_streaming_enabled(env):
+        with request_with_retry(env, "CREODIAS", "GET", url, stream=True, timeout=100) as req:
+            check_download_response(req)
+            with tqdm(unit='B', unit_scale=True, disable=not True) as progress:
+                chunks = throttle(env, "CREODIAS", req.iter_content(chunk_size=2 ** 20))
+                members = extract_stream(progress_chunks(chunks, progress), product_path, get_skip_patterns(env))
+        log(env["General"]["log"], "Extracted {} members, skipped {}.".format(
+            len(members), len([member for member in members if member["skipped"]])), indent=1)
+        return
     file_temp = "{}.incomplete".format(product_path)
     try:
         downloaded_bytes = 0
-        with requests.get(url, stream=True, timeout=100) as req:
+        with request_with_retry(env, "CREODIAS", "GET", url, stream=True, timeout=100) as req:
+            check_download_response(req)
             with tqdm(unit='B', unit_scale=True, disable=not True) as progress:
                 chunk_size = 2 ** 20  # download in 1 MB chunks
                 with open(file_temp, 'wb') as fout:
-                    for chunk in req.iter_content(chunk_size=chunk_size):
+                    for chunk in throttle(env, "CREODIAS", req.iter_content(chunk_size=chunk_size)):
                         if chunk:  # filter out keep-alive new chunks
                             fout.write(chunk)
                             progress.update(len(chunk))
@@ -152,6 +200,19 @@ def do_download(auth, download_request, product_path, env):
             pass
 
 
+def check_download_response(response):
+    """Raise an error for error pages, instead of passing them on to the zip parser."""
+    if response.status_code != codes.OK:
+        raise RuntimeError("Unexpected response (HTTP {}) on download request: {}".format(
+            response.status_code, response.text[:1000]))
+
+
+def progress_chunks(chunks, progress):
+    for chunk in chunks:
+        progress.update(len(chunk))
+        yield chunk
+
+
 def parse_filename(filename):
     if "S3" in filename:
         satellite = "Sentinel-3"
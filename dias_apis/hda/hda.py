@@ -15,37 +15,53 @@ import time
 from requests.auth import HTTPBasicAuth
 from requests.status_codes import codes
 from requests.utils import requote_uri
+from threading import Lock, Thread
 from zipfile import ZipFile
 
+from dias_apis.scheduler import request_with_retry, throttle
+from utils.auxil import log
 from utils.product_fun import get_lons_lats
 
 # Documentation for HDA API can be found here:
 # https://wekeo-broker.apps.mercator.dpi.wekeo.eu/databroker/ui/
 
-# HDA-API endpoint address
+# HDA-API endpoint address, can be overridden with 'api_endpoint' in the HDA section of the environment file (e.g. to
+# run against a local stub of the HDA API)
 api_endpoint = "https://wekeo-broker.apps.mercator.dpi.wekeo.eu"
 # Access-token address
-access_token_address = api_endpoint + "/databroker/gettoken"
+access_token_address = "{endpoint}/databroker/gettoken"
 # Terms and conditions
-accept_tc_address = api_endpoint + "/databroker/termsaccepted/Copernicus_General_License"
+accept_tc_address = "{endpoint}/databroker/termsaccepted/Copernicus_General_License"
 # Metadata address
-metadata_address = api_endpoint + "/databroker/querymetadata/{}"
+metadata_address = "{endpoint}/databroker/querymetadata/{}"
 # Data request address
-datarequest_address = api_endpoint + "/databroker/datarequest"
+datarequest_address = "{endpoint}/databroker/datarequest"
 # Data request status address
-datarequest_status_address = api_endpoint + "/databroker/datarequest/status/{}"
+datarequest_status_address = "{endpoint}/databroker/datarequest/status/{}"
 # Data request data address
-datarequest_result_address = api_endpoint + "/databroker/datarequest/jobs/{}/result"
+datarequest_result_address = "{endpoint}/databroker/datarequest/jobs/{}/result"
 # Data order address
-dataorder_address = api_endpoint + "/databroker/dataorder"
+dataorder_address = "{endpoint}/databroker/dataorder"
 # Data order status address
-dataorder_status_address = api_endpoint + "/databroker/dataorder/status/{}"
+dataorder_status_address = "{endpoint}/databroker/dataorder/status/{}"
 # Data order download address
-dataorder_download_address = api_endpoint + "/databroker/dataorder/download/{}"
+dataorder_download_address = "{endpoint}/databroker/dataorder/download/{}"
+# First and last interval in seconds between two status requests of a data request or data order
+POLL_INTERVAL_MIN = 2
+POLL_INTERVAL_MAX = 60
+# Factor by which the poll interval grows after every status request
+POLL_BACKOFF = 2
+# Access tokens are valid for one hour, they are renewed after this number of seconds
+ACCESS_TOKEN_LIFETIME = 3000
+# Number of consecutive failed status requests after which a data order is given up
+MAX_STATUS_ERRORS = 5
 
 
 def authenticate(env):
-    return HTTPBasicAuth(env['username'], env['password'])
+    auth = HTTPBasicAuth(env['username'], env['password'])
+    auth.api_endpoint = env['api_endpoint'].rstrip("/") if 'api_endpoint' in env else api_endpoint
+    return auth
+
 
 def get_download_requests(auth, start, end, sensor, resolution, wkt, env):
     lons, lats = get_lons_lats(wkt)
@@ -56,20 +72,128 @@ def get_download_requests(auth, start, end, sensor, resolution, wkt, env):
         'stringChoiceValues': []
     }
 
+    endpoint = auth.api_endpoint
     access_token = get_access_token(auth)
-    accept_tc_if_required(access_token)
-    job_id = post_datarequest(access_token, datarequest)
-    wait_for_datarequest_to_complete(access_token, job_id)
-    uris, product_names = get_datarequest_results(access_token, job_id)
+    accept_tc_if_required(endpoint, access_token)
+    job_id = post_datarequest(endpoint, access_token, datarequest)
+    wait_for_datarequest_to_complete(endpoint, access_token, job_id)
+    uris, product_names = get_datarequest_results(endpoint, access_token, job_id)
 
     return [{'job_id': job_id, 'uri': uri} for uri in uris], product_names
 
 
-def do_download(auth, download_request, product_path):
-    access_token = get_access_token(auth)
-    order_id = post_dataorder(access_token, download_request['job_id'], download_request['uri'])
-    wait_for_dataorder_to_complete(access_token, order_id)
-    dataorder_download(access_token, order_id, product_path)
+def do_download(auth, download_request, product_path, env):
+    """Order and download a single product."""
+    failed = do_downloads(auth, [download_request], [product_path], env)
+    if failed:
+        log(env["General"]["log"], "Download of {} failed: {}".format(product_path, failed[product_path]))
+
+
+def do_downloads(auth, download_requests, product_paths, env, semaphore=None, on_complete=None):
+    """
+    Order and download many products at once. All data orders are submitted first, their status is then polled in one
+    loop with exponentially growing intervals, and every product is downloaded in its own thread as soon as its order
+    is completed, while the other orders are still being polled.
+
+    Parameters
+    -------------
+
+    auth
+        Auth details for the HDA API
+    download_requests
+        Download requests as returned by get_download_requests
+    product_paths
+        The paths to which the products are downloaded, products which already exist are skipped
+    env
+        Dictionary of environment parameters, loaded from input file
+    semaphore
+        | **Default: None**
+        | Semaphore which bounds the number of parallel downloads
+    on_complete
+        | **Default: None**
+        | Function which is called with the product path and an error message, or None on success, when a product is
+        | finished
+
+    Returns the error messages of the products which could not be downloaded by product path.
+    """
+    endpoint, token = auth.api_endpoint, {}
+    failed, failed_lock = {}, Lock()
+
+    def get_token():
+        if not token or time.time() - token["time"] > ACCESS_TOKEN_LIFETIME:
+            token.update({"access_token": get_access_token(auth), "time": time.time()})
+        return token["access_token"]
+
+    def finish(product_path, error):
+        if error is not None:
+            with failed_lock:
+                failed[product_path] = error
+        if on_complete is not None:
+            on_complete(product_path, error)
+
+    def download(order_id, product_path):
+        try:
+            if semaphore is not None:
+                with semaphore:
+                    dataorder_download(endpoint, get_token(), order_id, product_path, env)
+            else:
+                dataorder_download(endpoint, get_token(), order_id, product_path, env)
+            finish(product_path, None if os.path.exists(product_path) else "Product missing after download.")
+        except (Exception, ) as e:
+            finish(product_path, str(e))
+
+    # submit the orders of all products which are not yet available
+    orders = {}
+    for download_request, product_path in zip(download_requests, product_paths):
+        if os.path.exists(product_path):
+            finish(product_path, None)
+            continue
+        try:
+            order_id = post_dataorder(endpoint, get_token(), download_request['job_id'], download_request['uri'])
+        except (Exception, ) as e:
+            finish(product_path, str(e))
+            continue
+        orders[order_id] = {"product_path": product_path, "interval": POLL_INTERVAL_MIN,
+                            "next_poll": time.time() + POLL_INTERVAL_MIN, "errors": 0}
+    log(env["General"]["log"], "Submitted {} data orders to {}.".format(len(orders), endpoint))
+
+    # poll all orders in one loop and start the download of every order which is completed
+    download_threads = []
+    while orders:
+        time.sleep(max(0, min(order["next_poll"] for order in orders.values()) - time.time()))
+        for order_id, order in list(orders.items()):
+            if order["next_poll"] > time.time():
+                continue
+            try:
+                status = get_dataorder_status(endpoint, get_token(), order_id, env)
+            except (Exception, ) as e:
+                # the order may still be running on the server, it is only given up after several errors in a row
+                order["errors"] += 1
+                status = "failed" if order["errors"] >= MAX_STATUS_ERRORS else "unknown"
+                message = "Status request {} of data order {} failed: {}".format(order["errors"], order_id, e)
+                if status == "unknown":
+                    log(env["General"]["log"], message, indent=1)
+            else:
+                order["errors"] = 0
+                message = "Data order {} ended with status {}.".format(order_id, status)
+            if status == "completed":
+                log(env["General"]["log"], "Data order {} completed, downloading {}.".format(
+                    order_id, os.path.basename(order["product_path"])), indent=1)
+                download_threads.append(Thread(target=download, args=(order_id, order["product_path"]),
+                                               name="Thread-download-{}".format(order_id)))
+                download_threads[-1].start()
+                del orders[order_id]
+            elif status in ["failed", "cancelled", "error"]:
+                log(env["General"]["log"], message, indent=1)
+                finish(order["product_path"], message)
+                del orders[order_id]
+            else:
+                order["interval"] = min(POLL_INTERVAL_MAX, order["interval"] * POLL_BACKOFF)
+                order["next_poll"] = time.time() + order["interval"]
+
+    for download_thread in download_threads:
+        download_thread.join()
+    return failed
 
 
 def get_dataset_id(sensor, resolution):
@@ -82,9 +206,10 @@ def get_dataset_id(sensor, resolution):
 
 
 def get_access_token(auth):
+    address = access_token_address.format(endpoint=auth.api_endpoint)
     print("Getting an access token for user {}. This token is valid for one hour only. URL: {}"
-          .format(auth.username, access_token_address))
-    response = requests.get(access_token_address, auth=auth)
+          .format(auth.username, address))
+    response = requests.get(address, auth=auth)
     if response.status_code == codes.OK:
         access_token = json.loads(response.text)['access_token']
         print("Success: Access token is {}".format(access_token))
@@ -93,14 +218,15 @@ def get_access_token(auth):
         raise RuntimeError("Unexpected response {} with header {}".format(response.text, response.headers))
 
 
-def accept_tc_if_required(access_token):
-    print("Checking if Terms and Conditions are already accepted: {}".format(accept_tc_address))
+def accept_tc_if_required(endpoint, access_token):
+    address = accept_tc_address.format(endpoint=endpoint)
+    print("Checking if Terms and Conditions are already accepted: {}".format(address))
     headers = {'authorization': access_token}
-    response = requests.get(accept_tc_address, headers=headers)
+    response = requests.get(address, headers=headers)
     isTandCAccepted = json.loads(response.text)['accepted']
     if not isTandCAccepted:
-        print("Accepting Terms and Conditions of Copernicus_General_License: {}".format(accept_tc_address))
-        response = requests.put(accept_tc_address, headers=headers)
+        print("Accepting Terms and Conditions of Copernicus_General_License: {}".format(address))
+        response = requests.put(address, headers=headers)
         if response.status_code == codes.OK:
             print("Successfully accepted Copernicus_General_License Terms and Conditions.")
         else:
@@ -109,21 +235,22 @@ def accept_tc_if_required(access_token):
         print("Copernicus_General_License Terms and Conditions already accepted.")
 
 
-def query_metadata(access_token, dataset_id):
-    encoded_dataset_id = requote_uri(dataset_id)
-    print("Getting query metadata from {}".format(metadata_address.format(encoded_dataset_id)))
+def query_metadata(endpoint, access_token, dataset_id):
+    address = metadata_address.format(requote_uri(dataset_id), endpoint=endpoint)
+    print("Getting query metadata from {}".format(address))
     headers = {'authorization': access_token}
-    response = requests.get(metadata_address.format(encoded_dataset_id), headers=headers)
+    response = requests.get(address, headers=headers)
     if response.status_code == codes.OK:
         return json.loads(response.text)
     else:
         raise RuntimeError("Unexpected response {}".format(response.text))
 
 
-def post_datarequest(access_token, datarequest):
-    print("Posting datarequest to {}".format(datarequest_address))
+def post_datarequest(endpoint, access_token, datarequest):
+    address = datarequest_address.format(endpoint=endpoint)
+    print("Posting datarequest to {}".format(address))
     headers = {'authorization': access_token}
-    response = requests.post(datarequest_address, headers=headers, json=datarequest)
+    response = requests.post(address, headers=headers, json=datarequest)
     if response.status_code == codes.OK:
         job_id = json.loads(response.text)["jobId"]
         print("Query successfully submitted. Job ID is " + job_id)
@@ -132,28 +259,30 @@ def post_datarequest(access_token, datarequest):
         raise RuntimeError("Unexpected response {}".format(response.text))
 
 
-def wait_for_datarequest_to_complete(access_token, job_id):
+def wait_for_datarequest_to_complete(endpoint, access_token, job_id):
     print("Waiting for data request to complete...")
     headers = {'authorization': access_token}
+    interval = POLL_INTERVAL_MIN
     while True:
-        response = requests.get(datarequest_status_address.format(job_id), headers=headers)
+        response = requests.get(datarequest_status_address.format(job_id, endpoint=endpoint), headers=headers)
         if response.status_code == codes.OK:
             if json.loads(response.text)["status"] == "completed":
                 print("Job {} completed!".format(job_id))
                 return
             else:
-                print("Job {} not yet completed. Wait 10 seconds before checking again...".format(job_id))
-                time.sleep(10)
+                print("Job {} not yet completed. Wait {} seconds before checking again...".format(job_id, interval))
+                time.sleep(interval)
+                interval = min(POLL_INTERVAL_MAX, interval * POLL_BACKOFF)
         else:
             raise RuntimeError("Unexpected response {}".format(response.text))
 
 
-def get_datarequest_results(access_token, job_id):
-    print("Getting data request results from {}".format(datarequest_result_address.format(job_id)))
+def get_datarequest_results(endpoint, access_token, job_id):
+    datarequest_result_address_paged = datarequest_result_address.format(job_id, endpoint=endpoint)
+    print("Getting data request results from {}".format(datarequest_result_address_paged))
     uris = []
     filenames = []
     headers = {'authorization': access_token}
-    datarequest_result_address_paged = datarequest_result_address.format(job_id)
     while True:
         response = requests.get(datarequest_result_address_paged, headers=headers)
         if response.status_code == codes.OK:
@@ -169,14 +298,15 @@ def get_datarequest_results(access_token, job_id):
     return uris, filenames
 
 
-def post_dataorder(access_token, job_id, uri):
-    print("Posting dataorder to {}".format(dataorder_address))
+def post_dataorder(endpoint, access_token, job_id, uri):
+    address = dataorder_address.format(endpoint=endpoint)
+    print("Posting dataorder to {}".format(address))
     headers = {'authorization': access_token}
     dataorder = {
         'jobId': job_id,
         'uri': uri
     }
-    response = requests.post(dataorder_address, headers=headers, json=dataorder)
+    response = requests.post(address, headers=headers, json=dataorder)
     if response.status_code == codes.OK:
         order_id = json.loads(response.text)["orderId"]
         print("Dataorder submitted. Order ID is " + order_id)
@@ -185,33 +315,42 @@ def post_dataorder(access_token, job_id, uri):
         raise RuntimeError("Unexpected response {}".format(response.text))
 
 
-def wait_for_dataorder_to_complete(access_token, order_id):
-    print("Waiting for dataorder {} to complete...".format(order_id))
+def get_dataorder_status(endpoint, access_token, order_id, env):
     headers = {'authorization': access_token}
+    response = request_with_retry(env, "HDA", "GET", dataorder_status_address.format(order_id, endpoint=endpoint),
+                                  headers=headers)
+    if response.status_code == codes.OK:
+        return json.loads(response.text)["status"]
+    else:
+        raise RuntimeError("Unexpected response {}".format(response.text))
+
+
+def wait_for_dataorder_to_complete(endpoint, access_token, order_id, env):
+    print("Waiting for dataorder {} to complete...".format(order_id))
+    interval = POLL_INTERVAL_MIN
     while True:
-        response = requests.get(dataorder_status_address.format(order_id), headers=headers)
-        if response.status_code == codes.OK:
-            if json.loads(response.text)["status"] == "completed":
-                print("Dataorder {} completed!".format(order_id))
-                return
-            else:
-                print("Dataorder {} not yet completed. Wait 10 seconds before checking again...".format(order_id))
-                time.sleep(10)
+        if get_dataorder_status(endpoint, access_token, order_id, env) == "completed":
+            print("Dataorder {} completed!".format(order_id))
+            return
         else:
-            raise RuntimeError("Unexpected response {}".format(response.text))
+            print("Dataorder {} not yet completed. Wait {} seconds before checking again...".format(order_id, interval))
+            time.sleep(interval)
+            interval = min(POLL_INTERVAL_MAX, interval * POLL_BACKOFF)
 
 
-def dataorder_download(access_token, order_id, filename):
-    print("Downloading data from {}".format(dataorder_download_address.format(order_id)))
+def dataorder_download(endpoint, access_token, order_id, filename, env):
+    address = dataorder_download_address.format(order_id, endpoint=endpoint)
+    log(env["General"]["log"], "Downloading data from {}".format(address), indent=1)
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     headers = {'authorization': access_token}
-    response = requests.get(dataorder_download_address.format(order_id), headers=headers, stream=True)
+    response = request_with_retry(env, "HDA", "GET", address, headers=headers, stream=True)
     if response.status_code == codes.OK:
         with open(filename + '.zip', 'wb') as down_stream:
-            for chunk in response.iter_content(chunk_size=65536):
+            for chunk in throttle(env, "HDA", response.iter_content(chunk_size=65536)):
                 down_stream.write(chunk)
         with ZipFile(filename + '.zip', 'r') as zip_file:
             zip_file.extractall(os.path.dirname(filename))
         os.remove(filename + '.zip')
     else:
-        print("Unexpected response on download request: {}".format(response.text))
+        raise RuntimeError("Unexpected response (HTTP {}) on download request: {}".format(
+            response.status_code, response.text))
@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+The LOCALMIRROR API stands in for a remote DIAS without network access. It serves the products of a local directory of
+(possibly synthetic) SAFE, SEN3 or Landsat folders, or zips of them, and filters them by sensing date, sensor and
+intersection of their footprint with the perimeter like a remote API would. It is meant for offline testing and for
+reproducible benchmarks of the orchestration, e.g. of the download scheduler and the product filters.
+
+Settings in the LOCALMIRROR section of the environment file:
+root_path: the directory of the mirrored products
+latency: optional seconds added to every search and download, or 'min,max' for a random latency
+failure_rate: optional probability (0 to 1) that a download fails
+seed: optional seed of the random latency and failures, for reproducible benchmarks
+"""
+
+import os
+import random
+import re
+import shutil
+import time
+from datetime import datetime, timezone
+from threading import Lock
+from xml.etree import ElementTree
+from zipfile import ZipFile
+
+from dias_apis.scheduler import throttle
+from utils.auxil import log
+from utils.product_fun import get_lons_lats, get_sensing_datetime_from_product_name
+
+# Files of a product which contain its footprint, relative to the product folder
+FOOTPRINT_FILES = ["xfdumanifest.xml", "manifest.safe", "MTD_MSIL1C.xml", "MTD_MSIL2A.xml"]
+# Tags of the footprint coordinates in these files
+FOOTPRINT_TAGS = ["posList", "coordinates", "EXT_POS_LIST"]
+# Size of the chunks in which products are copied
+CHUNK_SIZE = 2 ** 20
+
+random_generator, random_lock = None, Lock()
+
+
+def authenticate(env):
+    if not os.path.isdir(env['root_path']):
+        raise RuntimeError("The local mirror {} does not exist.".format(env['root_path']))
+    return env
+
+
+def get_download_requests(auth, start, end, sensor, resolution, wkt, env):
+    return search(auth, start, end, sensor, resolution, wkt, None, env)
+
+
+def get_updated_files(auth, start, end, sensor, resolution, wkt, published_after, env):
+    return search(auth, start, end, sensor, resolution, wkt, published_after, env)
+
+
+def do_download(auth, download_request, product_path, env):
+    """Copy (or extract) a product of the mirror to the product path, with the configured latency and failures."""
+    wait(auth)
+    if get_random(auth).random() < float(auth.get('failure_rate', 0) or 0):
+        raise RuntimeError("Injected failure on download of {}.".format(download_request['uuid']))
+    source = os.path.join(auth['root_path'], download_request['uuid'])
+    os.makedirs(os.path.dirname(product_path), exist_ok=True)
+    log(env["General"]["log"], "Copying product from {}.".format(source))
+    temp_path = "{}.incomplete".format(product_path)
+    shutil.rmtree(temp_path, ignore_errors=True)
+    if source.endswith(".zip"):
+        extract_zip(env, source, temp_path)
+        # zips contain the product folder, or only its content
+        extracted_path = os.path.join(temp_path, os.path.basename(product_path))
+        if os.path.isdir(extracted_path):
+            os.replace(extracted_path, product_path)
+            shutil.rmtree(temp_path)
+        else:
+            os.replace(temp_path, product_path)
+        return
+    for folder, _, files in os.walk(source):
+        target_folder = os.path.join(temp_path, os.path.relpath(folder, source))
+        os.makedirs(target_folder, exist_ok=True)
+        for file in files:
+            copy_file(env, os.path.join(folder, file), os.path.join(target_folder, file))
+    os.replace(temp_path, product_path)
+
+
+def copy_file(env, source_file, target_file):
+    """Copy a file in chunks, which pass through the bandwidth caps of the download scheduler."""
+    with open(source_file, 'rb') as src, open(target_file, 'wb') as dst:
+        for chunk in throttle(env, "LOCALMIRROR", read_chunks(src)):
+            dst.write(chunk)
+
+
+def extract_zip(env, source_file, target_path):
+    """Extract a zip in chunks, which pass through the bandwidth caps of the download scheduler."""
+    target_root = os.path.realpath(target_path)
+    with ZipFile(source_file, 'r') as zip_file:
+        for member in zip_file.infolist():
+            target_file = os.path.realpath(os.path.join(target_root, member.filename))
+            if not target_file.startswith(target_root + os.sep):
+                raise RuntimeError("Zip {} contains a file outside of the product: {}".format(
+                    source_file, member.filename))
+            if member.is_dir():
+                os.makedirs(target_file, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target_file), exist_ok=True)
+            with zip_file.open(member) as src, open(target_file, 'wb') as dst:
+                for chunk in throttle(env, "LOCALMIRROR", read_chunks(src)):
+                    dst.write(chunk)
+
+
+def read_chunks(f):
+    chunk = f.read(CHUNK_SIZE)
+    while chunk:
+        yield chunk
+        chunk = f.read(CHUNK_SIZE)
+
+
+def search(auth, start, end, sensor, resolution, wkt, published_after, env):
+    """Return the products of the mirror which match the criteria, in the format of the remote APIs."""
+    log(env["General"]["log"], "Search for products in local mirror {}.".format(auth['root_path']))
+    wait(auth)
+    start_time, end_time = parse_date(start), parse_date(end)
+    published_after_time = parse_date(published_after) if published_after else None
+    lons, lats = get_lons_lats(wkt)
+    uuids, product_names = [], []
+    for entry in sorted(os.listdir(auth['root_path'])):
+        product_name = entry[:-4] if entry.endswith(".zip") else entry
+        if not product_name.endswith((".SEN3", ".SAFE")) and not product_name.startswith("LC08"):
+            continue
+        if not matches_sensor(product_name, sensor, resolution):
+            continue
+        try:
+            sensing_time = datetime.strptime(get_sensing_datetime_from_product_name(product_name), r"%Y%m%dT%H%M%S")
+        except (IndexError, ValueError):
+            continue
+        if not start_time <= sensing_time.replace(tzinfo=timezone.utc) <= end_time:
+            continue
+        path = os.path.join(auth['root_path'], entry)
+        if published_after_time is not None and \
+                datetime.fromtimestamp(os.path.getmtime(path), timezone.utc) < published_after_time:
+            continue
+        footprint = read_footprint(path)
+        if footprint is not None and not intersects(footprint, (min(lons), min(lats), max(lons), max(lats))):
+            continue
+        uuids.append(entry)
+        product_names.append(product_name)
+    log(env["General"]["log"], "Found {} products.".format(len(uuids)), indent=1)
+    return [{'uuid': uuid} for uuid in uuids], product_names
+
+
+def matches_sensor(product_name, sensor, resolution):
+    if sensor == "OLCI":
+        return "_OL_1_{}___".format("EFR" if int(resolution) < 1000 else "ERR") in product_name
+    elif sensor == "MSI":
+        return "_MSIL1C_" in product_name
+    elif sensor == "MSI-L2A":
+        return "_MSIL2A_" in product_name
+    elif sensor == "OLI_TIRS":
+        return product_name.startswith("LC08")
+    raise RuntimeError("LOCALMIRROR API is not yet implemented for sensor: {}".format(sensor))
+
+
+def parse_date(date):
+    """Parse a date of the search period (with milliseconds) or of the publication time (without)."""
+    date_format = r"%Y-%m-%dT%H:%M:%S.%fZ" if "." in date else r"%Y-%m-%dT%H:%M:%SZ"
+    return datetime.strptime(date.strip(), date_format).replace(tzinfo=timezone.utc)
+
+
+def read_footprint(path):
+    """Return the bounding box (west, south, east, north) of the footprint of a product, or None if it has none."""
+    for footprint_file in FOOTPRINT_FILES:
+        try:
+            if path.endswith(".zip"):
+                with ZipFile(path, 'r') as zip_file:
+                    names = [name for name in zip_file.namelist() if name.endswith("/" + footprint_file)]
+                    if not names:
+                        continue
+                    root = ElementTree.fromstring(zip_file.read(names[0]))
+            elif os.path.isfile(os.path.join(path, footprint_file)):
+                root = ElementTree.parse(os.path.join(path, footprint_file)).getroot()
+            else:
+                continue
+        except (ElementTree.ParseError, OSError):
+            continue
+        for element in root.iter():
+            if element.tag.split("}")[-1] in FOOTPRINT_TAGS and element.text:
+                return parse_footprint(element.text)
+    return None
+
+
+def parse_footprint(text):
+    """Return the bounding box of footprint coordinates, which are given as latitude and longitude pairs."""
+    values = [float(value) for value in re.findall(r"[-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?", text)]
+    lats, lons = values[0::2], values[1::2]
+    if not lats or not lons:
+        return None
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+def intersects(box, other):
+    return box[0] <= other[2] and other[0] <= box[2] and box[1] <= other[3] and other[1] <= box[3]
+
+
+def get_random(auth):
+    global random_generator
+    with random_lock:
+        if random_generator is None:
+            random_generator = random.Random(auth['seed']) if 'seed' in auth else random.Random()
+        return random_generator
+
+
+def wait(auth):
+    """Sleep for the configured latency."""
+    if 'latency' not in auth or not auth['latency'].strip():
+        return
+    bounds = [float(value) for value in auth['latency'].split(",")]
+    latency = bounds[0] if len(bounds) == 1 else get_random(auth).uniform(bounds[0], bounds[1])
+    time.sleep(latency)
@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Paged search shared by the DIAS APIs. Large date ranges are split into sub-windows which are searched in parallel, the
+pages of every sub-window after the first one are fetched in parallel as soon as the first page reveals the total count,
+and the results of all pages and sub-windows are merged without duplicates before the filters of the API run.
+
+The number of parallel requests and the length of the sub-windows can be set per API in the environment file with
+'search_workers' and 'search_window_days' (0 to search the whole range at once).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# Default number of search requests which are sent to an API at once
+DEFAULT_SEARCH_WORKERS = 4
+# Default number of days of a sub-window of a search
+DEFAULT_SEARCH_WINDOW_DAYS = 31
+# Format of the dates of a search, with and without milliseconds
+DATE_FORMAT = r"%Y-%m-%dT%H:%M:%S.%fZ"
+DATE_FORMAT_SECONDS = r"%Y-%m-%dT%H:%M:%SZ"
+
+
+def get_search_workers(env, api):
+    if api in env and "search_workers" in env[api]:
+        return max(1, int(env[api]["search_workers"]))
+    return DEFAULT_SEARCH_WORKERS
+
+
+def get_search_window_days(env, api):
+    if api in env and "search_window_days" in env[api]:
+        return int(env[api]["search_window_days"])
+    return DEFAULT_SEARCH_WINDOW_DAYS
+
+
+def split_date_range(start, end, days):
+    """Split a date range into consecutive sub-windows of at most the given number of days, ranges which cannot be
+    parsed are not split."""
+    try:
+        start_date, end_date = parse_date(start), parse_date(end)
+    except ValueError:
+        return [(start, end)]
+    if days <= 0 or end_date - start_date <= timedelta(days=days):
+        return [(start, end)]
+    windows, window_start = [], start_date
+    while window_start <= end_date:
+        window_end = min(end_date, window_start + timedelta(days=days) - timedelta(milliseconds=1))
+        windows.append((format_date(window_start), format_date(window_end)))
+        window_start = window_end + timedelta(milliseconds=1)
+    return windows
+
+
+def parse_date(date):
+    """Parse a date of a search with or without milliseconds."""
+    return datetime.strptime(date.strip(), DATE_FORMAT if "." in date else DATE_FORMAT_SECONDS)
+
+
+def format_date(date):
+    return date.strftime(DATE_FORMAT)[:-4] + "Z"
+
+
+def search_windows(search_window, start, end, env, api):
+    """
+    Run a search function for every sub-window of a date range in parallel. The search function takes the start and
+    end of a sub-window and returns parallel lists whose first list holds the ids of the products. Returns the merged
+    lists without duplicates, in the order of the sub-windows.
+    """
+    windows = split_date_range(start, end, get_search_window_days(env, api))
+    if len(windows) == 1:
+        return merge_results([search_window(start, end)])
+    with ThreadPoolExecutor(max_workers=min(len(windows), get_search_workers(env, api))) as executor:
+        results = list(executor.map(lambda window: search_window(*window), windows))
+    return merge_results(results)
+
+
+def fetch_pages(fetch_page, page_keys, env, api):
+    """Fetch the pages of a search with a bounded pool, the results are returned in the order of the page keys."""
+    if len(page_keys) <= 1:
+        return [fetch_page(page_key) for page_key in page_keys]
+    with ThreadPoolExecutor(max_workers=min(len(page_keys), get_search_workers(env, api))) as executor:
+        return list(executor.map(fetch_page, page_keys))
+
+
+def merge_results(results):
+    """Merge the parallel lists of several searches, keeping the first occurrence of every product id."""
+    merged, seen = None, set()
+    for result in results:
+        if merged is None:
+            merged = tuple([] for _ in result)
+        for values in zip(*result):
+            if values[0] in seen:
+                continue
+            seen.add(values[0])
+            for merged_list, value in zip(merged, values):
+                merged_list.append(value)
+    return merged if merged is not None else ()
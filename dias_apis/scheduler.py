@@ -0,0 +1,170 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Download scheduling shared by all runs of a process. The DownloadScheduler replaces the single download semaphore: it
+limits the number of parallel downloads overall and per API ('max_parallel_downloads' in the section of the API in the
+environment file), and hands free slots to the most urgent waiting download first. Products sensed within the last
+'nrt_priority_days' (DIAS section, default 3) are downloaded before the backfill of older dates, newest first.
+
+The bandwidth of the downloads is capped with token buckets, one per API ('max_bandwidth' in MB/s in the section of the
+API) and one for all APIs ('max_bandwidth' in the DIAS section). Requests which are answered with HTTP 429 or 503 are
+retried with exponential backoff and random jitter, respecting the Retry-After header of the server.
+"""
+
+import heapq
+import itertools
+import os
+import random
+import time
+from threading import Condition, Lock
+
+import requests
+
+from utils.product_fun import get_sensing_time
+
+# HTTP status codes which signal that a server is throttling its clients
+RETRY_STATUS_CODES = [429, 503]
+# Default number of attempts of a throttled request
+DEFAULT_RETRY_ATTEMPTS = 5
+# Base and maximum of the exponential backoff between two attempts in seconds
+RETRY_BACKOFF_BASE = 2
+RETRY_BACKOFF_MAX = 120
+# Default number of days before today within which products are downloaded first
+DEFAULT_NRT_PRIORITY_DAYS = 3
+# Key of the buckets which cap the bandwidth of all APIs together
+ALL_APIS = "DIAS"
+
+buckets, buckets_lock = {}, Lock()
+
+
+def get_download_priority(env, product_path):
+    """Return the priority of a product download, lower values are downloaded first."""
+    sensing_time = get_sensing_time(os.path.basename(os.path.normpath(product_path)))
+    if sensing_time is None:
+        return 1, 0
+    nrt_days = int(env['DIAS'].get('nrt_priority_days', DEFAULT_NRT_PRIORITY_DAYS))
+    return 0 if time.time() - sensing_time < nrt_days * 86400 else 1, -sensing_time
+
+
+def get_bucket(env, api):
+    """Return the token bucket of an API (or of all APIs for ALL_APIS), or None if its bandwidth is not capped."""
+    with buckets_lock:
+        if api not in buckets:
+            section = env[api] if api in env else {}
+            rate = float(section.get('max_bandwidth', 0) or 0) * 1e6
+            buckets[api] = TokenBucket(rate) if rate > 0 else None
+        return buckets[api]
+
+
+def throttle(env, api, chunks):
+    """Pass through the chunks of a download, waiting as long as needed to keep the bandwidth caps."""
+    throttling = [bucket for bucket in [get_bucket(env, api), get_bucket(env, ALL_APIS)] if bucket is not None]
+    for chunk in chunks:
+        for bucket in throttling:
+            bucket.consume(len(chunk))
+        yield chunk
+
+
+def request_with_retry(env, api, method, url, **kwargs):
+    """Send a request, retrying with exponential backoff and jitter as long as the server answers with 429 or 503."""
+    attempts = int(env[api].get('retry_attempts', DEFAULT_RETRY_ATTEMPTS)) if api in env else DEFAULT_RETRY_ATTEMPTS
+    for attempt in range(attempts):
+        response = requests.request(method, url, **kwargs)
+        if response.status_code not in RETRY_STATUS_CODES or attempt == attempts - 1:
+            return response
+        delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+        retry_after = response.headers.get('Retry-After', "")
+        if retry_after.isdigit():
+            delay = max(delay, min(RETRY_BACKOFF_MAX, int(retry_after)))
+        response.close()
+        time.sleep(delay)
+
+
+class TokenBucket(object):
+    """Caps a rate in bytes per second with bursts of up to one second. Consumers go into debt and wait it off."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def consume(self, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - nbytes
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class PrioritySemaphore(object):
+    """A semaphore which wakes its waiters in the order of their priority (lowest first), and in order of arrival."""
+
+    def __init__(self, value):
+        self.value = value
+        self.condition = Condition()
+        self.waiters = []
+        self.counter = itertools.count()
+
+    def acquire(self, priority=0):
+        with self.condition:
+            entry = (priority, next(self.counter))
+            heapq.heappush(self.waiters, entry)
+            while self.value <= 0 or self.waiters[0] != entry:
+                self.condition.wait()
+            heapq.heappop(self.waiters)
+            self.value -= 1
+            self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.value += 1
+            self.condition.notify_all()
+
+
+class DownloadScheduler(object):
+    """Limits parallel downloads overall and per API, slots are taken with 'with scheduler.slot(api, priority):'."""
+
+    def __init__(self, max_parallel_downloads, env):
+        self.env = env
+        self.all_apis = PrioritySemaphore(max_parallel_downloads)
+        self.max_parallel_downloads = max_parallel_downloads
+        self.apis = {}
+        self.lock = Lock()
+
+    def get_api_semaphore(self, api):
+        with self.lock:
+            if api not in self.apis:
+                limit = self.max_parallel_downloads
+                if api in self.env and 'max_parallel_downloads' in self.env[api]:
+                    limit = int(self.env[api]['max_parallel_downloads'])
+                self.apis[api] = PrioritySemaphore(limit)
+            return self.apis[api]
+
+    def acquire(self, api, priority=(1, 0)):
+        self.get_api_semaphore(api).acquire(priority)
+        self.all_apis.acquire(priority)
+
+    def release(self, api):
+        self.all_apis.release()
+        self.get_api_semaphore(api).release()
+
+    def slot(self, api, priority=(1, 0)):
+        return DownloadSlot(self, api, priority)
+
+
+class DownloadSlot(object):
+    """A download slot of an API, usable as context manager from several threads at once."""
+
+    def __init__(self, scheduler, api, priority):
+        self.scheduler, self.api, self.priority = scheduler, api, priority
+
+    def __enter__(self):
+        self.scheduler.acquire(self.api, self.priority)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.scheduler.release(self.api)
@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Selective download of Sentinel-2 products, enabled with 'selective_download=True'. Instead of the whole SAFE archive,
+only the files of the product which the configured processors and quick looks need are fetched one by one from APIs
+which expose the file tree of a product. All files are kept except the images of bands which are not needed.
+
+Processors declare the Sentinel-2 L1 bands they read with a REQUIRED_BANDS attribute. If any configured processor does
+not declare them, the whole product is downloaded.
+
+Partial products are saved at the path of the full product with a file listing the bands they contain. Runs which need
+other bands, or whole products, download the product again.
+"""
+
+import importlib
+import os
+import re
+
+# Pattern of the band images of a SAFE product (band images in IMG_DATA and band masks in QI_DATA)
+BAND_FILE_PATTERN = re.compile(r"_(B\d{1,2}A?)(_\d+m)?\.jp2$", re.IGNORECASE)
+# Pattern of the bands in the params sections of the quick look adapters
+BAND_NAME_PATTERN = re.compile(r"^B\d{1,2}A?$", re.IGNORECASE)
+# Sections of adapters which read the bands listed in their params
+BAND_ADAPTER_SECTIONS = ["QLRGB", "QLSINGLEBAND"]
+# The name of the file in a partial product which lists the bands it contains
+BANDS_FILENAME = "sencast_bands.txt"
+
+
+def is_selective_download_enabled(params):
+    return "selective_download" in params["General"] and params["General"]["selective_download"] == "True" and \
+        params["General"]["sensor"].startswith("MSI")
+
+
+def get_required_bands(params):
+    """Return the normalised names of the bands the processors and adapters of the params read, or None if all."""
+    bands = set()
+    for processor in list(filter(None, params['General']['processors'].replace(" ", "").split(","))):
+        module = importlib.import_module("processors.{}.{}".format(processor.lower(), processor.lower()))
+        if not hasattr(module, "REQUIRED_BANDS"):
+            return None
+        bands.update(normalise_band(band) for band in module.REQUIRED_BANDS)
+    for section in BAND_ADAPTER_SECTIONS:
+        if params.has_section(section):
+            for value in params[section].values():
+                bands.update(normalise_band(band) for band in value.replace(" ", "").split(",")
+                             if BAND_NAME_PATTERN.match(band))
+    return sorted(bands)
+
+
+def normalise_band(band):
+    """Normalise a band name to the naming of the SAFE files, e.g. B4 to B04."""
+    number = band.upper()[1:]
+    return "B" + (number if number.endswith("A") else number.zfill(2))
+
+
+def is_required_file(path, bands):
+    """Return if a file of a SAFE product (path relative to the product) is needed to process the given bands."""
+    match = BAND_FILE_PATTERN.search(os.path.basename(path))
+    return match is None or normalise_band(match.group(1)) in bands
+
+
+def write_bands_file(product_path, bands):
+    with open(os.path.join(product_path, BANDS_FILENAME), "w") as f:
+        f.write("\n".join(bands))
+
+
+def is_product_available(product_path, download_request):
+    """Return if a product exists locally with all the bands the download request asks for (all bands if the request
+    has no bands)."""
+    if not os.path.exists(product_path):
+        return False
+    bands_file = os.path.join(product_path, BANDS_FILENAME)
+    if not os.path.isfile(bands_file):
+        return True
+    bands = download_request.get('bands') if download_request is not None else None
+    if bands is None:
+        return False
+    with open(bands_file, "r") as f:
+        return set(bands) <= set(f.read().split())
@@ -0,0 +1,260 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming extraction of zipped products. The members of a SAFE or SEN3 archive are unpacked from their local headers
+while the bytes arrive, so the zip is never written to disk and never read a second time. Members matching one of the
+skip patterns are not written. When the central directory at the end of the archive is reached, the names, sizes and
+CRCs of all members are checked against it.
+
+Enabled with 'streaming_extraction=True' in the DIAS section of the environment file. Members to skip are given as
+comma separated glob patterns with 'skip_members' (e.g. '*/QI_DATA/*').
+"""
+
+import os
+import shutil
+import struct
+import zlib
+from fnmatch import fnmatch
+
+# Signatures of the records of a zip archive
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+CENTRAL_DIRECTORY_SIGNATURE = 0x02014b50
+END_SIGNATURES = [0x06054b50, 0x06064b50, 0x07064b50]
+# Layout of the fixed part of a local header and of a central directory record
+LOCAL_HEADER_FORMAT = "<IHHHHHIIIHH"
+CENTRAL_DIRECTORY_FORMAT = "<IHHHHHHIIIHHHHHII"
+# Id of the extra field with the 64 bit sizes of large members
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_LIMIT = 0xFFFFFFFF
+# Compression methods which can be streamed
+STORED, DEFLATED = 0, 8
+
+
+def is_streaming_enabled(env):
+    return "streaming_extraction" in env["DIAS"] and env["DIAS"]["streaming_extraction"] == "True"
+
+
+def get_skip_patterns(env):
+    if "skip_members" not in env["DIAS"]:
+        return []
+    return list(filter(None, env["DIAS"]["skip_members"].replace(" ", "").split(",")))
+
+
+def extract_stream(chunks, product_path, skip_patterns=()):
+    """
+    Extract a zipped product from an iterable of byte chunks into the folder of the product path. The members are
+    extracted into a temporary folder which is moved into place once the archive has been checked, so interrupted
+    downloads do not leave incomplete products behind. Raises a RuntimeError if the archive cannot be streamed or is
+    corrupt.
+    """
+    out_path = os.path.dirname(product_path)
+    temp_path = os.path.join(out_path, "{}.extracting".format(os.path.basename(product_path)))
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    try:
+        extractor = StreamingZipExtractor(temp_path, skip_patterns)
+        for chunk in chunks:
+            if chunk:
+                extractor.feed(chunk)
+        extractor.close()
+        for name in os.listdir(temp_path):
+            target = os.path.join(out_path, name)
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            os.replace(os.path.join(temp_path, name), target)
+        return extractor.members
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+
+def parse_zip64_extra(extra, sizes):
+    """Replace the sizes of a header which overflow 32 bits by those of its zip64 extra field, in the order of the field
+    (uncompressed size first). Returns the sizes and whether the header has a zip64 extra field."""
+    sizes, position = list(sizes), 0
+    while position + 4 <= len(extra):
+        header_id, data_size = struct.unpack("<HH", extra[position:position + 4])
+        if header_id == ZIP64_EXTRA_ID:
+            data, offset = extra[position + 4:position + 4 + data_size], 0
+            for i, size in enumerate(sizes):
+                if size == ZIP64_LIMIT and offset + 8 <= len(data):
+                    sizes[i] = struct.unpack("<Q", data[offset:offset + 8])[0]
+                    offset += 8
+            return sizes, True
+        position += 4 + data_size
+    return sizes, False
+
+
+def decode_name(name, flags):
+    return name.decode("utf-8" if flags & 0x800 else "cp437")
+
+
+class StreamingZipExtractor(object):
+    """
+    Extracts a zip archive from bytes passed to feed(), in the order in which they are stored. close() must be called
+    after the last bytes, it checks the extracted members against the central directory. members lists the name, size
+    and CRC of all members, and whether they were skipped.
+    """
+
+    def __init__(self, out_path, skip_patterns=()):
+        self.out_path = os.path.realpath(out_path)
+        self.skip_patterns = list(skip_patterns)
+        self.buffer = bytearray()
+        self.central_directory = bytearray()
+        self.member = None
+        self.members = []
+        self.in_central_directory = False
+
+    def feed(self, data):
+        if self.in_central_directory:
+            self.central_directory += data
+            return
+        self.buffer += data
+        while not self.in_central_directory and self.step():
+            pass
+
+    def step(self):
+        """Consume as much of the buffer as possible for the current record, returns False if more bytes are needed."""
+        if self.member is None:
+            return self.read_local_header()
+        elif self.member["descriptor_pending"]:
+            return self.read_data_descriptor()
+        return self.read_member_data()
+
+    def read_local_header(self):
+        if len(self.buffer) < 4:
+            return False
+        signature = struct.unpack("<I", self.buffer[:4])[0]
+        if signature == CENTRAL_DIRECTORY_SIGNATURE or signature in END_SIGNATURES:
+            self.in_central_directory = True
+            self.central_directory += self.buffer
+            self.buffer = bytearray()
+            return False
+        if signature != LOCAL_HEADER_SIGNATURE:
+            raise RuntimeError("Corrupt zip archive, unexpected signature {:#x}.".format(signature))
+        header_size = struct.calcsize(LOCAL_HEADER_FORMAT)
+        if len(self.buffer) < header_size:
+            return False
+        _, _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length = struct.unpack(
+            LOCAL_HEADER_FORMAT, self.buffer[:header_size])
+        if len(self.buffer) < header_size + name_length + extra_length:
+            return False
+        name = decode_name(bytes(self.buffer[header_size:header_size + name_length]), flags)
+        extra = bytes(self.buffer[header_size + name_length:header_size + name_length + extra_length])
+        del self.buffer[:header_size + name_length + extra_length]
+        (size, compressed_size), zip64 = parse_zip64_extra(extra, [size, compressed_size])
+        if method not in [STORED, DEFLATED]:
+            raise RuntimeError("Cannot stream member {}, compression method {} is not supported.".format(name, method))
+        descriptor = bool(flags & 0x08)
+        if descriptor and method == STORED:
+            raise RuntimeError("Cannot stream member {}, it is stored without its size.".format(name))
+
+        skipped = any(fnmatch(name, pattern) for pattern in self.skip_patterns)
+        target = os.path.realpath(os.path.join(self.out_path, name))
+        if not target.startswith(self.out_path + os.sep):
+            raise RuntimeError("Member {} would be extracted outside of {}.".format(name, self.out_path))
+        output = None
+        if name.endswith("/"):
+            os.makedirs(target, exist_ok=True)
+        elif not skipped:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            output = open(target, "wb")
+        self.member = {"name": name, "method": method, "crc": crc, "size": size, "zip64": zip64,
+                       "descriptor": descriptor, "descriptor_pending": False, "skipped": skipped, "output": output,
+                       "remaining": None if descriptor else compressed_size, "actual_crc": 0, "actual_size": 0,
+                       "decompressor": zlib.decompressobj(-zlib.MAX_WBITS) if method == DEFLATED else None}
+        return True
+
+    def read_member_data(self):
+        member = self.member
+        if member["remaining"] is not None:
+            # the compressed size is known, skipped members are not decompressed
+            count = min(len(self.buffer), member["remaining"])
+            if count == 0 and member["remaining"] > 0:
+                return False
+            data = bytes(self.buffer[:count])
+            del self.buffer[:count]
+            member["remaining"] -= count
+            if not member["skipped"]:
+                self.write(data if member["decompressor"] is None else member["decompressor"].decompress(data))
+            if member["remaining"] == 0:
+                if not member["skipped"] and member["decompressor"] is not None:
+                    self.write(member["decompressor"].flush())
+                self.end_member_data()
+            return True
+        # the compressed size is unknown, the member ends where the deflate stream ends
+        if not self.buffer:
+            return False
+        decompressor = member["decompressor"]
+        data = decompressor.decompress(bytes(self.buffer))
+        consumed = len(self.buffer) - len(decompressor.unused_data)
+        del self.buffer[:consumed]
+        if not member["skipped"]:
+            self.write(data)
+        if decompressor.eof:
+            self.end_member_data()
+        return True
+
+    def end_member_data(self):
+        if self.member["descriptor"]:
+            self.member["descriptor_pending"] = True
+        else:
+            self.end_member()
+
+    def read_data_descriptor(self):
+        if len(self.buffer) < 4:
+            return False
+        offset = 4 if struct.unpack("<I", self.buffer[:4])[0] == DATA_DESCRIPTOR_SIGNATURE else 0
+        size_format = "<IQQ" if self.member["zip64"] else "<III"
+        if len(self.buffer) < offset + struct.calcsize(size_format):
+            return False
+        crc, _, size = struct.unpack(size_format, self.buffer[offset:offset + struct.calcsize(size_format)])
+        del self.buffer[:offset + struct.calcsize(size_format)]
+        self.member.update({"crc": crc, "size": size})
+        self.end_member()
+        return True
+
+    def write(self, data):
+        if data:
+            self.member["output"].write(data)
+            self.member["actual_crc"] = zlib.crc32(data, self.member["actual_crc"])
+            self.member["actual_size"] += len(data)
+
+    def end_member(self):
+        member, self.member = self.member, None
+        if member["output"] is not None:
+            member["output"].close()
+            if member["actual_crc"] != member["crc"] or member["actual_size"] != member["size"]:
+                raise RuntimeError("Corrupt member {}, size or CRC does not match.".format(member["name"]))
+        self.members.append({"name": member["name"], "size": member["size"], "crc": member["crc"],
+                             "skipped": member["skipped"]})
+
+    def close(self):
+        """Check that the archive is complete and that all members match the central directory."""
+        if self.member is not None and self.member["output"] is not None:
+            self.member["output"].close()
+        if not self.in_central_directory:
+            raise RuntimeError("Zip archive is truncated, the central directory is missing.")
+        members = {member["name"]: member for member in self.members}
+        directory, position = self.central_directory, 0
+        record_size = struct.calcsize(CENTRAL_DIRECTORY_FORMAT)
+        count = 0
+        while position + 4 <= len(directory) and \
+                struct.unpack("<I", directory[position:position + 4])[0] == CENTRAL_DIRECTORY_SIGNATURE:
+            if position + record_size > len(directory):
+                raise RuntimeError("Zip archive is truncated in the central directory.")
+            record = struct.unpack(CENTRAL_DIRECTORY_FORMAT, directory[position:position + record_size])
+            flags, crc, compressed_size, size = record[3], record[7], record[8], record[9]
+            name_length, extra_length, comment_length = record[10], record[11], record[12]
+            name_start = position + record_size
+            name = decode_name(bytes(directory[name_start:name_start + name_length]), flags)
+            extra = bytes(directory[name_start + name_length:name_start + name_length + extra_length])
+            size = parse_zip64_extra(extra, [size, compressed_size])[0][0]
+            if name not in members or members[name]["crc"] != crc or members[name]["size"] != size:
+                raise RuntimeError("Member {} does not match the central directory.".format(name))
+            position = name_start + name_length + extra_length + comment_length
+            count += 1
+        if count != len(self.members):
+            raise RuntimeError("Zip archive has {} members, the central directory lists {}.".format(
+                len(self.members), count))
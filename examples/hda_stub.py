@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local HTTP stub of the HDA API (data requests, data orders, their status and the download), to try the search and the
+batched downloads of HDA without network access. The status of every data order is answered with a throttling error
+(HTTP 503) and a dropped connection before it completes, and the run checks that all products are downloaded anyway.
+
+Run from the root of the repository: python examples/hda_stub.py [--products 3]
+"""
+
+import argparse
+import configparser
+import io
+import os
+import re
+import sys
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from threading import Lock, Thread
+from zipfile import ZipFile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dias_apis.hda import hda
+
+WKT = "POLYGON ((7.90 46.70, 8.10 46.70, 8.10 46.80, 7.90 46.80, 7.90 46.70))"
+# A pattern for the name of the fake products (completed with a number)
+PRODUCT_NAME = "S3A_OL_1_EFR____20230601T0{}0000_20230601T0{}0300_20230601T120000_0179_099_307_2160_MAR_O_NR_002.SEN3"
+# The answers to the status requests of every data order, in order: a status, an HTTP error or a dropped connection
+STATUS_SEQUENCE = ["running", 503, "drop", "running", "completed"]
+
+
+class HDAHandler(BaseHTTPRequestHandler):
+    """Answers the requests of the HDA API for the fake products of the server."""
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/databroker/gettoken":
+            return self.send_json({"access_token": "stub-token"})
+        if path == "/databroker/termsaccepted/Copernicus_General_License":
+            return self.send_json({"accepted": True})
+        if re.fullmatch(r"/databroker/datarequest/status/[^/]+", path):
+            return self.send_json({"status": "completed"})
+        if re.fullmatch(r"/databroker/datarequest/jobs/[^/]+/result", path):
+            return self.send_json({"content": [{"url": "stub://{}".format(name), "filename": name}
+                                               for name in self.server.products], "nextPage": None})
+        match = re.fullmatch(r"/databroker/dataorder/status/([^/]+)", path)
+        if match and match.group(1) in self.server.orders:
+            with self.server.lock:
+                order = self.server.orders[match.group(1)]
+                answer = STATUS_SEQUENCE[min(order["polls"], len(STATUS_SEQUENCE) - 1)]
+                order["polls"] += 1
+            if answer == "drop":
+                self.close_connection = True
+                return
+            if answer == 503:
+                self.send_response(503)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                return self.end_headers()
+            return self.send_json({"status": answer})
+        match = re.fullmatch(r"/databroker/dataorder/download/([^/]+)", path)
+        if match and match.group(1) in self.server.orders:
+            return self.send_body(get_product_zip(self.server.orders[match.group(1)]["name"]), "application/zip")
+        self.send_error(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/databroker/datarequest":
+            return self.send_json({"jobId": "stub-job"})
+        if self.path == "/databroker/dataorder":
+            name = re.search(r"stub://([^\"]+)", body.decode()).group(1)
+            with self.server.lock:
+                order_id = "order-{}".format(len(self.server.orders))
+                self.server.orders[order_id] = {"name": name, "polls": 0}
+            return self.send_json({"orderId": order_id})
+        self.send_error(404)
+
+    def send_json(self, content):
+        self.send_body(dumps(content).encode(), "application/json")
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_product_zip(product_name):
+    """Return a zip of a fake product folder with a manifest."""
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w") as zip_file:
+        zip_file.writestr("{}/xfdumanifest.xml".format(product_name), "<xfdu:XFDU/>")
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', help="Number of products of the stub", type=int, default=3)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HDAHandler)
+    server.products = [PRODUCT_NAME.format(i, i) for i in range(args.products)]
+    server.orders, server.lock = {}, Lock()
+    Thread(target=server.serve_forever, daemon=True).start()
+    hda.POLL_INTERVAL_MIN, hda.POLL_INTERVAL_MAX = 0.1, 0.5
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = configparser.ConfigParser()
+        env.read_dict({
+            "General": {"log": os.path.join(temp_dir, "log.txt")},
+            "DIAS": {},
+            "HDA": {"username": "stub", "password": "stub", "retry_attempts": "3",
+                    "api_endpoint": "http://{}:{}".format(*server.server_address)}
+        })
+        auth = hda.authenticate(env["HDA"])
+        download_requests, product_names = hda.get_download_requests(
+            auth, "2023-06-01T00:00:00.000Z", "2023-06-01T23:59:59.999Z", "OLCI", "300", WKT, env)
+        product_paths = [os.path.join(temp_dir, "OLCI_L1", product_name) for product_name in product_names]
+        failed = hda.do_downloads(auth, download_requests, product_paths, env)
+        server.shutdown()
+
+        assert product_names == server.products, "Unexpected products: {}".format(product_names)
+        assert not failed, "Failed downloads: {}".format(failed)
+        assert all(os.path.isfile(os.path.join(path, "xfdumanifest.xml")) for path in product_paths)
+        print("Downloaded {} products, {} status requests were answered.".format(
+            len(product_paths), sum(order["polls"] for order in server.orders.values())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local stub of a product finder for the near-real-time daemon. A publisher thread writes synthetic OLCI products of today
+into a LOCALMIRROR directory one after another, and the daemon polls the mirror like a remote API, where the
+modification time of a product is its publication time. The run checks that every published product is found and
+processed exactly once, and prints the latencies from sensing to processing.
+
+The products are empty apart from their footprint and no processors run, so no SNAP installation is needed.
+
+Run from the root of the repository: python examples/nrt_stub_finder.py [--products 3] [--interval 5]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from threading import Thread
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import format_minutes, sencast_nrt
+from utils.nrtstate import NRTState
+
+# The perimeter of the synthetic lake and the footprint of the synthetic products (around it)
+WKT = "POLYGON ((7.90 46.70, 8.10 46.70, 8.10 46.80, 7.90 46.80, 7.90 46.70))"
+FOOTPRINT = "45.0 5.0 45.0 11.0 48.0 11.0 48.0 5.0 45.0 5.0"
+# A pattern for the name of the synthetic products (completed with sensing start and end and processing time)
+PRODUCT_NAME = "S3A_OL_1_EFR____{}_{}_{}_0179_099_307_2160_MAR_O_NR_002.SEN3"
+MANIFEST = '<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1" xmlns:gml="http://www.opengis.net/gml"><gml:posList>{}' \
+           '</gml:posList></xfdu:XFDU>'
+
+ENV = """[General]
+gpt_path=/opt/snap/bin/gpt
+gpt_cache_size=1G
+params_path={root}
+wkt_path={root}
+out_path={root}/output/{{params_name}}_{{wkt_name}}_{{start}}_{{end}}
+
+[DIAS]
+l1_path={root}/input/{{sensor}}_L1/{{product_name}}
+readonly=False
+
+[LOCALMIRROR]
+root_path={root}/mirror
+latency=0.1
+
+[EARTHDATA]
+username=stub
+password=stub
+root_path={root}/earthdata
+"""
+
+PARAMS = """[General]
+remote_dias_api=LOCALMIRROR
+start=
+end=
+sensor=OLCI
+resolution=300
+wkt_name=stub
+wkt=
+processors=
+adapters=
+synchronise=true
+"""
+
+
+def publish(mirror_path, products, interval):
+    """Publish a synthetic product sensed a few minutes ago every interval seconds."""
+    for _ in range(products):
+        time.sleep(interval)
+        sensing_start = datetime.utcnow() - timedelta(minutes=10)
+        product_name = PRODUCT_NAME.format(*[t.strftime("%Y%m%dT%H%M%S") for t in [
+            sensing_start, sensing_start + timedelta(minutes=3), datetime.utcnow()]])
+        temp_path = os.path.join(mirror_path, "{}.incomplete".format(product_name))
+        os.makedirs(temp_path)
+        with open(os.path.join(temp_path, "xfdumanifest.xml"), "w") as f:
+            f.write(MANIFEST.format(FOOTPRINT))
+        os.replace(temp_path, os.path.join(mirror_path, product_name))
+        print("Published {}".format(product_name))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', help="Number of products to publish", type=int, default=3)
+    parser.add_argument('--interval', help="Seconds between two publications and two polls", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, "mirror"))
+        env_file, params_file = os.path.join(root, "stub_env.ini"), os.path.join(root, "stub.ini")
+        state_file = os.path.join(root, "nrt_state.sqlite")
+        with open(env_file, "w") as f:
+            f.write(ENV.format(root=root))
+        with open(params_file, "w") as f:
+            f.write(PARAMS)
+        with open(os.path.join(root, "stub.wkt"), "w") as f:
+            f.write(WKT)
+
+        publisher = Thread(target=publish, args=(os.path.join(root, "mirror"), args.products, args.interval))
+        publisher.start()
+        metrics = sencast_nrt([params_file], state_file, env_file=env_file, poll_interval=args.interval,
+                              max_polls=args.products + 2)
+        publisher.join()
+
+        published = set(os.listdir(os.path.join(root, "mirror")))
+        found = NRTState(state_file).get_product_names(params_file)
+        assert found == published, "Published {}, found {}".format(sorted(published), sorted(found))
+        for lake, lake_metrics in metrics.items():
+            print("{} products of {} processed, {} minutes from sensing to processing in average.".format(
+                lake_metrics["products"], lake, format_minutes(lake_metrics["total"]["mean"])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local HTTP stub of the OData file tree of COAH, serving a fake Sentinel-2 SAFE product, to try the selective download
+without network access. It downloads the product once with only some bands and checks that exactly the files of the
+other bands were skipped and that the partial product is not taken for a full one.
+
+Run from the root of the repository: python examples/selective_download_stub.py
+"""
+
+import configparser
+import os
+import re
+import sys
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from threading import Thread
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dias_apis.coah import coah
+from dias_apis.selective import is_product_available, is_required_file
+
+UUID = "00000000-0000-0000-0000-000000000000"
+PRODUCT_NAME = "S2A_MSIL1C_20230601T102601_N0509_R108_T32TLS_20230601T140705.SAFE"
+GRANULE = "GRANULE/L1C_T32TLS_A041541_20230601T103136"
+BANDS = ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12"]
+# The bands which are downloaded
+REQUIRED_BANDS = ["B02", "B03", "B04"]
+
+# The files of the fake product by their path in the product
+FILES = {
+    "manifest.safe": b"<xfdu:XFDU/>",
+    "MTD_MSIL1C.xml": b"<n1:Level-1C_User_Product/>",
+    GRANULE + "/MTD_TL.xml": b"<n1:Level-1C_Tile_ID/>",
+    GRANULE + "/IMG_DATA/T32TLS_20230601T102601_TCI.jp2": b"TCI"
+}
+for band in BANDS:
+    FILES["{}/IMG_DATA/T32TLS_20230601T102601_{}.jp2".format(GRANULE, band)] = band.encode()
+    FILES["{}/QI_DATA/MSK_DETFOO_{}.jp2".format(GRANULE, band)] = band.encode()
+
+
+class ODataHandler(BaseHTTPRequestHandler):
+    """Answers the Nodes listings and the $value downloads of the file tree of the fake product."""
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        names = re.findall(r"Nodes\('([^']*)'\)", path)
+        if not names or names[0] != PRODUCT_NAME:
+            return self.send_error(404)
+        node_path = "/".join(names[1:])
+        if path.endswith("/$value") and node_path in FILES:
+            return self.send_body(FILES[node_path], "application/octet-stream")
+        if path.endswith("/Nodes"):
+            prefix = node_path + "/" if node_path else ""
+            children = sorted(set(file[len(prefix):].split("/")[0] for file in FILES if file.startswith(prefix)))
+            if not children:
+                return self.send_error(404)
+            base = "http://{}:{}{}".format(*self.server.server_address, path[:-len("/Nodes")])
+            results = [{"Name": child, "__metadata": {"uri": "{}/Nodes('{}')".format(base, child)},
+                        "ChildrenNumber": len([file for file in FILES if file.startswith(prefix + child + "/")])}
+                       for child in children]
+            return self.send_body(dumps({"d": {"results": results}}).encode(), "application/json")
+        self.send_error(404)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ODataHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    coah.product_node_address = "http://{}:{}".format(*server.server_address) + \
+        "/odata/v1/Products('{}')/Nodes('{}')"
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = configparser.ConfigParser()
+        env.read_dict({"General": {"log": os.path.join(temp_dir, "log.txt")}, "DIAS": {}})
+        product_path = os.path.join(temp_dir, PRODUCT_NAME)
+        coah.do_download(None, {"uuid": UUID, "bands": REQUIRED_BANDS}, product_path, env)
+        server.shutdown()
+
+        downloaded = sorted(os.path.relpath(os.path.join(folder, file), product_path).replace(os.sep, "/")
+                            for folder, _, files in os.walk(product_path) for file in files)
+        expected = sorted(file for file in FILES if is_required_file(file, REQUIRED_BANDS))
+        with open(env["General"]["log"]) as f:
+            print(f.read())
+        assert [file for file in downloaded if file in FILES] == expected, "Unexpected files: {}".format(downloaded)
+        assert is_product_available(product_path, {"uuid": UUID, "bands": REQUIRED_BANDS})
+        assert not is_product_available(product_path, {"uuid": UUID, "bands": REQUIRED_BANDS + ["B08"]})
+        assert not is_product_available(product_path, {"uuid": UUID})
+        print("Downloaded {} of {} files, the partial product is recognised.".format(len(expected), len(FILES)))
+
+
+if __name__ == "__main__":
+    main()
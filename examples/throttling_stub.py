@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local throttling HTTP stub of the COAH download endpoint, to try the download scheduler without network access. The
+first request for every product is answered with HTTP 429 and a Retry-After header, the products are then served as
+zips of incompressible data. The products are downloaded through one download slot, and the run checks that the near
+real-time product is downloaded before the backfill (newest first), that every throttled request was retried and that
+the bandwidth cap of the API was kept.
+
+Run from the root of the repository: python examples/throttling_stub.py [--size 2] [--bandwidth 1]
+"""
+
+import argparse
+import configparser
+import io
+import os
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from zipfile import ZIP_STORED, ZipFile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dias_apis.coah import coah
+from dias_apis.scheduler import DownloadScheduler, get_download_priority
+
+# A pattern for the name of the fake products (completed with the sensing date)
+PRODUCT_NAME = "S3A_OL_1_EFR____{0}T100000_{0}T100300_{0}T120000_0179_099_307_2160_MAR_O_NR_002.SEN3"
+# Days before today on which the fake products are sensed, the first one is a near real-time product
+PRODUCT_DAYS = [0, 40, 10, 20]
+# Seconds the clients are asked to wait after a throttled request
+RETRY_AFTER = 1
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    """Answers the first request for every product with HTTP 429, and the following ones with the product."""
+
+    def do_GET(self):
+        match = re.fullmatch(r"/odata/v1/Products\('([^']+)'\)/\$value", self.path)
+        if match is None or match.group(1) not in self.server.products:
+            return self.send_error(404)
+        with self.server.lock:
+            requests = self.server.requests.setdefault(match.group(1), 0)
+            self.server.requests[match.group(1)] += 1
+        if requests == 0:
+            self.send_response(429)
+            self.send_header("Retry-After", str(RETRY_AFTER))
+            self.send_header("Content-Length", "0")
+            return self.end_headers()
+        body = self.server.products[match.group(1)]
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_product_zip(product_name, size):
+    """Return an uncompressed zip of a fake product folder with a measurement file of the given size in bytes."""
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w", ZIP_STORED) as zip_file:
+        zip_file.writestr("{}/xfdumanifest.xml".format(product_name), "<xfdu:XFDU/>")
+        zip_file.writestr("{}/Oa01_radiance.nc".format(product_name), os.urandom(size))
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', help="Size of every product in MB", type=float, default=2)
+    parser.add_argument('--bandwidth', help="Bandwidth cap of the API in MB/s", type=float, default=1)
+    args = parser.parse_args()
+
+    product_names = [PRODUCT_NAME.format((datetime.utcnow() - timedelta(days=days)).strftime(r"%Y%m%d"))
+                     for days in PRODUCT_DAYS]
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    server.products = {name: get_product_zip(name, int(args.size * 1e6)) for name in product_names}
+    server.requests, server.lock = {}, Lock()
+    Thread(target=server.serve_forever, daemon=True).start()
+    coah.download_address = "http://{}:{}".format(*server.server_address) + "/odata/v1/Products('{}')/$value"
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = configparser.ConfigParser()
+        env.read_dict({
+            "General": {"log": os.path.join(temp_dir, "log.txt")},
+            "DIAS": {"nrt_priority_days": "3"},
+            "COAH": {"max_bandwidth": str(args.bandwidth), "retry_attempts": "3"}
+        })
+        scheduler = DownloadScheduler(1, env)
+        started, started_lock = [], Lock()
+
+        def download(product_name):
+            product_path = os.path.join(temp_dir, "OLCI_L1", product_name)
+            with scheduler.slot("COAH", get_download_priority(env, product_path)):
+                with started_lock:
+                    started.append(product_name)
+                coah.download(None, product_name, product_path, env)
+
+        # hold the only slot until all downloads wait for it, so that they are started in the order of priority
+        scheduler.acquire("COAH")
+        threads = [Thread(target=download, args=(product_name, )) for product_name in product_names]
+        for thread in threads:
+            thread.start()
+        while len(scheduler.get_api_semaphore("COAH").waiters) < len(threads):
+            time.sleep(0.01)
+        start = time.time()
+        scheduler.release("COAH")
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        server.shutdown()
+
+        expected = [product_names[i] for i in sorted(range(len(PRODUCT_DAYS)), key=lambda i: PRODUCT_DAYS[i])]
+        assert started == expected, "Unexpected download order: {}".format(started)
+        assert all(server.requests[name] == 2 for name in product_names), "Unexpected requests: {}".format(
+            server.requests)
+        assert all(os.path.isfile(os.path.join(temp_dir, "OLCI_L1", name, "Oa01_radiance.nc"))
+                   for name in product_names)
+        total = sum(len(body) for body in server.products.values()) / 1e6
+        # the token bucket allows a burst of one second
+        assert elapsed >= (total - args.bandwidth) / args.bandwidth, "Bandwidth cap exceeded"
+        print("Downloaded {:.1f} MB in {:.1f} s ({:.2f} MB/s with a cap of {} MB/s), in the order: {}".format(
+            total, elapsed, total / elapsed, args.bandwidth, ", ".join(name[16:24] for name in started)))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,20 +5,47 @@ import time
 import shutil
 import argparse
 import importlib
+import configparser
 import traceback
-from threading import Semaphore, Thread
+from datetime import datetime, timedelta
+from threading import Event, Lock, Semaphore, Thread
 
+from dias_apis.scheduler import DownloadScheduler, get_download_priority
+from dias_apis.selective import get_required_bands, is_product_available, is_selective_download_enabled
+from presubset.presubset import is_presubset_enabled, presubset, set_presubset_region
 from utils import earthdata
-from utils.auxil import init_hindcast, log
+from utils.auxil import get_child_cpu_time, init_hindcast, load_environment, load_params, load_sweep, load_wkt, log
+from utils.execution import ExecutionBackends, config_from_dict, config_to_dict, get_execution_backend
+from utils.gptfusion import get_fusion_chain, is_gpt_fusion_enabled, run_fused_graph
+from utils.intermediate import is_intermediate, log_io_report
 from utils.product_fun import filter_for_timeliness, get_satellite_name_from_product_name, \
-    get_sensing_date_from_product_name, get_l1product_path, filter_for_tiles, filter_for_baseline
+    get_sensing_date_from_product_name, get_l1product_path, filter_for_tiles, filter_for_baseline, \
+    read_product_metadata
+from utils.nrtstate import NRTState
+from utils.planner import is_preflight_enabled, plan_resources
+from utils.searchrecord import SEARCH_MODES, get_search_mode, record_search, replay_search
+from utils.provenance import get_provenance, invalidate_changed_output, is_provenance_enabled, write_provenance
+from utils.taskqueue import HEARTBEAT_INTERVAL, TaskQueue, get_worker_name
+from utils.timeseries import append_products, is_timeseries_enabled
 
 global summary
 summary = []
+# Guards the removal of entries from the summary, entries are appended without it
+summary_lock = Lock()
+download_locks, download_locks_lock = {}, Lock()
+
+# Seconds a worker waits before polling the task queue again
+WORKER_POLL_INTERVAL = 60
+# Seconds between two polls of the near-real-time daemon
+NRT_POLL_INTERVAL = 600
+# Seconds by which incremental searches of the near-real-time daemon overlap, to cover delays of the search index
+NRT_POLL_OVERLAP = 3600
+# Number of times the near-real-time daemon processes a product group before it gives up on it
+NRT_MAX_ATTEMPTS = 3
 
 
 def sencast(params_file, env_file=None, max_parallel_downloads=1, max_parallel_processors=1,
-            max_parallel_adapters=1):
+            max_parallel_adapters=1, search=None):
     """
     File-based interface for Sencast.
 
@@ -29,7 +56,8 @@ def sencast(params_file, env_file=None, max_parallel_downloads=1, max_parallel_p
         File to read the parameters for this run from
     env_file
         | **Default: None**
-        | Environment settings read from the environment .ini file, if None provided Sencast will search for file in environments folder.
+        | Environment settings read from the environment .ini file, if None provided Sencast will search for file in
+        | environments folder.
     max_parallel_downloads
         | **Default: 1**
         | Maximum number of parallel downloads of satellite images
@@ -39,16 +67,423 @@ def sencast(params_file, env_file=None, max_parallel_downloads=1, max_parallel_p
     max_parallel_adapters
         | **Default: 1**
         | Maximum number of adapters to run in parallel
+    search
+        | **Default: None**
+        | Search mode (live, record or replay) overriding the one of the parameters file, see utils/searchrecord.py
     """
     l2product_files = {}
     env, params, l2_path = init_hindcast(env_file, params_file)
+    if search is not None:
+        params['General']['search'] = search
     sencast_thread(env, params, l2_path, l2product_files, max_parallel_downloads, max_parallel_processors,
                    max_parallel_adapters)
     return l2product_files
 
 
+def sencast_sweep(sweep_file, env_file=None, max_parallel_downloads=1, max_parallel_processors=1,
+                  max_parallel_adapters=1):
+    """
+    Sweep interface for Sencast. Runs a parameter file for every combination of perimeters and periods listed in a
+    sweep file. The runs are executed concurrently within the given limits, and products needed by several runs are
+    downloaded only once.
+
+    Parameters
+    ------------
+
+    sweep_file
+        File to read the sweep from
+    env_file
+        | **Default: None**
+        | Environment settings read from the environment .ini file, if None provided Sencast will search for file in
+        | environments folder.
+    max_parallel_downloads
+        | **Default: 1**
+        | Maximum number of parallel downloads of satellite images over all runs
+    max_parallel_processors
+        | **Default: 1**
+        | Maximum number of processors to run in parallel over all runs
+    max_parallel_adapters
+        | **Default: 1**
+        | Maximum number of adapters to run in parallel over all runs
+    """
+    env, _, _ = load_environment(env_file)
+    params_file, combinations = load_sweep(sweep_file, env['General']['params_path'])
+    semaphores = {
+        'download': DownloadScheduler(max_parallel_downloads, env),
+        'process': Semaphore(max_parallel_processors),
+        'adapt': Semaphore(max_parallel_adapters)
+    }
+    backends = ExecutionBackends(max_parallel_processors)
+    runs = [init_hindcast(env_file, params_file, params) for params in combinations]
+
+    # all runs share the pre-subsets of the bounding box around all their perimeters
+    set_presubset_region([params_run for _, params_run, _ in runs])
+
+    l2product_files, errors, sweep_threads = {}, {}, []
+    for env_run, params_run, l2_path in runs:
+        l2product_files[l2_path] = {}
+        args = (env_run, params_run, l2_path, l2product_files[l2_path], semaphores, backends, errors)
+        sweep_threads.append(Thread(target=sencast_sweep_thread, args=args, name="Sweep-{}".format(
+            os.path.basename(l2_path))))
+        sweep_threads[-1].start()
+    for sweep_thread in sweep_threads:
+        sweep_thread.join()
+    backends.shutdown()
+
+    if len(errors) > 0:
+        raise RuntimeError("Sencast failed for {}/{} runs: {}".format(
+            len(errors), len(combinations), ", ".join(sorted(errors.keys()))))
+    return l2product_files
+
+
+def sencast_sweep_thread(env, params, l2_path, l2product_files, semaphores, backends, errors):
+    """Run one combination of a sweep and record its error, if it fails."""
+    try:
+        sencast_thread(env, params, l2_path, l2product_files, semaphores=semaphores, backends=backends)
+    except (Exception,) as e:
+        log(env["General"]["log"], "Sencast failed for {}: {}".format(l2_path, e))
+        errors[l2_path] = str(e)
+
+
+def sencast_nrt(params_files, state_file, env_file=None, max_parallel_downloads=1, max_parallel_processors=1,
+                max_parallel_adapters=1, poll_interval=NRT_POLL_INTERVAL, lookback_days=1, max_polls=None):
+    """
+    Near-real-time daemon for Sencast. Polls the remote dias api of every parameter file (one per lake) for products
+    published since the last poll, and processes the product groups with new products as soon as they appear. The
+    poll times and the products seen are kept in a local state file, together with the latencies from sensing to
+    processing per lake. Product groups which failed are processed again on the next polls, up to NRT_MAX_ATTEMPTS
+    times, and groups which a stopped daemon left scheduled are processed after a restart.
+
+    Parameters
+    ------------
+
+    params_files
+        List of files to read the parameters for each lake from, their period is replaced by the last days
+    state_file
+        SQLite file to keep the state of the daemon in
+    env_file
+        | **Default: None**
+        | Environment settings read from the environment .ini file, if None provided Sencast will search for file in
+        | environments folder.
+    max_parallel_downloads
+        | **Default: 1**
+        | Maximum number of parallel downloads of satellite images
+    max_parallel_processors
+        | **Default: 1**
+        | Maximum number of processors to run in parallel
+    max_parallel_adapters
+        | **Default: 1**
+        | Maximum number of adapters to run in parallel
+    poll_interval
+        | **Default: 600**
+        | Seconds between two polls
+    lookback_days
+        | **Default: 1**
+        | Number of days, including today, for which products are searched
+    max_polls
+        | **Default: None**
+        | Stop after this number of polls and wait for the scheduled product groups, if None the daemon runs forever
+    """
+    env, _, _ = load_environment(env_file)
+    env["General"]["log"] = os.path.join(os.path.dirname(os.path.abspath(state_file)), "nrt_log_{}.txt".format(
+        datetime.now().strftime("%Y%m%dT%H%M%S")))
+    state = NRTState(state_file)
+    semaphores = {
+        'download': DownloadScheduler(max_parallel_downloads, env),
+        'process': Semaphore(max_parallel_processors),
+        'adapt': Semaphore(max_parallel_adapters)
+    }
+    backends, runs, auths, group_threads, deferred = ExecutionBackends(max_parallel_processors), {}, {}, {}, set()
+    earthdata.authenticate(env)
+
+    # the runs of all lakes share the pre-subsets of the bounding box around all their perimeters
+    presubset_wkt = set_presubset_region([load_lake_params(env, params_file) for params_file in params_files])
+    polls = 0
+    try:
+        while max_polls is None or polls < max_polls:
+            poll_start = time.time()
+            for params_file in params_files:
+                try:
+                    poll_lake(env, env_file, params_file, state, semaphores, backends, runs, auths, group_threads,
+                              deferred, lookback_days, presubset_wkt)
+                except (Exception,):
+                    log(env["General"]["log"], "Polling failed for {}.".format(params_file))
+                    log(env["General"]["log"], traceback.format_exc(), indent=1)
+            polls += 1
+            for lake, metrics in sorted(state.get_latency_metrics().items()):
+                log(env["General"]["log"], "Latency of {} over {} products: {} minutes in average, {} at most."
+                    .format(lake, metrics["products"], format_minutes(metrics["total"]["mean"]),
+                            format_minutes(metrics["total"]["max"])))
+            if max_polls is None or polls < max_polls:
+                time.sleep(max(0, poll_interval - (time.time() - poll_start)))
+        for group_thread in group_threads.values():
+            group_thread.join()
+    finally:
+        backends.shutdown()
+    return state.get_latency_metrics()
+
+
+def load_lake_params(env, params_file):
+    """Load the params of a lake of the near-real-time daemon, with its wkt."""
+    params, _ = load_params(params_file, env['General']['params_path'])
+    if not params['General']['wkt']:
+        params['General']['wkt'], _ = load_wkt("{}.wkt".format(params['General']['wkt_name']),
+                                               env['General']['wkt_path'])
+    return params
+
+
+def poll_lake(env, env_file, params_file, state, semaphores, backends, runs, auths, group_threads, deferred,
+              lookback_days, presubset_wkt=None):
+    """Search the products of a lake which were published since its last poll and schedule their product groups."""
+    params = load_lake_params(env, params_file)
+    lake, api = params_file, params['General']['remote_dias_api']
+    api_module = importlib.import_module("dias_apis.{}.{}".format(api.lower(), api.lower()))
+    if api not in auths:
+        auths[api] = api_module.authenticate(env[api])
+
+    poll_start, last_poll = time.time(), state.get_last_poll(lake)
+    today = datetime.utcnow().date()
+    start = "{}T00:00:00.000Z".format((today - timedelta(days=lookback_days - 1)).isoformat())
+    end = "{}T23:59:59.999Z".format(today.isoformat())
+    sensor, resolution, wkt = params['General']['sensor'], params['General']['resolution'], params['General']['wkt']
+    if last_poll is not None and hasattr(api_module, "get_updated_files"):
+        published_after = datetime.utcfromtimestamp(last_poll - NRT_POLL_OVERLAP).strftime("%Y-%m-%dT%H:%M:%SZ")
+        download_requests, product_names = api_module.get_updated_files(auths[api], start, end, sensor, resolution,
+                                                                        wkt, published_after, env)
+    else:
+        download_requests, product_names = api_module.get_download_requests(auths[api], start, end, sensor,
+                                                                            resolution, wkt, env)
+    state.set_last_poll(lake, poll_start)
+
+    # register new products and find the product groups which need to be (re)processed
+    known_product_names = state.get_product_names(lake)
+    download_groups, l1product_path_groups = group_products(env, params, download_requests, product_names)
+    for group in download_groups.keys():
+        for download_request, l1product_path in zip(download_groups[group], l1product_path_groups[group]):
+            if os.path.basename(l1product_path) not in known_product_names:
+                state.add_product(lake, os.path.basename(l1product_path), download_request, group)
+                deferred.add((lake, group))
+    # retry the groups which failed, and the groups which a stopped daemon left scheduled
+    for group in state.get_pending_groups(lake, NRT_MAX_ATTEMPTS):
+        if not ((lake, group) in group_threads and group_threads[(lake, group)].is_alive()):
+            deferred.add((lake, group))
+    log(env["General"]["log"], "Polled {}: {} products found, {} product group(s) to process.".format(
+        lake, len(product_names), len([key for key in deferred if key[0] == lake])))
+
+    for key in sorted(deferred):
+        if key[0] != lake or (key in group_threads and group_threads[key].is_alive()):
+            continue
+        deferred.remove(key)
+        group = key[1]
+        day = get_group_day(group)
+        if (lake, day) not in runs:
+            params_day = configparser.ConfigParser()
+            params_day.read_dict({section: dict(params.items(section, raw=True)) for section in params.sections()})
+            params_day['General']['start'] = "{}T00:00:00.000Z".format(day)
+            params_day['General']['end'] = "{}T23:59:59.999Z".format(day)
+            runs[(lake, day)] = init_hindcast(env_file, params_file, params_day)
+            if presubset_wkt is not None:
+                set_presubset_region([runs[(lake, day)][1]], presubset_wkt)
+        env_run, params_run, l2_path = runs[(lake, day)]
+        group_download_requests, group_product_names = state.get_group_products(lake, group)
+        l1product_paths = [get_l1product_path(env_run, product_name) for product_name in group_product_names]
+        args = (env_run, params_run, api_module.do_download, auths[api], group_download_requests, l1product_paths,
+                l2_path, semaphores, group, backends, state, lake)
+        group_threads[key] = Thread(target=sencast_nrt_group, args=args, name="NRT-{}-{}".format(lake, group))
+        group_threads[key].start()
+
+    # forget the finished threads, and the runs of the days before the search period once all their groups finished
+    for key in [key for key, group_thread in group_threads.items() if key[0] == lake and not group_thread.is_alive()]:
+        del group_threads[key]
+    busy_days = set(get_group_day(key[1]) for key in deferred | set(group_threads.keys()) if key[0] == lake)
+    for run_lake, day in list(runs.keys()):
+        if run_lake == lake and day < start[:10] and day not in busy_days:
+            prune_summary(runs[(lake, day)][2])
+            del runs[(lake, day)]
+
+
+def get_group_day(group):
+    return datetime.strptime(get_sensing_date_from_product_name(group), r"%Y%m%d").date().isoformat()
+
+
+def prune_summary(l2_path, group=None):
+    """Remove the entries of a run, or of a product group of a run, from the summary."""
+    with summary_lock:
+        for i in reversed(range(len(summary))):
+            if summary[i]["l2_path"] == l2_path and (group is None or summary[i]["group"] == group):
+                del summary[i]
+
+
+def sencast_nrt_group(env, params, do_download, auth, download_requests, l1product_paths, l2_path, semaphores, group,
+                      backends, state, lake):
+    """Process a product group of the near-real-time daemon and record the outcome in its state."""
+    # forget the outcome of an earlier attempt of the group
+    prune_summary(l2_path, group)
+    try:
+        sencast_product_group(env, params, do_download, auth, download_requests, l1product_paths, l2_path, {},
+                              semaphores, group, backends)
+        succeeded = all(s["succeeded"] for s in list(summary) if s["l2_path"] == l2_path and s["group"] == group)
+    except (Exception,):
+        log(env["General"]["log"], "Processing of product group {} failed.".format(group))
+        log(env["General"]["log"], traceback.format_exc(), indent=1)
+        succeeded = False
+    state.set_products_status(lake, [os.path.basename(path) for path in l1product_paths],
+                              "done" if succeeded else "failed")
+
+
+def format_minutes(minutes):
+    return "n/a" if minutes is None else "{:.1f}".format(minutes)
+
+
+def sencast_coordinate(params_files, queue_file, env_file=None, sweep_file=None):
+    """
+    Coordinator of distributed Sencast runs. Searches the products of each parameter file, and of every combination
+    of perimeter and period of a sweep file, and adds one task per product group to a task queue, which is processed by
+    workers started with sencast_worker on any number of nodes. Tasks which are already in the queue are not added
+    again.
+
+    Parameters
+    ------------
+
+    params_files
+        List of files to read the parameters for the runs from
+    queue_file
+        SQLite file of the task queue, on a filesystem shared by the coordinator and all workers
+    env_file
+        | **Default: None**
+        | Environment settings read from the environment .ini file, if None provided Sencast will search for file in
+        | environments folder.
+    sweep_file
+        | **Default: None**
+        | File to read a sweep from, whose runs are added to the runs of the parameter files
+    """
+    queue = TaskQueue(queue_file)
+    runs = [init_hindcast(env_file, params_file) for params_file in params_files]
+    if sweep_file is not None:
+        env, _, _ = load_environment(env_file)
+        params_file, combinations = load_sweep(sweep_file, env['General']['params_path'])
+        runs += [init_hindcast(env_file, params_file, params) for params in combinations]
+    # the tasks of all runs share the pre-subsets of the bounding box around all their perimeters
+    set_presubset_region([params for _, params, _ in runs])
+    for env, params, l2_path in runs:
+        authenticate, get_download_requests, _ = get_dias_api(params)
+        auth = authenticate(env[params['General']['remote_dias_api']])
+        download_groups, l1product_path_groups = get_product_groups(env, params, auth, get_download_requests, l2_path)
+        added = 0
+        for group in sorted(download_groups.keys()):
+            task = {
+                'params': config_to_dict(params),
+                'l2_path': l2_path,
+                'group': group,
+                'download_requests': download_groups[group],
+                'product_names': [os.path.basename(l1product_path) for l1product_path in l1product_path_groups[group]]
+            }
+            if queue.add("{}:{}".format(l2_path, group), task):
+                added += 1
+        log(env["General"]["log"], "Added {} of {} product group(s) to the task queue {}.".format(
+            added, len(download_groups), queue_file))
+    return queue.counts()
+
+
+def sencast_worker(queue_file, env_file=None, max_parallel_downloads=1, max_parallel_processors=1,
+                   max_parallel_adapters=1, exit_when_empty=True):
+    """
+    Worker of distributed Sencast runs. Claims product group tasks from the task queue and processes them one after
+    the other, while sending heartbeats. Tasks of workers which stopped sending heartbeats are processed again.
+
+    Parameters
+    ------------
+
+    queue_file
+        SQLite file of the task queue, on a filesystem shared by the coordinator and all workers
+    env_file
+        | **Default: None**
+        | Environment settings read from the environment .ini file, if None provided Sencast will search for file in
+        | environments folder.
+    max_parallel_downloads
+        | **Default: 1**
+        | Maximum number of parallel downloads of satellite images
+    max_parallel_processors
+        | **Default: 1**
+        | Maximum number of processors to run in parallel
+    max_parallel_adapters
+        | **Default: 1**
+        | Maximum number of adapters to run in parallel
+    exit_when_empty
+        | **Default: True**
+        | Stop when no task is pending or running anymore, otherwise keep polling the queue for new tasks
+    """
+    env, _, _ = load_environment(env_file)
+    queue, worker = TaskQueue(queue_file), get_worker_name()
+    semaphores = {
+        'download': DownloadScheduler(max_parallel_downloads, env),
+        'process': Semaphore(max_parallel_processors),
+        'adapt': Semaphore(max_parallel_adapters)
+    }
+    backends, auths = ExecutionBackends(max_parallel_processors), {}
+    try:
+        while True:
+            task = queue.claim(worker)
+            if task is None:
+                if exit_when_empty and queue.counts()['running'] == 0:
+                    break
+                time.sleep(WORKER_POLL_INTERVAL)
+                continue
+            task_id, key, payload = task
+            params, l2_path, group = config_from_dict(payload['params']), payload['l2_path'], payload['group']
+            env["General"]["log"] = os.path.join(l2_path, "Logs", "{}_{}_log.txt".format(group, worker))
+            os.makedirs(os.path.dirname(env["General"]["log"]), exist_ok=True)
+            log(env["General"]["log"], "Worker {} claimed task {}.".format(worker, key))
+
+            stop_heartbeat, reclaimed = Event(), Event()
+            heartbeat_thread = Thread(target=send_heartbeats, args=(env, queue, task_id, worker, stop_heartbeat,
+                                                                    reclaimed),
+                                      name="Heartbeat-{}".format(group), daemon=True)
+            heartbeat_thread.start()
+            summary_start = len(summary)
+            try:
+                api = params['General']['remote_dias_api']
+                authenticate, _, do_download = get_dias_api(params)
+                if api not in auths:
+                    auths[api] = authenticate(env[api])
+                    earthdata.authenticate(env)
+                l1product_paths = [get_l1product_path(env, product_name) for product_name in payload['product_names']]
+                sencast_product_group(env, params, do_download, auths[api], payload['download_requests'],
+                                      l1product_paths, l2_path, {}, semaphores, group, backends, reclaimed)
+                if reclaimed.is_set():
+                    log(env["General"]["log"], "Worker {} aborted task {}, it has been reclaimed.".format(worker, key))
+                    continue
+                failed = ["{} {}".format(s["type"], s["name"]) for s in summary[summary_start:] if not s["succeeded"]]
+                queue.complete(task_id, worker, not failed, ", ".join(failed) or None)
+                log(env["General"]["log"], "Worker {} finished task {}.".format(worker, key))
+            except (Exception,):
+                if reclaimed.is_set():
+                    log(env["General"]["log"], "Worker {} aborted task {}, it has been reclaimed.".format(worker, key))
+                    continue
+                log(env["General"]["log"], "Worker {} failed on task {}.".format(worker, key))
+                log(env["General"]["log"], traceback.format_exc(), indent=1)
+                queue.complete(task_id, worker, False, traceback.format_exc())
+            finally:
+                stop_heartbeat.set()
+                heartbeat_thread.join()
+    finally:
+        backends.shutdown()
+    return queue.counts()
+
+
+def send_heartbeats(env, queue, task_id, worker, stop, reclaimed):
+    """Send heartbeats for a task until stop is set. Sets reclaimed if the task has been handed to another worker, so
+    that this worker aborts it."""
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        if not queue.heartbeat(task_id, worker):
+            log(env["General"]["log"], "Task {} has been reclaimed from worker {}, aborting it.".format(
+                task_id, worker))
+            reclaimed.set()
+            return
+
+
 def sencast_thread(env, params, l2_path, l2product_files, max_parallel_downloads=1, max_parallel_processors=1,
-                   max_parallel_adapters=1):
+                   max_parallel_adapters=1, semaphores=None, backends=None):
     """
     Threading function for running Sencast.
     1. Calls API to find available data for given query
@@ -75,27 +510,179 @@ def sencast_thread(env, params, l2_path, l2product_files, max_parallel_downloads
     max_parallel_adapters
         | **Default: 1**
         | Maximum number of adapters to run in parallel
+    semaphores
+        | **Default: None**
+        | Dictionary of semaphore objects shared with other runs, if None they are created from the limits above
+    backends
+        | **Default: None**
+        | ExecutionBackends shared with other runs, if None they are created and shut down by this run
     """
 
-    # dynamically import the remote dias api to use
+    # dynamically import the remote dias api to use and create authentication to it
+    authenticate, get_download_requests, do_download = get_dias_api(params)
+    auth = authenticate(env[params['General']['remote_dias_api']])
+
+    # find products which match the criterias from params and group them
+    download_groups, l1product_path_groups = get_product_groups(env, params, auth, get_download_requests, l2_path)
+
+    # check the disk space and fit the parallelism and the gpt cache size into the available resources
+    if is_preflight_enabled(env):
+        planned_downloads, planned_processors, planned_adapters, gpt_cache_size = plan_resources(
+            env, params, download_groups, l1product_path_groups, l2_path, max_parallel_downloads,
+            max_parallel_processors, max_parallel_adapters)
+        # the planned cache size applies to this run only, the environment may be shared with other runs
+        env_run = configparser.ConfigParser()
+        env_run.read_dict({section: dict(env.items(section, raw=True)) for section in env.sections()})
+        env_run['General']['gpt_cache_size'] = gpt_cache_size
+        env = env_run
+        if semaphores is None:
+            max_parallel_downloads, max_parallel_processors, max_parallel_adapters = \
+                planned_downloads, planned_processors, planned_adapters
+    if semaphores is None:
+        semaphores = {
+            'download': DownloadScheduler(max_parallel_downloads, env),
+            'process': Semaphore(max_parallel_processors),
+            'adapt': Semaphore(max_parallel_adapters)
+        }
+    log(env["General"]["log"], "Each group is handled by an individual thread.")
+
+    # order all products of the search at once, if the api supports it
+    do_downloads = get_dias_bulk_download(params)
+    if do_downloads is not None and env['DIAS']['readonly'] != "True":
+        prefetch_products(env, params, do_downloads, auth, download_groups, l1product_path_groups, semaphores)
+
+    # authenticate to earthdata api for anchillary data download anchillary data (used by some processors)
+    earthdata.authenticate(env)
+
+    # do hindcast for every product group
+    shared_backends = backends is not None
+    if not shared_backends:
+        backends = ExecutionBackends(max_parallel_processors)
+    hindcast_threads = []
+    for group, _ in sorted(sorted(download_groups.items()), key=lambda item: len(item[1])):
+        args = (
+            env, params, do_download, auth, download_groups[group], l1product_path_groups[group], l2_path,
+            l2product_files,
+            semaphores, group, backends)
+        hindcast_threads.append(Thread(target=sencast_product_group, args=args, name="Thread-{}".format(group)))
+        hindcast_threads[-1].start()
+
+    # wait for all hindcast threads to terminate
+    starttime = time.time()
+    for hindcast_thread in hindcast_threads:
+        hindcast_thread.join()
+    if not shared_backends:
+        backends.shutdown()
+
+    log(env["General"]["log"], "Hindcast complete in {0:.1f} seconds.".format(time.time() - starttime))
+    log_cpu_times(env, l2_path)
+    log_io_report(env, l2_path)
+
+    # composite the outputs of all product groups over time
+    if params.has_section("COMPOSITE"):
+        composite_products(env, params, l2_path, l2product_files)
+
+    run_summary = [s for s in summary if s["l2_path"] == l2_path]
+    failed = []
+    for s in run_summary:
+        if not s["succeeded"]:
+            failed.append("{} {} {}".format(s["group"], s["type"], s["name"]))
+    if len(failed) > 0:
+        raise RuntimeError("Sencast failed for {}/{} processes. The following processes failed: {}"
+                           .format(len(failed), len(run_summary), ", ".join(failed)))
+
+
+def get_dias_api(params):
+    """Dynamically import the remote dias api of the params and return its authenticate, get_download_requests and
+    do_download functions."""
     api = params['General']['remote_dias_api']
-    authenticate = getattr(importlib.import_module("dias_apis.{}.{}".format(api.lower(), api.lower())), "authenticate")
-    get_download_requests = getattr(importlib.import_module("dias_apis.{}.{}".format(api.lower(), api.lower())),
-                                    "get_download_requests")
-    do_download = getattr(importlib.import_module("dias_apis.{}.{}".format(api.lower(), api.lower())), "do_download")
+    api_module = importlib.import_module("dias_apis.{}.{}".format(api.lower(), api.lower()))
+    return getattr(api_module, "authenticate"), getattr(api_module, "get_download_requests"), \
+        getattr(api_module, "do_download")
+
+
+def get_dias_bulk_download(params):
+    """Return the do_downloads function of the remote dias api of the params, or None if it has none."""
+    api = params['General']['remote_dias_api']
+    api_module = importlib.import_module("dias_apis.{}.{}".format(api.lower(), api.lower()))
+    return getattr(api_module, "do_downloads", None)
+
+
+def prefetch_products(env, params, do_downloads, auth, download_groups, l1product_path_groups, semaphores):
+    """
+    Download all missing products of a run with one call to the do_downloads function of the api, in a background
+    thread. The download locks of these products are held until each product is finished, so the product groups wait
+    for their products and download them on their own only if the bulk download failed.
+    """
+    download_requests, l1product_paths = [], []
+    for group in sorted(download_groups.keys()):
+        for download_request, l1product_path in zip(download_groups[group], l1product_path_groups[group]):
+            if l1product_path in l1product_paths or is_product_available(l1product_path, download_request):
+                continue
+            if get_download_lock(l1product_path).acquire(blocking=False):
+                if os.path.isdir(l1product_path):
+                    log(env["General"]["log"], "Replacing partial product which lacks bands: " + l1product_path)
+                    shutil.rmtree(l1product_path)
+                download_requests.append(download_request)
+                l1product_paths.append(l1product_path)
+    if not l1product_paths:
+        return
+
+    pending, pending_lock = set(l1product_paths), Lock()
+
+    def on_complete(l1product_path, error):
+        if error is not None:
+            log(env["General"]["log"], "Bulk download of {} failed: {}".format(l1product_path, error))
+        with pending_lock:
+            if l1product_path not in pending:
+                return
+            pending.remove(l1product_path)
+        get_download_lock(l1product_path).release()
+
+    def run():
+        try:
+            api = params['General']['remote_dias_api']
+            slot = semaphores['download'].slot(api, min(get_download_priority(env, path) for path in l1product_paths))
+            do_downloads(auth, download_requests, l1product_paths, env, semaphore=slot,
+                         on_complete=on_complete)
+        except (Exception, ):
+            log(env["General"]["log"], "Bulk download failed.")
+            log(env["General"]["log"], traceback.format_exc(), indent=1)
+        finally:
+            for l1product_path in list(pending):
+                on_complete(l1product_path, None)
+
+    log(env["General"]["log"], "Ordering {} products at once.".format(len(l1product_paths)))
+    Thread(target=run, name="Thread-bulk-download").start()
 
-    # create authentication to remote dias api
-    auth = authenticate(env[api])
 
-    # find products which match the criterias from params
+def get_product_groups(env, params, auth, get_download_requests, l2_path=None):
+    """
+    Find the products which match the criterias from params, filter them and group them by satellite and date.
+    Returns the download requests and the l1 product paths of each group. Searches are recorded to or replayed from
+    the output folder if set in the params.
+    """
+    search_mode = get_search_mode(params) if l2_path is not None else "live"
+    if search_mode == "replay":
+        download_requests, product_names = replay_search(env, params, l2_path)
+        return group_products(env, params, download_requests, product_names)
+
+    api = params['General']['remote_dias_api']
     start, end = params['General']['start'], params['General']['end']
     sensor, resolution, wkt = params['General']['sensor'], params['General']['resolution'], params['General']['wkt']
     try:
         download_requests, product_names = get_download_requests(auth, start, end, sensor, resolution, wkt, env)
     except:
         raise ValueError("Unable to access {} API, please check your internet conectivity or try using an alternative API".format(api))
+    if search_mode == "record":
+        record_search(env, params, l2_path, download_requests, product_names)
+    return group_products(env, params, download_requests, product_names)
 
 
+def group_products(env, params, download_requests, product_names):
+    """Filter found products and group them by satellite and date."""
+    sensor = params['General']['sensor']
+
     # filter for timeliness
     download_requests, product_names = filter_for_timeliness(download_requests, product_names, env)
 
@@ -107,19 +694,23 @@ def sencast_thread(env, params, l2_path, l2product_files, max_parallel_downloads
     # filter for baseline
     download_requests, product_names = filter_for_baseline(download_requests, product_names, sensor, env)
 
+    # request only the files of the bands which are needed, from apis which support it
+    if is_selective_download_enabled(params):
+        bands = get_required_bands(params)
+        if bands is None:
+            log(env["General"]["log"], "Not all processors declare their bands, downloading whole products.")
+        else:
+            log(env["General"]["log"], "Downloading only bands {} where supported.".format(", ".join(bands)))
+            download_requests = [dict(download_request, bands=bands) for download_request in download_requests]
+
     # set up inputs for product hindcast
     l1product_paths = [get_l1product_path(env, product_name) for product_name in product_names]
-    semaphores = {
-        'download': Semaphore(max_parallel_downloads),
-        'process': Semaphore(max_parallel_processors),
-        'adapt': Semaphore(max_parallel_adapters)
-    }
 
     # for readonly local dias, remove unavailable products and their download_requests
     if env['DIAS']['readonly'] == "True":
         log(env["General"]["log"], "{} products have been found.".format(len(l1product_paths)))
         for i in range(len(l1product_paths)):
-            if not os.path.exists(l1product_paths[i]):
+            if not is_product_available(l1product_paths[i], download_requests[i]):
                 download_requests[i], l1product_paths[i] = None, None
         l1product_paths = list(filter(None, l1product_paths))
         download_requests = list(filter(None, download_requests))
@@ -127,7 +718,8 @@ def sencast_thread(env, params, l2_path, l2product_files, max_parallel_downloads
         log(env["General"]["log"],
             "Products which are available will not be downloaded because the local DIAS is set to 'readonly'.")
     else:
-        actual_downloads = len([0 for l1product_path in l1product_paths if not os.path.exists(l1product_path)])
+        actual_downloads = len([0 for download_request, l1product_path in zip(download_requests, l1product_paths)
+                                if not is_product_available(l1product_path, download_request)])
         log(env["General"]["log"],
             "{} products are already locally available.".format(len(l1product_paths) - actual_downloads))
         log(env["General"]["log"], "{} products must be downloaded first.".format(actual_downloads))
@@ -145,39 +737,11 @@ def sencast_thread(env, params, l2_path, l2product_files, max_parallel_downloads
 
     # print information about grouped products
     log(env["General"]["log"], "The products have been grouped into {} group(s).".format(len(l1product_path_groups)))
-    log(env["General"]["log"], "Each group is handled by an individual thread.")
-
-    # authenticate to earthdata api for anchillary data download anchillary data (used by some processors)
-    earthdata.authenticate(env)
-
-    # do hindcast for every product group
-    hindcast_threads = []
-    for group, _ in sorted(sorted(download_groups.items()), key=lambda item: len(item[1])):
-        args = (
-            env, params, do_download, auth, download_groups[group], l1product_path_groups[group], l2_path,
-            l2product_files,
-            semaphores, group)
-        hindcast_threads.append(Thread(target=sencast_product_group, args=args, name="Thread-{}".format(group)))
-        hindcast_threads[-1].start()
-
-    # wait for all hindcast threads to terminate
-    starttime = time.time()
-    for hindcast_thread in hindcast_threads:
-        hindcast_thread.join()
-
-    log(env["General"]["log"], "Hindcast complete in {0:.1f} seconds.".format(time.time() - starttime))
-
-    failed = []
-    for s in summary:
-        if not s["succeeded"]:
-            failed.append("{} {} {}".format(s["group"], s["type"], s["name"]))
-    if len(failed) > 0:
-        raise RuntimeError("Sencast failed for {}/{} processes. The following processes failed: {}"
-                           .format(len(failed), len(summary), ", ".join(failed)))
+    return download_groups, l1product_path_groups
 
 
 def sencast_product_group(env, params, do_download, auth, download_requests, l1product_paths, l2_path,
-                          l2product_files_outer, semaphores, group):
+                          l2product_files_outer, semaphores, group, backends=None, abort=None):
     """
     Run Sencast for given thread.
     1. Downloads required products
@@ -207,56 +771,125 @@ def sencast_product_group(env, params, do_download, auth, download_requests, l1p
         Dictionary of semaphore objects
     group
         Thread group name
+    backends
+        | **Default: None**
+        | ExecutionBackends to run the processors on, if None all processors run inline
+    abort
+        | **Default: None**
+        | Event which aborts the product group between two downloads, processors or adapters when it is set
     """
-    # download the products, which are not yet available locally
+    if backends is None:
+        backends = ExecutionBackends()
+
+    # download the products, which are not yet available locally, once for all runs which need them
     for download_request, l1product_path in zip(download_requests, l1product_paths):
-        if not os.path.exists(l1product_path):
-            with semaphores['download']:
-                log(env["General"]["log"], "Downloading file: " + l1product_path)
-                do_download(auth, download_request, l1product_path, env)
+        check_abort(abort, group)
+        with get_download_lock(l1product_path):
+            if not is_product_available(l1product_path, download_request):
+                if os.path.isdir(l1product_path):
+                    log(env["General"]["log"], "Replacing partial product which lacks bands: " + l1product_path)
+                    shutil.rmtree(l1product_path)
+                api = params['General']['remote_dias_api']
+                with semaphores['download'].slot(api, get_download_priority(env, l1product_path)):
+                    log(env["General"]["log"], "Downloading file: " + l1product_path)
+                    do_download(auth, download_request, l1product_path, env)
 
     # ensure all products have been downloaded
-    for l1product_path in l1product_paths:
-        if not os.path.exists(l1product_path):
+    for download_request, l1product_path in zip(download_requests, l1product_paths):
+        if not is_product_available(l1product_path, download_request):
             raise RuntimeError("Download of product was not successful: {}".format(l1product_path))
 
+    # cut the products to the region of all perimeters once, processors fall back to the full product on failure
+    if is_presubset_enabled(env, params):
+        for l1product_path in l1product_paths:
+            try:
+                with semaphores['process']:
+                    presubset(env, params, l1product_path)
+            except (Exception,):
+                log(env["General"]["log"], "Pre-subset failed for {}, processing full product.".format(l1product_path))
+                log(env["General"]["log"], traceback.format_exc(), indent=1)
+
+    use_provenance = is_provenance_enabled(params)
+    # fused graphs produce the outputs of several processors at once, which provenance cannot invalidate one by one
+    use_fusion = is_gpt_fusion_enabled(params) and not use_provenance
     with semaphores['process']:
-        l2product_files = {}
+        l2product_files, fused_outputs = {}, {}
         # apply processors to all products
         for processor in list(filter(None, params['General']['processors'].split(","))):
+            check_abort(abort, group)
             try:
                 log(env["General"]["log"], "", blank=True)
-                log(env["General"]["log"], "Processor {} starting...".format(processor))
-                process = getattr(
-                    importlib.import_module("processors.{}.{}".format(processor.lower(), processor.lower())), "process")
-                processor_outputs = []
+                backend = get_execution_backend(params, processor)
+                log(env["General"]["log"], "Processor {} starting ({} backend)...".format(processor, backend))
+                processor_outputs, cpu_time = [], 0
                 for l1product_path in l1product_paths:
                     if l1product_path not in l2product_files.keys():
                         l2product_files[l1product_path] = {}
-                    output_file = process(env, params, l1product_path, l2product_files[l1product_path], l2_path)
+                    product_name = os.path.basename(l1product_path)
+                    if use_provenance:
+                        provenance = get_provenance(params, processor, product_name, [
+                            (step, product_name) for step in l2product_files[l1product_path]], l2_path,
+                            l1product_path)
+                        invalidate_changed_output(env, l2_path, processor, product_name, provenance)
+                    fused_cpu_time = 0
+                    if use_fusion and processor not in fused_outputs.get(l1product_path, {}):
+                        child_start = get_child_cpu_time()
+                        fused_outputs[l1product_path] = run_fused_graph(
+                            env, params, get_fusion_chain(params, processor), l1product_path,
+                            l2product_files[l1product_path], l2_path)
+                        fused_cpu_time = get_child_cpu_time() - child_start
+                    if processor in fused_outputs.get(l1product_path, {}):
+                        output_file = fused_outputs[l1product_path].pop(processor)
+                        product_cpu_time = fused_cpu_time
+                        if output_file is None:
+                            cpu_time += product_cpu_time
+                            log(env["General"]["log"], "Output of {} was passed on in the fused graph and not "
+                                                       "written.".format(processor), indent=1)
+                            continue
+                    else:
+                        output_file, product_cpu_time = backends.run(backend, processor, env, params, l1product_path,
+                                                                     l2product_files[l1product_path], l2_path)
+                    cpu_time += product_cpu_time
+                    if use_provenance:
+                        write_provenance(l2_path, processor, product_name, provenance, output_file)
                     l2product_files[l1product_path][processor] = output_file
+                    write_metadata_sidecar(env, output_file)
                     processor_outputs.append(output_file)
-                log(env["General"]["log"],
-                    "Processor {} finished: [{}].".format(processor, ", ".join(processor_outputs)))
+                log(env["General"]["log"], "Processor {} finished in {:.1f} cpu seconds: [{}].".format(
+                    processor, cpu_time, ", ".join(processor_outputs)))
                 if len(processor_outputs) == 1:
                     l2product_files[processor] = processor_outputs[0]
                 elif len(processor_outputs) > 1:
-                    if "mosaic" in params["General"] and params["General"]["mosaic"] == "False":
+                    if any(is_intermediate(output) for output in processor_outputs):
+                        log(env["General"]["log"], "Outputs of {} are intermediate products, not mosaicing them. "
+                                                   "List {} in deliverables to mosaic it.".format(processor, processor))
+                    elif "mosaic" in params["General"] and params["General"]["mosaic"] == "False":
                         log(env["General"]["log"], "Mosaic outputs set to false, not mosaicing {}".format(processor))
                     else:
                         try:
                             log(env["General"]["log"], "Mosaicing outputs of processor {}...".format(processor))
                             from mosaic.mosaic import mosaic
+                            mosaic_name = "{}_{}".format(processor, group)
+                            if use_provenance:
+                                provenance = get_provenance(params, "MOSAIC", mosaic_name, [
+                                    (processor, os.path.basename(path)) for path in l1product_paths], l2_path)
+                                invalidate_changed_output(env, l2_path, "MOSAIC", mosaic_name, provenance)
                             l2product_files[processor] = mosaic(env, params, processor_outputs)
+                            if use_provenance:
+                                write_provenance(l2_path, "MOSAIC", mosaic_name, provenance,
+                                                 l2product_files[processor])
+                            write_metadata_sidecar(env, l2product_files[processor])
                             log(env["General"]["log"], "Mosaiced outputs of processor {}.".format(processor))
                         except (Exception,):
                             log(env["General"]["log"], "Mosaicing outputs of processor {} failed.".format(processor))
                             traceback.print_exc()
-                summary.append({"group": group, "type": "processor", "name": processor, "succeeded": True})
+                summary.append({"group": group, "type": "processor", "name": processor, "succeeded": True,
+                                "backend": backend, "cpu_time": cpu_time, "l2_path": l2_path})
             except (Exception,):
                 log(env["General"]["log"], "Processor {} failed on product {}.".format(processor, l1product_path))
                 log(env["General"]["log"], traceback.format_exc(), indent=1)
-                summary.append({"group": group, "type": "processor", "name": processor, "succeeded": False})
+                summary.append({"group": group, "type": "processor", "name": processor, "succeeded": False,
+                                "l2_path": l2_path})
                 del processor_outputs
         for l1product_path in l1product_paths:
             try:
@@ -266,10 +899,19 @@ def sencast_product_group(env, params, do_download, auth, download_requests, l1p
         log(env["General"]["log"], "", blank=True)
         log(env["General"]["log"], "All processors finished! {}".format(str(l2product_files)))
 
+    # append the outputs to the pixel time-series stores
+    if is_timeseries_enabled(env, params):
+        try:
+            append_products(env, params, l2product_files)
+        except (Exception,):
+            log(env["General"]["log"], "Appending product group {} to the time-series stores failed.".format(group))
+            log(env["General"]["log"], traceback.format_exc(), indent=1)
+
     # apply adapters
     if "adapters" in params["General"]:
         with semaphores['adapt']:
             for adapter in list(filter(None, params['General']['adapters'].split(","))):
+                check_abort(abort, group)
                 try:
                     log(env["General"]["log"], "", blank=True)
                     log(env["General"]["log"], "Adapter {} starting...".format(adapter))
@@ -277,16 +919,71 @@ def sencast_product_group(env, params, do_download, auth, download_requests, l1p
                                     "apply")
                     apply(env, params, l2product_files, group)
                     log(env["General"]["log"], "Adapter {} finished.".format(adapter))
-                    summary.append({"group": group, "type": "adapter", "name": adapter, "succeeded": True})
+                    summary.append({"group": group, "type": "adapter", "name": adapter, "succeeded": True,
+                                    "l2_path": l2_path})
                 except (Exception,):
                     log(env["General"]["log"], "Adapter {} failed on product group {}.".format(adapter, group))
                     log(env["General"]["log"], sys.exc_info()[0])
                     traceback.print_exc()
-                    summary.append({"group": group, "type": "adapter", "name": adapter, "succeeded": False})
+                    summary.append({"group": group, "type": "adapter", "name": adapter, "succeeded": False,
+                                    "l2_path": l2_path})
 
     l2product_files_outer[group] = l2product_files
 
 
+def check_abort(abort, group):
+    if abort is not None and abort.is_set():
+        raise RuntimeError("Processing of product group {} has been aborted.".format(group))
+
+
+def composite_products(env, params, l2_path, l2product_files):
+    """Composite the outputs of all product groups of a run into daily, weekly, monthly or whole-run products."""
+    try:
+        from composite.composite import apply
+        log(env["General"]["log"], "", blank=True)
+        log(env["General"]["log"], "Temporal compositing starting...")
+        composites = apply(env, params, l2product_files, l2_path)
+        log(env["General"]["log"], "Temporal compositing finished, {} composites.".format(len(composites)))
+        summary.append({"group": "all", "type": "composite", "name": "COMPOSITE", "succeeded": True,
+                        "l2_path": l2_path})
+    except (Exception,):
+        log(env["General"]["log"], "Temporal compositing failed.")
+        log(env["General"]["log"], sys.exc_info()[0])
+        traceback.print_exc()
+        summary.append({"group": "all", "type": "composite", "name": "COMPOSITE", "succeeded": False,
+                        "l2_path": l2_path})
+
+
+def log_cpu_times(env, l2_path):
+    """Log the cpu time used by each processor over all product groups of a run, to help choosing execution backends."""
+    cpu_times = {}
+    for s in summary:
+        if s["type"] == "processor" and "cpu_time" in s and s["l2_path"] == l2_path:
+            key = (s["name"], s["backend"])
+            cpu_times[key] = cpu_times.get(key, 0) + s["cpu_time"]
+    for (processor, backend), cpu_time in sorted(cpu_times.items(), key=lambda item: -item[1]):
+        log(env["General"]["log"], "Processor {} used {:.1f} cpu seconds ({} backend).".format(
+            processor, cpu_time, backend), indent=1)
+
+
+def get_download_lock(l1product_path):
+    """Return the lock which guards the download of a l1 product, so that runs sharing a product download it once."""
+    with download_locks_lock:
+        if l1product_path not in download_locks:
+            download_locks[l1product_path] = Lock()
+        return download_locks[l1product_path]
+
+
+def write_metadata_sidecar(env, product_file):
+    """Write the json metadata sidecar of a product file. Failures are logged and do not fail the processor."""
+    if not product_file or not os.path.isfile(product_file) or not product_file.endswith(".nc"):
+        return
+    try:
+        read_product_metadata(product_file)
+    except (Exception,):
+        log(env["General"]["log"], "Could not write metadata sidecar for {}".format(product_file), indent=1)
+
+
 def test_installation(env, delete):
     if delete:
         _, params_s3, l2_path_s3 = init_hindcast(env, 'test_S3_processors.ini')
@@ -327,11 +1024,48 @@ if __name__ == "__main__":
     parser.add_argument('--adapters', '-a', help="Maximum number of adapters to run in parallel", type=int, default=1)
     parser.add_argument('--tests', '-t', help="Run test scripts to check Sencast installation", action='store_true')
     parser.add_argument('--delete_tests', '-x', help="Delete previous test run.", action='store_true')
+    parser.add_argument('--queue', '-q', help="SQLite task queue file for distributed runs. Together with "
+                                              "comma-separated parameter files and/or a sweep file, their product "
+                                              "groups are added to the queue", type=str, default=None)
+    parser.add_argument('--worker', '-w', help="Process product groups from the task queue", action='store_true')
+    parser.add_argument('--sweep', '-s', help="Run a sweep over perimeters and periods from a sweep file", type=str,
+                        default=None)
+    parser.add_argument('--nrt', '-n', help="Run the near-real-time daemon with this state file, for the "
+                                            "comma-separated parameter files", type=str, default=None)
+    parser.add_argument('--search', help="Search for products (live), also record the search in the output folder "
+                                         "(record) or replay the recorded search (replay)", type=str, default=None,
+                        choices=SEARCH_MODES)
     args = parser.parse_args()
     variables = vars(args)
     sys.argv = [sys.argv[0]]
     if variables["tests"]:
         test_installation(variables["environment"], variables["delete_tests"])
+    elif variables["nrt"]:
+        if variables["parameters"] is None:
+            raise ValueError("Sencast FAILED. Link to parameters file must be provided.")
+        sencast_nrt(list(filter(None, variables["parameters"].split(","))), variables["nrt"],
+                    env_file=variables["environment"],
+                    max_parallel_downloads=variables["downloads"],
+                    max_parallel_processors=variables["processors"],
+                    max_parallel_adapters=variables["adapters"])
+    elif variables["queue"] and variables["worker"]:
+        sencast_worker(variables["queue"],
+                       env_file=variables["environment"],
+                       max_parallel_downloads=variables["downloads"],
+                       max_parallel_processors=variables["processors"],
+                       max_parallel_adapters=variables["adapters"])
+    elif variables["queue"]:
+        if variables["parameters"] is None and variables["sweep"] is None:
+            raise ValueError("Sencast FAILED. Link to parameters or sweep file must be provided to fill the task "
+                             "queue.")
+        sencast_coordinate(list(filter(None, (variables["parameters"] or "").split(","))), variables["queue"],
+                           env_file=variables["environment"], sweep_file=variables["sweep"])
+    elif variables["sweep"]:
+        sencast_sweep(variables["sweep"],
+                      env_file=variables["environment"],
+                      max_parallel_downloads=variables["downloads"],
+                      max_parallel_processors=variables["processors"],
+                      max_parallel_adapters=variables["adapters"])
     else:
         if variables["parameters"] is None:
             raise ValueError("Sencast FAILED. Link to parameters file must be provided.")
@@ -339,4 +1073,5 @@ if __name__ == "__main__":
                 env_file=variables["environment"],
                 max_parallel_downloads=variables["downloads"],
                 max_parallel_processors=variables["processors"],
-                max_parallel_adapters=variables["adapters"])
+                max_parallel_adapters=variables["adapters"],
+                search=variables["search"])
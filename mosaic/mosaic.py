@@ -8,13 +8,33 @@ bundled with the SNAP software.
 
 import os
 import re
-import subprocess
 
+import numpy as np
+from netCDF4 import Dataset
+
+from utils.auxil import log, gpt_subprocess
 from utils.product_fun import get_lons_lats, get_sensing_date_from_product_name, get_reproject_params_from_wkt, \
-    get_band_names_from_nc
+    read_product_metadata
 
+# Key of the params section for mosaic
+PARAMS_SECTION = "MOSAIC"
 # The name of the xml file for gpt
 GPT_XML_FILENAME = "mosaic_{}_{}.xml"
+# Default number of attempts for the GPT
+DEFAULT_ATTEMPTS = 1
+# Default timeout for the GPT (doesn't apply to last attempt) in seconds
+DEFAULT_TIMEOUT = False
+# Default mosaic method, either "gpt" (SNAP Mosaic operator) or "native" (numpy, for products on the perimeter grid)
+DEFAULT_METHOD = "gpt"
+# Rules to resolve overlaps in native mosaics: first valid pixel in product order, mean of the valid pixels, or first
+# valid pixel with products ordered by their number of valid pixels within the mosaic (in the band set with
+# 'quality_band', or in all mosaicked bands)
+OVERLAP_RULES = ["first", "mean", "max_valid"]
+DEFAULT_OVERLAP_RULE = "first"
+# Number of rows written at once by the native mosaic
+BLOCK_ROWS = 256
+# Maximum misalignment (in pixels) of a product grid to the perimeter grid for native mosaicking
+GRID_TOLERANCE = 0.05
 
 
 def mosaic(env, params, product_files):
@@ -32,11 +52,24 @@ def mosaic(env, params, product_files):
     # check if output already exists
     if os.path.isfile(output_file):
         if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
-            print("Removing file: ${}".format(output_file))
+            log(env["General"]["log"], "Removing file: ${}".format(output_file), indent=1)
             os.remove(output_file)
         else:
-            print("Skipping MOSAIC, target already exists: {}".format(os.path.basename(output_file)))
+            log(env["General"]["log"], "Skipping MOSAIC, target already exists: {}".format(
+                os.path.basename(output_file)), indent=1)
+            return output_file
+
+    method, rule, quality_band = DEFAULT_METHOD, DEFAULT_OVERLAP_RULE, None
+    if PARAMS_SECTION in params:
+        method = params[PARAMS_SECTION].get("method", DEFAULT_METHOD).lower()
+        rule = params[PARAMS_SECTION].get("overlap", DEFAULT_OVERLAP_RULE).lower()
+        quality_band = params[PARAMS_SECTION].get("quality_band", "").strip() or None
+    if method == "native":
+        if rule not in OVERLAP_RULES:
+            raise RuntimeError("Unknown mosaic overlap rule {}, use one of: {}".format(rule, ", ".join(OVERLAP_RULES)))
+        if native_mosaic(env, params, product_files, output_file, rule, quality_band=quality_band):
             return output_file
+        log(env["General"]["log"], "Product grids do not align with the perimeter grid, using GPT mosaic.", indent=1)
 
     # rewrite xml file for gpt
     gpt_xml_file = os.path.join(os.path.dirname(output_file), "_reproducibility", GPT_XML_FILENAME.format(params['General']['sensor'], date))
@@ -48,11 +81,24 @@ def mosaic(env, params, product_files):
     for i in range(len(product_files)):
         args.append("-SsourceFile{}={}".format(i, product_files[i]))
     args.append("-PoutputFile={}".format(output_file))
-    print("Calling [{}]...".format(" ".join(args)))
-    if subprocess.call(args):
-        raise RuntimeError("GPT Failed.")
 
-    return output_file
+    if PARAMS_SECTION in params and "attempts" in params[PARAMS_SECTION]:
+        attempts = int(params[PARAMS_SECTION]["attempts"])
+    else:
+        attempts = DEFAULT_ATTEMPTS
+
+    if PARAMS_SECTION in params and "timeout" in params[PARAMS_SECTION]:
+        timeout = int(params[PARAMS_SECTION]["timeout"])
+    else:
+        timeout = DEFAULT_TIMEOUT
+
+    if gpt_subprocess(args, env["General"]["log"], attempts=attempts, timeout=timeout):
+        return output_file
+    else:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+            log(env["General"]["log"], "Removed corrupted output file.", indent=2)
+        raise RuntimeError("GPT Failed.")
 
 
 def rewrite_xml(gpt_xml_file, product_files, sensor, wkt, resolution):
@@ -61,7 +107,7 @@ def rewrite_xml(gpt_xml_file, product_files, sensor, wkt, resolution):
 
     sources_str = "\n\t\t\t".join(["<source{}>{}</source{}>".format(i, "${sourceFile" + str(i) + "}", i) for i in range(len(product_files))])
 
-    product_band_names = [get_band_names_from_nc(product_file) for product_file in product_files]
+    product_band_names = [read_product_metadata(product_file)['bands'] for product_file in product_files]
     common_band_names = product_band_names[0]
     for band_names in product_band_names[1:]:
         common_band_names = list(set(common_band_names) & set(band_names))
@@ -86,3 +132,140 @@ def rewrite_xml(gpt_xml_file, product_files, sensor, wkt, resolution):
 
     with open(gpt_xml_file, "w") as f:
         f.write(xml)
+
+
+def native_mosaic(env, params, product_files, output_file, rule=DEFAULT_OVERLAP_RULE, block_rows=BLOCK_ROWS,
+                  quality_band=None):
+    """
+    Mosaic products which are on the regular lat/lon grid of the perimeter without GPT. Each product is placed on the
+    perimeter grid by its integer pixel offset, overlaps are resolved with the given rule, and the output is written
+    in blocks of rows. With the rule max_valid, products are ranked by their valid pixels within the mosaic in the
+    quality band, or in all mosaicked bands if no quality band is given. Returns False without writing anything if a
+    product grid does not align.
+    """
+    grid = get_reproject_params_from_wkt(params['General']['wkt'], params['General']['resolution'])
+    west, north = float(grid['easting']), float(grid['northing'])
+    pixel_size_x, pixel_size_y = float(grid['pixelSizeX']), float(grid['pixelSizeY'])
+    width, height = int(grid['width']), int(grid['height'])
+
+    metadata = [read_product_metadata(product_file) for product_file in product_files]
+    common_band_names = set(metadata[0]['dtypes'])
+    for product_metadata in metadata[1:]:
+        common_band_names &= set(product_metadata['dtypes'])
+    common_band_names = sorted(common_band_names - {"lat", "lon"})
+
+    srcs = [Dataset(product_file) for product_file in product_files]
+    try:
+        offsets = [get_grid_offset(src, west, north, pixel_size_x, pixel_size_y) for src in srcs]
+        if None in offsets:
+            return False
+        products = list(zip(srcs, offsets))
+        if rule == "max_valid" and common_band_names:
+            ranking_band_names = common_band_names
+            if quality_band is not None and quality_band in common_band_names:
+                ranking_band_names = [quality_band]
+            elif quality_band is not None:
+                log(env["General"]["log"], "Quality band {} is not in all products, ranking by all bands.".format(
+                    quality_band), indent=1)
+            valid_pixels = {id(src): sum(count_valid_pixels(src, band_name, offset, width, height, block_rows)
+                                         for band_name in ranking_band_names) for src, offset in products}
+            products.sort(key=lambda product: -valid_pixels[id(product[0])])
+
+        log(env["General"]["log"], "Mosaicing {} products natively with overlap rule '{}'.".format(len(srcs), rule),
+            indent=1)
+        temp_file = "{}.incomplete".format(output_file)
+        with Dataset(temp_file, mode='w') as dst:
+            dst.setncatts(srcs[0].__dict__)
+            dst.createDimension('lat', height)
+            dst.createDimension('lon', width)
+            for name, values in [('lat', north - (np.arange(height) + 0.5) * pixel_size_y),
+                                 ('lon', west + (np.arange(width) + 0.5) * pixel_size_x)]:
+                dst.createVariable(name, 'f8', (name,))
+                if name in srcs[0].variables:
+                    dst[name].setncatts(srcs[0][name].__dict__)
+                dst[name][:] = values
+            if 'crs' in srcs[0].variables:
+                dst.createVariable('crs', srcs[0]['crs'].datatype)
+                dst['crs'].setncatts(srcs[0]['crs'].__dict__)
+
+            for band_name in common_band_names:
+                src_band = srcs[0].variables[band_name]
+                is_float = np.issubdtype(src_band.dtype, np.floating)
+                fill_value = getattr(src_band, '_FillValue', np.nan if is_float else 0)
+                dst.createVariable(band_name, src_band.datatype, ('lat', 'lon'), fill_value=fill_value,
+                                   zlib=True, complevel=6)
+                dst[band_name].setncatts({k: v for k, v in src_band.__dict__.items() if k != '_FillValue'})
+                for y0 in range(0, height, block_rows):
+                    y1 = min(height, y0 + block_rows)
+                    dst[band_name][y0:y1, :] = mosaic_block(products, band_name, y0, y1, width, fill_value,
+                                                            src_band.dtype, rule if is_float else "first")
+        os.replace(temp_file, output_file)
+    finally:
+        for src in srcs:
+            src.close()
+    return True
+
+
+def get_grid_offset(src, west, north, pixel_size_x, pixel_size_y):
+    """Returns the (row, col) offset of a product on the perimeter grid, or None if the grids do not align."""
+    if 'lat' not in src.variables or 'lon' not in src.variables:
+        return None
+    lats, lons = src.variables['lat'], src.variables['lon']
+    if len(lats.dimensions) != 1 or len(lons.dimensions) != 1 or len(lats) < 2 or len(lons) < 2:
+        return None
+    lat0, lat1, lon0, lon1 = float(lats[0]), float(lats[1]), float(lons[0]), float(lons[1])
+    if abs((lat0 - lat1) - pixel_size_y) > GRID_TOLERANCE * pixel_size_y or \
+            abs((lon1 - lon0) - pixel_size_x) > GRID_TOLERANCE * pixel_size_x:
+        return None
+    row = (north - lat0) / pixel_size_y - 0.5
+    col = (lon0 - west) / pixel_size_x - 0.5
+    if abs(row - round(row)) > GRID_TOLERANCE or abs(col - round(col)) > GRID_TOLERANCE:
+        return None
+    return int(round(row)), int(round(col))
+
+
+def count_valid_pixels(src, band_name, offset, width, height, block_rows=BLOCK_ROWS):
+    """Count the valid pixels of a band within the mosaic, which is read in blocks of rows."""
+    band, (row, col) = src.variables[band_name], offset
+    r0, r1 = max(0, row), min(height, row + band.shape[0])
+    c0, c1 = max(0, col), min(width, col + band.shape[1])
+    valid_pixels = 0
+    for y0 in range(r0, r1, block_rows):
+        data = band[y0 - row:min(r1, y0 + block_rows) - row, c0 - col:c1 - col]
+        invalid = np.ma.getmaskarray(data)
+        if np.issubdtype(data.dtype, np.floating):
+            invalid |= np.isnan(np.ma.getdata(data))
+        valid_pixels += int(np.count_nonzero(~invalid))
+    return valid_pixels
+
+
+def mosaic_block(products, band_name, y0, y1, width, fill_value, dtype, rule):
+    """Combines the rows y0 to y1 of a band of all products, which are given as (dataset, (row, col)) tuples."""
+    block = np.full((y1 - y0, width), fill_value, dtype=dtype)
+    valid = np.zeros(block.shape, dtype=bool)
+    if rule == "mean":
+        sums = np.zeros(block.shape, dtype=np.float64)
+        counts = np.zeros(block.shape, dtype=np.int32)
+    for src, (row, col) in products:
+        band = src.variables[band_name]
+        r0, r1 = max(y0, row), min(y1, row + band.shape[0])
+        c0, c1 = max(0, col), min(width, col + band.shape[1])
+        if r0 >= r1 or c0 >= c1:
+            continue
+        data = band[r0 - row:r1 - row, c0 - col:c1 - col]
+        values = np.ma.getdata(data)
+        is_valid = ~np.ma.getmaskarray(data)
+        if np.issubdtype(values.dtype, np.floating):
+            is_valid &= ~np.isnan(values)
+        window = (slice(r0 - y0, r1 - y0), slice(c0, c1))
+        if rule == "mean":
+            sums[window] += np.where(is_valid, values, 0)
+            counts[window] += is_valid
+        else:
+            take = is_valid & ~valid[window]
+            block[window][take] = values[take]
+            valid[window] |= is_valid
+    if rule == "mean":
+        has_values = counts > 0
+        block[has_values] = (sums[has_values] / counts[has_values]).astype(dtype)
+    return block
@@ -0,0 +1,158 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+The regional pre-subset cuts each L1 product once to the bounding box of all perimeters of a deployment and stores the
+subset in BEAM-DIMAP format. GPT based processors which read L1 products then read the small subset instead of the
+full swath, for every perimeter which is processed on this product.
+
+The region is the presubset_wkt of the params, else the presubset_wkt of the DIAS section of the environment, which
+lets separate runs of a deployment share their subsets, else the bounding box of the wkt. Sweeps, the near-real-time
+daemon and the coordinator set the presubset_wkt of their runs to the bounding box of all their perimeters.
+"""
+
+import hashlib
+import os
+import shutil
+from threading import Lock
+
+from utils.auxil import log, gpt_subprocess
+from utils.product_fun import get_lons_lats
+
+# Key of the params section for the pre-subset
+PARAMS_SECTION = "PRESUBSET"
+# The name of the xml file for gpt
+GPT_XML_FILENAME = "presubset_{}.xml"
+# A pattern for the name of the subset product (completed with product name and region hash)
+OUT_FILENAME = "{}_{}.dim"
+# Sensors whose L1 products can be pre-subset, other products are always read in full
+PRESUBSET_SENSORS = ["OLCI"]
+# Default number of attempts for the GPT
+DEFAULT_ATTEMPTS = 1
+# Default timeout for the GPT (doesn't apply to last attempt) in seconds
+DEFAULT_TIMEOUT = False
+
+presubset_locks, presubset_locks_lock = {}, Lock()
+
+
+def is_presubset_enabled(env, params):
+    return "presubset" in params["General"] and params["General"]["presubset"] == "True" and \
+           params["General"]["sensor"] in PRESUBSET_SENSORS and "subset_path" in env["DIAS"]
+
+
+def get_presubset_region(env, params):
+    """Return the region of the pre-subset, which is the presubset_wkt of the params or of the environment or the
+    bounding box of the wkt."""
+    if "presubset_wkt" in params["General"] and params["General"]["presubset_wkt"]:
+        return params["General"]["presubset_wkt"]
+    if "presubset_wkt" in env["DIAS"] and env["DIAS"]["presubset_wkt"]:
+        return env["DIAS"]["presubset_wkt"]
+    return get_union_bbox_wkt([params["General"]["wkt"]])
+
+
+def set_presubset_region(paramss, presubset_wkt=None):
+    """Set the presubset_wkt of all params which have none to the given region, by default the bounding box of the
+    perimeters of all params, so that their runs share the pre-subsets."""
+    if presubset_wkt is None:
+        presubset_wkt = get_union_bbox_wkt([params['General']['wkt'] for params in paramss])
+    for params in paramss:
+        if not params['General'].get('presubset_wkt', ""):
+            params['General']['presubset_wkt'] = presubset_wkt
+    return presubset_wkt
+
+
+def get_union_bbox_wkt(wkts):
+    """Return the bounding box of all given perimeters as wkt polygon."""
+    lons, lats = [], []
+    for wkt in wkts:
+        wkt_lons, wkt_lats = get_lons_lats(wkt)
+        lons.extend(wkt_lons)
+        lats.extend(wkt_lats)
+    west, east, south, north = min(lons), max(lons), min(lats), max(lats)
+    return "POLYGON (({0} {2}, {1} {2}, {1} {3}, {0} {3}, {0} {2}))".format(west, east, south, north)
+
+
+def get_presubset_file(env, params, l1product_path):
+    """Return the pre-subset of a L1 product if it exists, otherwise the L1 product itself."""
+    if not is_presubset_enabled(env, params):
+        return l1product_path
+    subset_file = get_subset_file_name(env, params, l1product_path)
+    return subset_file if os.path.isfile(subset_file) else l1product_path
+
+
+def get_subset_file_name(env, params, l1product_path):
+    region_hash = hashlib.md5(get_presubset_region(env, params).encode()).hexdigest()[:8]
+    return os.path.join(env["DIAS"]["subset_path"], OUT_FILENAME.format(os.path.basename(l1product_path), region_hash))
+
+
+def presubset(env, params, l1product_path):
+    """
+    Cut a L1 product to the pre-subset region, unless this has already been done by this or another run. Returns the
+    subset product, or the L1 product if pre-subsets are not enabled.
+    """
+    if not is_presubset_enabled(env, params):
+        return l1product_path
+    output_file = get_subset_file_name(env, params, l1product_path)
+    with presubset_locks_lock:
+        lock = presubset_locks.setdefault(output_file, Lock())
+    with lock:
+        if os.path.isfile(output_file):
+            log(env["General"]["log"], "Using existing pre-subset: {}".format(os.path.basename(output_file)), indent=1)
+            return output_file
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+        sensor, region = params["General"]["sensor"], get_presubset_region(env, params)
+        gpt_xml_file = os.path.join(os.path.dirname(output_file), "_reproducibility",
+                                    GPT_XML_FILENAME.format(os.path.splitext(os.path.basename(output_file))[0]))
+        if not os.path.isfile(gpt_xml_file):
+            rewrite_xml(gpt_xml_file, sensor, region)
+
+        # write to a temporary product first, so that other runs never read an incomplete subset
+        temp_file = "{}.incomplete.dim".format(os.path.splitext(output_file)[0])
+        args = [env['General']['gpt_path'], gpt_xml_file, "-c", env['General']['gpt_cache_size'], "-e",
+                "-SsourceFile={}".format(l1product_path), "-PoutputFile={}".format(temp_file)]
+
+        if PARAMS_SECTION in params and "attempts" in params[PARAMS_SECTION]:
+            attempts = int(params[PARAMS_SECTION]["attempts"])
+        else:
+            attempts = DEFAULT_ATTEMPTS
+
+        if PARAMS_SECTION in params and "timeout" in params[PARAMS_SECTION]:
+            timeout = int(params[PARAMS_SECTION]["timeout"])
+        else:
+            timeout = DEFAULT_TIMEOUT
+
+        log(env["General"]["log"], "Creating pre-subset of {}".format(os.path.basename(l1product_path)), indent=1)
+        if not gpt_subprocess(args, env["General"]["log"], attempts=attempts, timeout=timeout):
+            remove_dimap(temp_file)
+            raise RuntimeError("GPT Failed.")
+
+        # the data folder is referenced by name from the header, so it is renamed before the header is moved
+        os.replace("{}.data".format(os.path.splitext(temp_file)[0]), "{}.data".format(os.path.splitext(output_file)[0]))
+        with open(temp_file, "r") as f:
+            header = f.read()
+        with open(temp_file, "w") as f:
+            f.write(header.replace(os.path.basename(os.path.splitext(temp_file)[0]),
+                                   os.path.basename(os.path.splitext(output_file)[0])))
+        os.replace(temp_file, output_file)
+        return output_file
+
+
+def remove_dimap(dimap_file):
+    """Remove a BEAM-DIMAP product, consisting of the header file and its data folder."""
+    if os.path.isfile(dimap_file):
+        os.remove(dimap_file)
+    data_dir = "{}.data".format(os.path.splitext(dimap_file)[0])
+    if os.path.isdir(data_dir):
+        shutil.rmtree(data_dir)
+
+
+def rewrite_xml(gpt_xml_file, sensor, wkt):
+    with open(os.path.join(os.path.dirname(__file__), GPT_XML_FILENAME.format(sensor)), "r") as f:
+        xml = f.read()
+
+    xml = xml.replace("${wkt}", wkt)
+
+    os.makedirs(os.path.dirname(gpt_xml_file), exist_ok=True)
+    with open(gpt_xml_file, "w") as f:
+        f.write(xml)
@@ -16,6 +16,7 @@ import subprocess
 
 from datetime import datetime
 from polymer.ancillary_era5 import Ancillary_ERA5
+from presubset.presubset import get_presubset_file
 from utils.auxil import load_properties, log, gpt_subprocess
 from utils.product_fun import get_lons_lats, get_sensing_date_from_product_name
 
@@ -29,6 +30,8 @@ OUT_FILENAME = "L2C2RCC_{}_{}.nc"
 QL_DIR = "L2C2RCC-{}"
 # A pattern for the name of the file to which the quicklooks will be saved (completed with product name and band name)
 QL_FILENAME = "L2C2RCC_{}_{}.png"
+# The Sentinel-2 L1 bands which this processor reads
+REQUIRED_BANDS = ["B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8A"]
 # The name of the xml file for gpt
 GPT_XML_FILENAME = "c2rcc_{}_{}.xml"
 # Default number of attempts for the GPT
@@ -40,7 +43,32 @@ DEFAULT_TIMEOUT = False
 def process(env, params, l1product_path, l2product_files, out_path):
     """This processor applies c2rcc to the source product and stores the result."""
 
-    gpt, product_name = env['General']['gpt_path'], os.path.basename(l1product_path)
+    gpt_job = prepare(env, params, l1product_path, l2product_files, out_path)
+    if gpt_job["exists"]:
+        return gpt_job["output_file"]
+
+    gpt, output_file = env['General']['gpt_path'], gpt_job["output_file"]
+    if "gpt_use_default" in env['General'] and env['General']['gpt_use_default'] == "True":
+        args = [gpt, gpt_job["gpt_xml_file"], "-SsourceFile={}".format(gpt_job["source_file"]),
+                "-PoutputFile={}".format(output_file)]
+    else:
+        args = [gpt, gpt_job["gpt_xml_file"], "-c", env['General']['gpt_cache_size'], "-e",
+                "-SsourceFile={}".format(gpt_job["source_file"]), "-PoutputFile={}".format(output_file)]
+
+    if gpt_subprocess(args, env["General"]["log"], attempts=gpt_job["attempts"], timeout=gpt_job["timeout"]):
+        return output_file
+    else:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+            log(env["General"]["log"], "Removed corrupted output file.", indent=2)
+        raise RuntimeError("GPT Failed.")
+
+
+def prepare(env, params, l1product_path, l2product_files, out_path):
+    """Write the graph of this processor and return the files it reads and writes, without calling the GPT. Used by
+    process and to fuse the graphs of consecutive GPT processors."""
+
+    product_name = os.path.basename(l1product_path)
     sensor, resolution, wkt, resolution = params['General']['sensor'], params['General']['resolution'], params['General']['wkt'], params['General']['resolution']
     altnn, validexpression = params[PARAMS_SECTION]['altnn'], params[PARAMS_SECTION]['validexpression']
     vicar_properties_filename = params[PARAMS_SECTION]['vicar_properties_filename']
@@ -68,14 +96,26 @@ def process(env, params, l1product_path, l2product_files, out_path):
                 ancillary_obj["useEcmwfAuxData"] = "True"
             pass
 
+    if PARAMS_SECTION in params and "attempts" in params[PARAMS_SECTION]:
+        attempts = int(params[PARAMS_SECTION]["attempts"])
+    else:
+        attempts = DEFAULT_ATTEMPTS
+
+    if PARAMS_SECTION in params and "timeout" in params[PARAMS_SECTION]:
+        timeout = int(params[PARAMS_SECTION]["timeout"])
+    else:
+        timeout = DEFAULT_TIMEOUT
+
     output_file = os.path.join(out_path, OUT_DIR, OUT_FILENAME.format(anc_name, product_name))
+    gpt_job = {"gpt_xml_file": None, "source_file": None, "output_file": output_file, "exists": False,
+               "attempts": attempts, "timeout": timeout}
     if os.path.isfile(output_file):
         if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
             log(env["General"]["log"], "Removing file: ${}".format(output_file))
             os.remove(output_file)
         else:
             log(env["General"]["log"], "Skipping C2RCC, target already exists: {}".format(OUT_FILENAME.format(anc_name, product_name)))
-            return output_file
+            return dict(gpt_job, exists=True)
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
     if "processor" in params[PARAMS_SECTION]:
@@ -94,38 +134,14 @@ def process(env, params, l1product_path, l2product_files, out_path):
                         params[PARAMS_SECTION]["processor"]))
     else:
         log(env["General"]["log"], "Using L1 product as input file.", indent=1)
-        input_file = l1product_path
+        input_file = get_presubset_file(env, params, l1product_path)
         if sensor == "MSI":
             sensor = "MSI_RES"
 
     gpt_xml_file = os.path.join(out_path, OUT_DIR, "_reproducibility", GPT_XML_FILENAME.format(sensor, date_str))
     rewrite_xml(gpt_xml_file, date_str, sensor, altnn, validexpression, vicar_properties_filename, wkt, ancillary_obj, resolution)
 
-    if "gpt_use_default" in env['General'] and env['General']['gpt_use_default'] == "True":
-        args = [gpt, gpt_xml_file, "-SsourceFile={}".format(input_file), "-PoutputFile={}".format(output_file)]
-    else:
-        args = [gpt, gpt_xml_file, "-c", env['General']['gpt_cache_size'], "-e",
-                "-SsourceFile={}".format(input_file), "-PoutputFile={}".format(output_file)]
-
-    if PARAMS_SECTION in params and "attempts" in params[PARAMS_SECTION]:
-        attempts = int(params[PARAMS_SECTION]["attempts"])
-    else:
-        attempts = DEFAULT_ATTEMPTS
-
-    if PARAMS_SECTION in params and "timeout" in params[PARAMS_SECTION]:
-        timeout = int(params[PARAMS_SECTION]["timeout"])
-    else:
-        timeout = DEFAULT_TIMEOUT
-
-    if gpt_subprocess(args, env["General"]["log"], attempts=attempts, timeout=timeout):
-        return output_file
-    else:
-        if os.path.exists(output_file):
-            os.remove(output_file)
-            log(env["General"]["log"], "Removed corrupted output file.", indent=2)
-        raise RuntimeError("GPT Failed.")
-
-    return output_file
+    return dict(gpt_job, gpt_xml_file=gpt_xml_file, source_file=input_file)
 
 
 def rewrite_xml(gpt_xml_file, date_str, sensor, altnn, validexpression, vicar_properties_filename, wkt, ancillary, resolution):
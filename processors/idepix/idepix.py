@@ -9,6 +9,7 @@ For an overview of the processor: https://www.brockmann-consult.de/portfolio/ide
 """
 
 import os
+from presubset.presubset import get_presubset_file
 from utils.auxil import log, gpt_subprocess
 from utils.product_fun import get_reproject_params_from_wkt, get_main_file_from_product_path
 
@@ -22,6 +23,8 @@ OUT_FILENAME = "reproj_idepix_subset_{}.nc"
 QL_DIR = "L1P-{}"
 # A pattern for the name of the file to which the quicklooks will be saved (completed with product name and band name)
 QL_FILENAME = "reproj_idepix_subset_{}_{}.png"
+# The Sentinel-2 L1 bands which this processor reads
+REQUIRED_BANDS = ["B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B8A", "B9", "B10", "B11", "B12"]
 # The name of the xml file for gpt
 GPT_XML_FILENAME = "idepix_{}.xml"
 # Default number of attempts for the GPT
@@ -30,35 +33,37 @@ DEFAULT_ATTEMPTS = 1
 DEFAULT_TIMEOUT = False
 
 
-def process(env, params, l1product_path, _, out_path):
+def process(env, params, l1product_path, l2product_files, out_path):
     """This processor applies subset, idepix, merge and reprojection to the source product and
     writes the result to disk. It returns the location of the output product."""
 
-    gpt, product_name = env['General']['gpt_path'], os.path.basename(l1product_path)
-    sensor, resolution, wkt = params['General']['sensor'], params['General']['resolution'], params['General']['wkt']
+    gpt_job = prepare(env, params, l1product_path, l2product_files, out_path)
+    if gpt_job["exists"]:
+        return gpt_job["output_file"]
 
-    output_file = os.path.join(out_path, OUT_DIR, OUT_FILENAME.format(product_name))
-    if os.path.isfile(output_file):
-        if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
-            log(env["General"]["log"], "Removing file: ${}".format(output_file), indent=1)
+    gpt, output_file = env['General']['gpt_path'], gpt_job["output_file"]
+    if "gpt_use_default" in env['General'] and env['General']['gpt_use_default'] == "True":
+        args = [gpt, gpt_job["gpt_xml_file"], "-SsourceFile={}".format(gpt_job["source_file"]),
+                "-PoutputFile={}".format(output_file)]
+    else:
+        args = [gpt, gpt_job["gpt_xml_file"], "-c", env['General']['gpt_cache_size'], "-e",
+                "-SsourceFile={}".format(gpt_job["source_file"]), "-PoutputFile={}".format(output_file)]
+
+    if gpt_subprocess(args, env["General"]["log"], attempts=gpt_job["attempts"], timeout=gpt_job["timeout"]):
+        return output_file
+    else:
+        if os.path.exists(output_file):
             os.remove(output_file)
-        else:
-            log(env["General"]["log"], "Skipping IDEPIX, target already exists: {}".format(os.path.basename(output_file)), indent=1)
-            return output_file
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            log(env["General"]["log"], "Removed corrupted output file.", indent=2)
+        raise RuntimeError("GPT Failed.")
 
-    gpt_xml_file = os.path.join(out_path, OUT_DIR, "_reproducibility", GPT_XML_FILENAME.format(sensor))
-    if not os.path.isfile(gpt_xml_file):
-        rewrite_xml(gpt_xml_file, sensor, resolution, wkt)
 
-    if sensor == "OLI_TIRS":
-        l1product_path = get_main_file_from_product_path(l1product_path)
+def prepare(env, params, l1product_path, _, out_path):
+    """Write the graph of this processor and return the files it reads and writes, without calling the GPT. Used by
+    process and to fuse the graphs of consecutive GPT processors."""
 
-    if "gpt_use_default" in env['General'] and env['General']['gpt_use_default'] == "True":
-        args = [gpt, gpt_xml_file, "-SsourceFile={}".format(l1product_path), "-PoutputFile={}".format(output_file)]
-    else:
-        args = [gpt, gpt_xml_file, "-c", env['General']['gpt_cache_size'], "-e",
-                "-SsourceFile={}".format(l1product_path), "-PoutputFile={}".format(output_file)]
+    product_name = os.path.basename(l1product_path)
+    sensor, resolution, wkt = params['General']['sensor'], params['General']['resolution'], params['General']['wkt']
 
     if PARAMS_SECTION in params and "attempts" in params[PARAMS_SECTION]:
         attempts = int(params[PARAMS_SECTION]["attempts"])
@@ -70,13 +75,28 @@ def process(env, params, l1product_path, _, out_path):
     else:
         timeout = DEFAULT_TIMEOUT
 
-    if gpt_subprocess(args, env["General"]["log"], attempts=attempts, timeout=timeout):
-        return output_file
-    else:
-        if os.path.exists(output_file):
+    output_file = os.path.join(out_path, OUT_DIR, OUT_FILENAME.format(product_name))
+    gpt_xml_file = os.path.join(out_path, OUT_DIR, "_reproducibility", GPT_XML_FILENAME.format(sensor))
+    gpt_job = {"gpt_xml_file": gpt_xml_file, "source_file": None, "output_file": output_file, "exists": False,
+               "attempts": attempts, "timeout": timeout}
+    if os.path.isfile(output_file):
+        if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
+            log(env["General"]["log"], "Removing file: ${}".format(output_file), indent=1)
             os.remove(output_file)
-            log(env["General"]["log"], "Removed corrupted output file.", indent=2)
-        raise RuntimeError("GPT Failed.")
+        else:
+            log(env["General"]["log"], "Skipping IDEPIX, target already exists: {}".format(
+                os.path.basename(output_file)), indent=1)
+            return dict(gpt_job, exists=True)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    if not os.path.isfile(gpt_xml_file):
+        rewrite_xml(gpt_xml_file, sensor, resolution, wkt)
+
+    if sensor == "OLI_TIRS":
+        gpt_job["source_file"] = get_main_file_from_product_path(l1product_path)
+    else:
+        gpt_job["source_file"] = get_presubset_file(env, params, l1product_path)
+    return gpt_job
 
 
 def rewrite_xml(gpt_xml_file, sensor, resolution, wkt):
@@ -10,8 +10,8 @@ import os
 import numpy as np
 from scipy.integrate import trapz
 
-from netCDF4 import Dataset
 from utils.auxil import log
+from utils.intermediate import get_product_path, open_product, remove_product
 from utils.product_fun import copy_nc, get_band_names_from_nc, get_name_width_height_from_nc, \
     get_satellite_name_from_product_name, get_valid_pe_from_nc, write_pixels_to_nc, create_band, read_pixels_from_nc, \
     get_sensing_date_from_product_name, copy_band
@@ -67,11 +67,11 @@ def process(env, params, l1product_path, l2product_files, out_path):
     kd_product_path = l2product_files[kd_processor]
     product_name = os.path.basename(product_path)
     product_dir = os.path.join(os.path.dirname(os.path.dirname(product_path)), OUT_DIR)
-    output_file = os.path.join(product_dir, OUT_FILENAME.format(product_name))
-    if os.path.isfile(output_file):
+    output_file = get_product_path(params, PARAMS_SECTION, os.path.join(product_dir, OUT_FILENAME.format(product_name)))
+    if os.path.exists(output_file):
         if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
             log(env["General"]["log"], "Removing file: ${}".format(output_file), indent=1)
-            os.remove(output_file)
+            remove_product(output_file)
         else:
             log(env["General"]["log"], "Skipping Primary Production, target already exists: {}".format(OUT_FILENAME.format(product_name)), indent=1)
             return output_file
@@ -83,7 +83,8 @@ def process(env, params, l1product_path, l2product_files, out_path):
         zvals = np.array(params[PARAMS_SECTION]["depths"])
     zvals_fine = np.linspace(np.min(zvals), np.max(zvals), 100)  # Fine spaced depths for integration
 
-    with Dataset(product_path) as chl_src, Dataset(kd_product_path) as kd_src, Dataset(output_file, mode='w') as dst:
+    with open_product(product_path) as chl_src, open_product(kd_product_path) as kd_src, \
+            open_product(output_file, mode='w') as dst:
         log(env["General"]["log"], "Reading Chlorophyll values from {}".format(product_path), indent=1)
         chl_band_names = get_band_names_from_nc(chl_src)
         if chl_bandname not in chl_band_names:
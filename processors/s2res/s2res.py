@@ -19,37 +19,39 @@ GPT_XML_FILENAME = "s2res.xml"
 DEFAULT_ATTEMPTS = 1
 # Default timeout for the GPT (doesn't apply to last attempt) in seconds
 DEFAULT_TIMEOUT = False
+# The Sentinel-2 L1 bands which this processor reads, S2Resampling resamples all bands of the product
+REQUIRED_BANDS = ["B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B8A", "B9", "B10", "B11", "B12"]
 
 
 def process(env, params, l1product_path, l2product_files, out_path):
     """ This processor applies S2 resampling to the source product and stores the result. """
 
-    gpt, product_name = env['General']['gpt_path'], os.path.basename(l1product_path)
+    gpt_job = prepare(env, params, l1product_path, l2product_files, out_path)
+    if gpt_job["exists"]:
+        return gpt_job["output_file"]
 
-    if "resolution" not in params["General"]:
-        raise RuntimeWarning('Resolution must be defined in the parameter file.')
-    resolution = params["General"]['resolution']
+    gpt, output_file = env['General']['gpt_path'], gpt_job["output_file"]
+    args = [gpt, gpt_job["gpt_xml_file"], "-c", env['General']['gpt_cache_size'], "-e",
+            "-SsourceFile={}".format(gpt_job["source_file"]), "-PoutputFile={}".format(output_file)]
 
-    source_file = l1product_path
-
-    product_path = os.path.basename(source_file)
-    output_file = os.path.join(out_path, OUT_DIR, OUT_FILENAME.format(product_name))
-    l2product_files["S2RES"] = output_file
-    if os.path.isfile(output_file):
-        if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
-            log(env["General"]["log"], "Removing file: ${}".format(output_file))
+    if gpt_subprocess(args, env["General"]["log"], attempts=gpt_job["attempts"], timeout=gpt_job["timeout"]):
+        return output_file
+    else:
+        if os.path.exists(output_file):
             os.remove(output_file)
-        else:
-            log(env["General"]["log"], "Skipping S2 res, target already exists: {}".format(OUT_FILENAME.format(product_name)))
-            return output_file
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            log(env["General"]["log"], "Removed corrupted output file.", indent=2)
+        raise RuntimeError("GPT Failed.")
 
-    gpt_xml_file = os.path.join(out_path, OUT_DIR, "_reproducibility", GPT_XML_FILENAME)
-    if not os.path.isfile(gpt_xml_file):
-        rewrite_xml(gpt_xml_file, resolution)
 
-    args = [gpt, gpt_xml_file, "-c", env['General']['gpt_cache_size'], "-e",
-            "-SsourceFile={}".format(source_file), "-PoutputFile={}".format(output_file)]
+def prepare(env, params, l1product_path, l2product_files, out_path):
+    """Write the graph of this processor and return the files it reads and writes, without calling the GPT. Used by
+    process and to fuse the graphs of consecutive GPT processors."""
+
+    product_name = os.path.basename(l1product_path)
+
+    if "resolution" not in params["General"]:
+        raise RuntimeWarning('Resolution must be defined in the parameter file.')
+    resolution = params["General"]['resolution']
 
     if PARAMS_SECTION in params and "attempts" in params[PARAMS_SECTION]:
         attempts = int(params[PARAMS_SECTION]["attempts"])
@@ -61,15 +63,24 @@ def process(env, params, l1product_path, l2product_files, out_path):
     else:
         timeout = DEFAULT_TIMEOUT
 
-    if gpt_subprocess(args, env["General"]["log"], attempts=attempts, timeout=timeout):
-        return output_file
-    else:
-        if os.path.exists(output_file):
+    output_file = os.path.join(out_path, OUT_DIR, OUT_FILENAME.format(product_name))
+    l2product_files["S2RES"] = output_file
+    gpt_xml_file = os.path.join(out_path, OUT_DIR, "_reproducibility", GPT_XML_FILENAME)
+    gpt_job = {"gpt_xml_file": gpt_xml_file, "source_file": l1product_path, "output_file": output_file,
+               "exists": False, "attempts": attempts, "timeout": timeout}
+    if os.path.isfile(output_file):
+        if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
+            log(env["General"]["log"], "Removing file: ${}".format(output_file))
             os.remove(output_file)
-            log(env["General"]["log"], "Removed corrupted output file.", indent=2)
-        raise RuntimeError("GPT Failed.")
+        else:
+            log(env["General"]["log"], "Skipping S2 res, target already exists: {}".format(
+                OUT_FILENAME.format(product_name)))
+            return dict(gpt_job, exists=True)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-    return output_file
+    if not os.path.isfile(gpt_xml_file):
+        rewrite_xml(gpt_xml_file, resolution)
+    return gpt_job
 
 
 def rewrite_xml(gpt_xml_file, resolution):
@@ -11,8 +11,8 @@ import os
 import re
 import numpy as np
 
-from netCDF4 import Dataset
 from utils.auxil import log
+from utils.intermediate import get_product_path, open_product, remove_product
 from utils.product_fun import copy_nc, get_band_names_from_nc, get_name_width_height_from_nc, \
     get_satellite_name_from_product_name, get_valid_pe_from_nc, write_pixels_to_nc, create_band, read_pixels_from_nc
 
@@ -61,11 +61,11 @@ def process(env, params, l1product_path, l2product_files, out_path):
     product_path = l2product_files[processor]
     product_name = os.path.basename(product_path)
     product_dir = os.path.join(os.path.dirname(os.path.dirname(product_path)), OUT_DIR)
-    output_file = os.path.join(product_dir, OUT_FILENAME.format(product_name))
-    if os.path.isfile(output_file):
+    output_file = get_product_path(params, PARAMS_SECTION, os.path.join(product_dir, OUT_FILENAME.format(product_name)))
+    if os.path.exists(output_file):
         if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
             log(env["General"]["log"], 'Removing file: ${}'.format(output_file), indent=1)
-            os.remove(output_file)
+            remove_product(output_file)
         else:
             log(env["General"]["log"],
                 'Skipping Secchi Depth, target already exists: {}'.format(OUT_FILENAME.format(product_name)), indent=1)
@@ -73,7 +73,7 @@ def process(env, params, l1product_path, l2product_files, out_path):
     os.makedirs(product_dir, exist_ok=True)
 
     log(env["General"]["log"], 'Reading POLYMER output from {}'.format(product_path))
-    with Dataset(product_path) as src, Dataset(output_file, mode='w') as dst:
+    with open_product(product_path) as src, open_product(output_file, mode='w') as dst:
         name, width, height = get_name_width_height_from_nc(src, product_path)
         product_band_names = get_band_names_from_nc(src)
 
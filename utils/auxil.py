@@ -6,16 +6,25 @@ import socket
 import getpass
 import subprocess
 import configparser
-from threading import Timer
+from threading import Thread, Timer, local
 from datetime import datetime
 
 project_path = os.path.dirname(__file__)
 
-def init_hindcast(env_file, params_file):
-    """Initialize a sencast run with an environment file and a parameters file."""
+# The cpu time of the subprocesses started by gpt_subprocess, per thread
+child_cpu_times = local()
+# Units of the Java heap size in gpt.vmoptions (case-insensitive), in GB
+GPT_HEAP_UNITS = {"k": 1e-6, "m": 1e-3, "g": 1}
+
+def init_hindcast(env_file, params_file, params=None):
+    """
+    Initialize a sencast run with an environment file and a parameters file. If params are given, they are used
+    instead of the content of the parameters file, whose name is still used for the output folder.
+    """
     # load environment and params from file
     env, env_file, cache = load_environment(env_file)
-    params, params_file = load_params(params_file, env['General']['params_path'])
+    if params is None:
+        params, params_file = load_params(params_file, env['General']['params_path'])
 
     # create output path, if it does not exist yet
     wkt_name = params['General']['wkt_name']
@@ -37,9 +46,19 @@ def init_hindcast(env_file, params_file):
         log(log_file, "Output folder for this run already exists.")
         if "synchronise" in params["General"].keys() and params['General']['synchronise'] == "false":
             log(log_file, "Overwriting existing run")
+        elif "synchronise" in params["General"].keys() and params['General']['synchronise'] == "provenance":
+            log(log_file, "Updating existing run, outputs whose params, code or inputs changed will be recomputed")
+            if not params['General']['wkt']:
+                params['General']['wkt'], _ = load_wkt("{}.wkt".format(wkt_name), env['General']['wkt_path'])
+            with open(os.path.join(out_path, os.path.basename(params_file)), "w") as f:
+                params.write(f)
         else:
             log(log_file, "Reading params from output folder to ensure comparable results.")
+            search = params['General'].get('search')
             params, params_file = load_params(os.path.join(out_path, os.path.basename(params_file)))
+            # the search mode is taken from the current params, so that recorded searches can be replayed
+            if search is not None:
+                params['General']['search'] = search
         if not params['General']['wkt']:
             params['General']['wkt'], _ = load_wkt("{}.wkt".format(wkt_name), env['General']['wkt_path'])
     else:
@@ -104,6 +123,44 @@ def load_params(params_file, params_path=os.path.join(project_path, "../paramete
     return params, params_file
 
 
+def load_sweep(sweep_file, params_path=os.path.join(project_path, "../parameters")):
+    """
+    Read a sweep from a ini file. Returns the name of its parameters file and separate params for every combination of
+    perimeter and period, the parameters file itself is never changed.
+    """
+    if not os.path.isabs(sweep_file) and params_path:
+        sweep_file = os.path.join(params_path, sweep_file)
+    if not os.path.isfile(sweep_file):
+        raise RuntimeError("The sweep file could not be found: {}".format(os.path.abspath(sweep_file)))
+    sweep = configparser.ConfigParser()
+    sweep.read(sweep_file)
+    template, params_file = load_params(sweep['Sweep']['params'], params_path)
+
+    wkt_names = list(filter(None, sweep['Sweep'].get('wkt_names', template['General']['wkt_name']).replace(" ", "")
+                            .split(",")))
+    periods = []
+    for date in filter(None, sweep['Sweep'].get('dates', "").replace(" ", "").split(",")):
+        periods.append(("{}T00:00:00.000Z".format(date), "{}T23:59:59.999Z".format(date)))
+    for period in filter(None, sweep['Sweep'].get('periods', "").replace(" ", "").split(",")):
+        start, end = period.split("/")
+        periods.append((start, end))
+    if not periods:
+        periods.append((template['General']['start'], template['General']['end']))
+
+    combinations = []
+    for start, end in periods:
+        for wkt_name in wkt_names:
+            params = configparser.ConfigParser()
+            params.read_dict({section: dict(template.items(section, raw=True)) for section in template.sections()})
+            if 'wkt_names' in sweep['Sweep']:
+                params['General']['wkt_name'] = wkt_name
+                params['General']['wkt'] = ""
+            params['General']['start'] = start
+            params['General']['end'] = end
+            combinations.append(params)
+    return params_file, combinations
+
+
 def load_wkt(wkt_file, wkt_path=os.path.join(project_path, "../wkt")):
     """Read the perimeter from a given wkt file."""
     if not os.path.isabs(wkt_file) and wkt_path:
@@ -130,7 +187,8 @@ def gpt_subprocess(cmd, log_path, attempts=1, timeout=False):
         if attempts != 1 and timeout:
             timer = Timer(timeout, process.kill)
             timer.start()
-        res = process.communicate()
+        res, cpu_time = communicate_with_cpu_time(process)
+        child_cpu_times.seconds = get_child_cpu_time() + cpu_time
         if attempts != 1 and timeout:
             timer.cancel()
         if process.returncode == 0:
@@ -149,20 +207,34 @@ def gpt_subprocess(cmd, log_path, attempts=1, timeout=False):
     return False
 
 
+def communicate_with_cpu_time(process):
+    """Wait for a process like communicate and return its output and the cpu time (user and system) it and its waited
+    for children used. Returns no cpu time where os.wait4 is not available."""
+    if not hasattr(os, "wait4"):
+        return process.communicate(), 0
+    outputs = {}
+    readers = [Thread(target=lambda name, pipe: outputs.update({name: pipe.read()}), args=(name, pipe))
+               for name, pipe in [("stdout", process.stdout), ("stderr", process.stderr)]]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    process.stdout.close()
+    process.stderr.close()
+    return (outputs["stdout"], outputs["stderr"]), rusage.ru_utime + rusage.ru_stime
+
+
+def get_child_cpu_time():
+    """Return the cpu time of the subprocesses which gpt_subprocess ran in the current thread so far."""
+    return getattr(child_cpu_times, "seconds", 0.0)
+
+
 def set_gpt_cache_size(env):
     """Set the GPT cache size, if not set."""
     if not env['General']['gpt_cache_size']:
-        heap_size = ""
-        with open(os.path.join(os.path.dirname(env['General']['gpt_path']), "gpt.vmoptions"), "rt") as f:
-            for line in f:
-                if line.startswith(r"-Xmx"):
-                    heap_size = line.replace(r"-Xmx", "")
-                    if "m" in heap_size:
-                        heap_size = float(heap_size.replace(r"m", ""))/1000
-                    elif "G" in heap_size:
-                        heap_size = float(heap_size.replace(r"G", ""))
-                    elif "g" in heap_size:
-                        heap_size = float(heap_size.replace(r"g", ""))
+        heap_size = get_gpt_heap_size(env)
         if not heap_size:
             raise RuntimeError("Could not read heap size from GPT vmoptions. Set it in your env file!")
         cache_size = str(int(round(int(heap_size) * 0.7, 0,))) + "G"
@@ -170,6 +242,20 @@ def set_gpt_cache_size(env):
     return env['General']['gpt_cache_size']
 
 
+def get_gpt_heap_size(env):
+    """Return the Java heap size of GPT in GB from gpt.vmoptions, or an empty string if it is not set."""
+    heap_size = ""
+    with open(os.path.join(os.path.dirname(env['General']['gpt_path']), "gpt.vmoptions"), "rt") as f:
+        for line in f:
+            if line.startswith(r"-Xmx"):
+                heap_size = line.replace(r"-Xmx", "").strip()
+                if heap_size[-1:].lower() in GPT_HEAP_UNITS:
+                    heap_size = float(heap_size[:-1]) * GPT_HEAP_UNITS[heap_size[-1].lower()]
+                else:
+                    heap_size = float(heap_size) / 1e9
+    return heap_size
+
+
 def load_properties(properties_file, separator_char='=', comment_char='#'):
     """ Read a properties file into a dict. """
     properties_dict = {}
@@ -4,15 +4,26 @@
 """Nasa Earth Data API
 
 Documentation for Nasa Earth Data API can be found `here. <https://wiki.earthdata.nasa.gov/display/EL/How+To+Access+Data+With+Python>`_
+
+The session cookies of Earthdata Login are kept in a file based cookie jar in the cache directory of the EARTHDATA
+section ('cache_path', defaults to 'root_path'), which is shared by all threads and reused by later runs and spawned
+workers, so they do not have to log in again.
 """
 
 __author__ = 'Daniel'
 
-from http.cookiejar import CookieJar
+import os
 import urllib.request
-
+from http.cookiejar import LoadError, MozillaCookieJar
+from threading import Lock
 
 api_endpoint = "https://oceandata.sci.gsfc.nasa.gov/cgi/getfile/"
+# Host of Earthdata Login, the only host which receives the credentials
+urs_host = "urs.earthdata.nasa.gov"
+# The name of the cookie jar file in the cache directory
+COOKIE_FILENAME = "earthdata_cookies.txt"
+
+cookie_jar, cookie_lock = None, Lock()
 
 
 def authenticate(env):
@@ -22,17 +33,59 @@ def authenticate(env):
     # Create a password manager to deal with the 401 reponse that is returned from
     # Earthdata Login
     password_manager = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-    password_manager.add_password(None, "https://urs.earthdata.nasa.gov", env['EARTHDATA']['username'], env['EARTHDATA']['password'])
+    password_manager.add_password(None, "https://" + urs_host, env['EARTHDATA']['username'],
+                                  env['EARTHDATA']['password'])
 
-    # Create a cookie jar for storing cookies. This is used to store and return
-    # the session cookie given to use by the data server (otherwise it will just
-    # keep sending us back to Earthdata Login to authenticate).  Ideally, we
-    # should use a file based cookie jar to preserve cookies between runs. This
-    # will make it much more efficient.
-    cookie_jar = CookieJar()
+    # The cookie jar stores and returns the session cookie given to us by the data server (otherwise it will just keep
+    # sending us back to Earthdata Login to authenticate). It is saved to a file to preserve cookies between runs.
+    jar = get_cookie_jar(env)
 
     # Install all the handlers.
     opener = urllib.request.build_opener(
         urllib.request.HTTPBasicAuthHandler(password_manager),
-        urllib.request.HTTPCookieProcessor(cookie_jar))
+        PersistentCookieProcessor(jar))
     urllib.request.install_opener(opener)
+
+
+def get_cookie_file(env):
+    cache_path = env['EARTHDATA'].get('cache_path', env['EARTHDATA']['root_path'])
+    return os.path.join(cache_path, COOKIE_FILENAME)
+
+
+def get_cookie_jar(env):
+    """Return the cookie jar of the process, loaded from the cookie file of the environment if it exists."""
+    global cookie_jar
+    cookie_file = get_cookie_file(env)
+    with cookie_lock:
+        if cookie_jar is None or cookie_jar.filename != cookie_file:
+            cookie_jar = MozillaCookieJar(cookie_file)
+            if os.path.isfile(cookie_file):
+                try:
+                    cookie_jar.load(ignore_discard=True)
+                except (LoadError, OSError):
+                    cookie_jar.clear()
+        return cookie_jar
+
+
+def save_cookies():
+    """Save the cookie jar, through a temporary file so that concurrent runs never read a partial file."""
+    with cookie_lock:
+        if cookie_jar is None:
+            return
+        os.makedirs(os.path.dirname(cookie_jar.filename), exist_ok=True)
+        temp_file = "{}.{}.incomplete".format(cookie_jar.filename, os.getpid())
+        cookie_jar.save(temp_file, ignore_discard=True)
+        os.replace(temp_file, cookie_jar.filename)
+
+
+class PersistentCookieProcessor(urllib.request.HTTPCookieProcessor):
+    """Saves the cookie jar whenever a response sets cookies."""
+
+    def http_response(self, request, response):
+        response = super().http_response(request, response)
+        if response.headers.get_all("Set-Cookie"):
+            save_cookies()
+        return response
+
+    https_response = http_response
+
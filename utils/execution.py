@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Execution backends for processor calls. Processors run 'inline' in the thread of their product group by default. The
+'thread' backend runs them in a shared thread pool and the 'process' backend in a pool of spawned python processes,
+which lets GIL-bound numpy processors of different product groups run truly in parallel. The backend is selected with
+the 'backend' key in the params section of a processor, or for all processors in the General section.
+"""
+
+import configparser
+import importlib
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from threading import Lock
+
+from utils import earthdata
+from utils.auxil import get_child_cpu_time
+from utils.intermediate import merge_io_stats, pop_io_stats
+
+# Available execution backends for processors
+EXECUTION_BACKENDS = ["inline", "thread", "process"]
+DEFAULT_EXECUTION_BACKEND = "inline"
+
+
+def get_execution_backend(params, processor):
+    """Read the execution backend of a processor from its params section, falling back to the General section."""
+    backend = params['General'].get("backend", DEFAULT_EXECUTION_BACKEND)
+    if params.has_section(processor.upper()):
+        backend = params[processor.upper()].get("backend", backend)
+    backend = backend.strip().lower() or DEFAULT_EXECUTION_BACKEND
+    if backend not in EXECUTION_BACKENDS:
+        raise RuntimeError("Unknown execution backend {}, use one of: {}".format(
+            backend, ", ".join(EXECUTION_BACKENDS)))
+    return backend
+
+
+def config_to_dict(config):
+    """Convert a ConfigParser into a dictionary of sections, which can be passed to other processes."""
+    return {section: dict(config[section]) for section in config.sections()}
+
+
+def config_from_dict(config_dict):
+    """Rebuild a ConfigParser from a dictionary of sections. The values are already interpolated."""
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_dict(config_dict)
+    return config
+
+
+def run_processor(processor, env, params, l1product_path, l2product_files, l2_path):
+    """Run the process function of a processor and return its output file and the cpu time used by the caller and by
+    the GPT subprocesses it ran."""
+    process = getattr(importlib.import_module("processors.{}.{}".format(processor.lower(), processor.lower())),
+                      "process")
+    start, child_start = time.thread_time(), get_child_cpu_time()
+    output_file = process(env, params, l1product_path, l2product_files, l2_path)
+    return output_file, time.thread_time() - start + get_child_cpu_time() - child_start
+
+
+def run_processor_in_process(processor, env_dict, params_dict, l1product_path, l2product_files, l2_path):
+    """Entry point of processor calls in a worker process. The worker runs one processor at a time, the I/O counters of
+    its intermediate products are returned with the result, since they are not shared with the process of the run."""
+    env, params = config_from_dict(env_dict), config_from_dict(params_dict)
+    # the earthdata url opener is installed per interpreter and must be set up again in spawned workers
+    if env.has_section("EARTHDATA"):
+        earthdata.authenticate(env)
+    start, child_start = time.process_time(), get_child_cpu_time()
+    output_file, _ = run_processor(processor, env, params, l1product_path, l2product_files, l2_path)
+    return (output_file, time.process_time() - start + get_child_cpu_time() - child_start) + pop_io_stats()
+
+
+class ExecutionBackends(object):
+    """Pools for the thread and process backends, created lazily and shared by all product groups of a run."""
+
+    def __init__(self, max_workers=1):
+        self.max_workers = max_workers
+        self.executors = {}
+        self.lock = Lock()
+
+    def get_executor(self, backend):
+        with self.lock:
+            if backend not in self.executors:
+                if backend == "process":
+                    self.executors[backend] = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                                  mp_context=get_context("spawn"))
+                else:
+                    self.executors[backend] = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                 thread_name_prefix="Processor")
+            return self.executors[backend]
+
+    def run(self, backend, processor, env, params, l1product_path, l2product_files, l2_path):
+        """Run a processor on the given backend and return its output file and cpu time in seconds."""
+        if backend == "inline":
+            return run_processor(processor, env, params, l1product_path, l2product_files, l2_path)
+        elif backend == "process":
+            future = self.get_executor(backend).submit(run_processor_in_process, processor, config_to_dict(env),
+                                                       config_to_dict(params), l1product_path, dict(l2product_files),
+                                                       l2_path)
+            output_file, cpu_time, io_stats, seconds_per_byte = future.result()
+            merge_io_stats(io_stats, seconds_per_byte)
+            return output_file, cpu_time
+        else:
+            future = self.get_executor(backend).submit(run_processor, processor, env, params, l1product_path,
+                                                       l2product_files, l2_path)
+        return future.result()
+
+    def shutdown(self):
+        with self.lock:
+            for executor in self.executors.values():
+                executor.shutdown(wait=True)
+            self.executors = {}
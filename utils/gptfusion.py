@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fusion of the graphs of consecutive GPT processors (e.g. IDEPIX and C2RCC with 'processor=IDEPIX', or S2RES and C2RCC
+with 'processor=S2RES'), enabled with 'gpt_fusion=True'. The graphs of the chain are spliced into one graph which runs
+in a single GPT call, so intermediate products are passed in memory instead of being written by one JVM and read back
+by the next. The spliced graph writes the outputs of the last processor, of all processors which are deliverables and of
+all processors whose output is read by a processor outside the chain or by an adapter. If only the processors whose
+outputs are not written remain to be run for a product, they are skipped.
+
+Processors can be fused if they have a prepare function, which writes their graph and returns the files they read and
+write. A processor is only fused with its predecessor if it reads the output of that predecessor.
+"""
+
+import importlib
+import os
+import xml.etree.ElementTree as ElementTree
+
+from utils.auxil import gpt_subprocess, log
+from utils.intermediate import is_deliverable
+
+# A pattern for the name of a fused graph (completed with the processor names and the product name)
+FUSED_XML_FILENAME = "fused_{}_{}.xml"
+# The placeholder of the source product in the graphs of the processors
+SOURCE_PLACEHOLDER = "${sourceFile}"
+
+
+def is_gpt_fusion_enabled(params):
+    return "gpt_fusion" in params["General"] and params["General"]["gpt_fusion"] == "True"
+
+
+def get_prepare(processor):
+    """Return the prepare function of a processor, or None if it cannot be fused."""
+    module = importlib.import_module("processors.{}.{}".format(processor.lower(), processor.lower()))
+    return getattr(module, "prepare", None)
+
+
+def get_fusion_chain(params, processor):
+    """Return the processor and all following processors of the params which can be fused with it, or an empty list if
+    there are none."""
+    processors = list(filter(None, params['General']['processors'].split(",")))
+    chain = []
+    for candidate in processors[processors.index(processor):]:
+        if get_prepare(candidate) is None:
+            break
+        chain.append(candidate)
+    return chain if len(chain) > 1 else []
+
+
+def is_output_read(params, processor, chain):
+    """Return if the output of a processor is read by a configured processor outside the chain or by an adapter."""
+    name = processor.lower()
+    processors = list(filter(None, params['General']['processors'].split(",")))
+    readers = [reader for reader in processors if reader not in chain]
+    readers += list(filter(None, params['General'].get('adapters', "").split(","))) + ["COMPOSITE", "TIMESERIES"]
+    for reader in readers:
+        if not params.has_section(reader):
+            continue
+        for key, value in params[reader].items():
+            if key == name or key.startswith(name + "_"):
+                return True
+            if (key == "processor" or key.endswith("_processor") or key == "products") and \
+                    name in value.lower().replace(" ", "").split(","):
+                return True
+    return False
+
+
+def run_fused_graph(env, params, chain, l1product_path, l2product_files, l2_path):
+    """
+    Prepare the processors of a chain and run those which read the output of their predecessor as one fused graph.
+    Returns the output file of each processor which was run, None for processors whose output was not written, or an
+    empty dictionary if fewer than two processors can be fused, in which case the processors must be run on their own.
+    """
+    if len(chain) < 2:
+        return {}
+    planned_files, gpt_jobs = dict(l2product_files), []
+    for processor in chain:
+        try:
+            gpt_job = get_prepare(processor)(env, params, l1product_path, planned_files, l2_path)
+        except (Exception, ):
+            if not gpt_jobs:
+                raise
+            break
+        if gpt_jobs and gpt_job["source_file"] != gpt_jobs[-1][1]["output_file"]:
+            break
+        if gpt_job["exists"]:
+            # outputs which would only have been passed on to an existing output need not be computed again
+            processors = [job_processor for job_processor, _ in gpt_jobs] + [processor]
+            if gpt_jobs and not any(is_deliverable(params, job_processor) or
+                                    is_output_read(params, job_processor, processors)
+                                    for job_processor, _ in gpt_jobs):
+                log(env["General"]["log"], "Output of {} exists, skipping {}.".format(
+                    processor, ", ".join(processors[:-1])), indent=1)
+                outputs = {job_processor: None for job_processor, _ in gpt_jobs}
+                outputs[processor] = gpt_job["output_file"]
+                return outputs
+            break
+        gpt_jobs.append((processor, gpt_job))
+        planned_files[processor] = gpt_job["output_file"]
+    if len(gpt_jobs) < 2:
+        return {}
+
+    processors = [processor for processor, _ in gpt_jobs]
+    last_job = gpt_jobs[-1][1]
+    fused_xml_file = os.path.join(os.path.dirname(last_job["gpt_xml_file"]), FUSED_XML_FILENAME.format(
+        "_".join(processors), os.path.basename(l1product_path)))
+    written = [processor == processors[-1] or is_deliverable(params, processor) or
+               is_output_read(params, processor, processors) for processor in processors]
+    splice_graphs(fused_xml_file, [job["gpt_xml_file"] for _, job in gpt_jobs],
+                  [job["output_file"] for _, job in gpt_jobs], processors, written)
+    log(env["General"]["log"], "Running {} as one fused graph.".format(", ".join(processors)), indent=1)
+
+    gpt = env['General']['gpt_path']
+    if "gpt_use_default" in env['General'] and env['General']['gpt_use_default'] == "True":
+        args = [gpt, fused_xml_file, "-SsourceFile={}".format(gpt_jobs[0][1]["source_file"])]
+    else:
+        args = [gpt, fused_xml_file, "-c", env['General']['gpt_cache_size'], "-e",
+                "-SsourceFile={}".format(gpt_jobs[0][1]["source_file"])]
+    attempts = max(job["attempts"] for _, job in gpt_jobs)
+    timeout = max(job["timeout"] for _, job in gpt_jobs) or False
+    if not gpt_subprocess(args, env["General"]["log"], attempts=attempts, timeout=timeout):
+        for _, gpt_job in gpt_jobs:
+            if os.path.exists(gpt_job["output_file"]):
+                os.remove(gpt_job["output_file"])
+                log(env["General"]["log"], "Removed corrupted output file.", indent=2)
+        raise RuntimeError("GPT Failed.")
+    return {processor: gpt_job["output_file"] if write else None
+            for (processor, gpt_job), write in zip(gpt_jobs, written)}
+
+
+def splice_graphs(fused_xml_file, gpt_xml_files, output_files, processors, written):
+    """
+    Splice the graphs of a chain into one graph. Node ids are prefixed with the processor name, the source placeholder
+    of each graph is replaced by the node which feeds the write node of the previous graph, and the write nodes write
+    to the output files of their processors or are dropped if their output is not written.
+    """
+    fused = ElementTree.Element("graph", id="fused")
+    ElementTree.SubElement(fused, "version").text = "1.0"
+    previous = None
+    for gpt_xml_file, output_file, processor, write in zip(gpt_xml_files, output_files, processors, written):
+        nodes = ElementTree.parse(gpt_xml_file).getroot().findall("node")
+        node_ids = set(node.get("id") for node in nodes)
+        prefix = "{}_".format(processor.lower())
+        write_nodes = [node for node in nodes if node.findtext("operator", "").strip().lower() == "write"]
+        if len(write_nodes) != 1:
+            raise RuntimeError("Cannot fuse graph {}, it must have exactly one write node.".format(gpt_xml_file))
+        for node in nodes:
+            node.set("id", prefix + node.get("id"))
+            sources = node.find("sources")
+            for source in (sources if sources is not None else []):
+                if source.get("refid") in node_ids:
+                    source.set("refid", prefix + source.get("refid"))
+                text = (source.text or "").strip()
+                if text in node_ids:
+                    source.text = prefix + text
+                elif text == SOURCE_PLACEHOLDER and previous is not None:
+                    source.text = previous
+        write_node = write_nodes[0]
+        write_node.find("parameters/file").text = output_file
+        write_source = write_node.find("sources")[0]
+        previous = write_source.get("refid") or write_source.text.strip()
+        for node in nodes:
+            if node is not write_node or write:
+                fused.append(node)
+
+    os.makedirs(os.path.dirname(fused_xml_file), exist_ok=True)
+    with open(fused_xml_file, "w") as f:
+        f.write(ElementTree.tostring(fused, encoding="unicode"))
@@ -0,0 +1,335 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Intermediate products for chains of python processors (e.g. POLYMER -> OC3 -> PRIMARYPRODUCTION). With
+'intermediate=npy', the outputs of processors which are not listed as deliverables are written as a directory with one
+uncompressed .npy file per variable and a json file with the dimensions and attributes, instead of a compressed NetCDF.
+The next processor memory-maps the bands it reads, so the chain skips compressing and decompressing them.
+
+NpyProduct implements the part of the netCDF4.Dataset interface which is used by the python processors and the
+functions in utils.product_fun, and open_product returns either of them depending on the product path.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from threading import Lock
+
+import numpy as np
+from netCDF4 import Dataset
+
+from utils.auxil import log
+
+# Formats for chain-internal products
+INTERMEDIATE_FORMATS = ["netcdf", "npy"]
+DEFAULT_INTERMEDIATE_FORMAT = "netcdf"
+# The extension which replaces '.nc' in the path of an intermediate product
+INTERMEDIATE_EXTENSION = ".npyd"
+# The name of the file with dimensions and attributes in an intermediate product
+METADATA_FILENAME = "product.json"
+# A pattern for the name of the file of a variable in an intermediate product (completed with variable name)
+VARIABLE_FILENAME = "{}.npy"
+
+# I/O counters of the intermediate products by product path, collected per run by log_io_report
+io_stats, io_stats_lock = {}, Lock()
+# Time to write and read a byte as compressed NetCDF, measured once per process
+netcdf_io = {"seconds_per_byte": None}
+
+
+def get_intermediate_format(params):
+    intermediate_format = params["General"].get("intermediate", DEFAULT_INTERMEDIATE_FORMAT).lower()
+    if intermediate_format not in INTERMEDIATE_FORMATS:
+        raise RuntimeError("Unknown intermediate format {}, use one of: {}".format(
+            intermediate_format, ", ".join(INTERMEDIATE_FORMATS)))
+    return intermediate_format
+
+
+def is_deliverable(params, processor):
+    """Processors are deliverables unless a list of deliverables is given which does not contain them."""
+    if "deliverables" not in params["General"] or not params["General"]["deliverables"].strip():
+        return True
+    return processor.upper() in params["General"]["deliverables"].upper().replace(" ", "").split(",")
+
+
+def get_product_path(params, processor, output_file):
+    """Return the path to which a python processor writes its output, which is an intermediate product if enabled."""
+    if get_intermediate_format(params) == "npy" and not is_deliverable(params, processor):
+        return "{}{}".format(os.path.splitext(output_file)[0], INTERMEDIATE_EXTENSION)
+    return output_file
+
+
+def is_intermediate(product_path):
+    return product_path.endswith(INTERMEDIATE_EXTENSION)
+
+
+def open_product(product_path, mode='r'):
+    """Open a product for reading ('r') or writing ('w'), as NpyProduct or netCDF4.Dataset depending on its path."""
+    if is_intermediate(product_path):
+        return NpyProduct(product_path, mode)
+    return Dataset(product_path, mode=mode)
+
+
+def remove_product(product_path):
+    if os.path.isdir(product_path):
+        shutil.rmtree(product_path)
+    elif os.path.isfile(product_path):
+        os.remove(product_path)
+
+
+def add_io(product_path, nbytes, seconds, product=False):
+    with io_stats_lock:
+        counters = io_stats.setdefault(product_path, {"products": 0, "bytes": 0, "seconds": 0.0})
+        counters["bytes"] += nbytes
+        counters["seconds"] += seconds
+        counters["products"] += 1 if product else 0
+
+
+def pop_io_stats(l2_path=None):
+    """Remove and return the I/O counters of the intermediate products in an output folder (of all products if None)
+    and the measured NetCDF I/O time per byte. Worker processes return them to the process of the run."""
+    root = None if l2_path is None else os.path.join(os.path.abspath(l2_path), "")
+    with io_stats_lock:
+        paths = [path for path in io_stats if root is None or os.path.abspath(path).startswith(root)]
+        return {path: io_stats.pop(path) for path in paths}, netcdf_io["seconds_per_byte"]
+
+
+def merge_io_stats(stats, seconds_per_byte):
+    """Add the I/O counters returned by a worker process to the counters of this process."""
+    with io_stats_lock:
+        for path, counters in stats.items():
+            merged = io_stats.setdefault(path, {"products": 0, "bytes": 0, "seconds": 0.0})
+            for key, value in counters.items():
+                merged[key] += value
+        if netcdf_io["seconds_per_byte"] is None:
+            netcdf_io["seconds_per_byte"] = seconds_per_byte
+
+
+def log_io_report(env, l2_path):
+    """Log the time spent on the intermediate products of a run and an estimate of the time the same I/O would take as
+    NetCDF. The counters of the run are reset."""
+    run_stats, seconds_per_byte = pop_io_stats(l2_path)
+    stats = {key: sum(counters[key] for counters in run_stats.values()) for key in ["products", "bytes", "seconds"]}
+    if not stats["products"]:
+        return
+    message = "Intermediate products: {} written, {:.1f} MB read and written in {:.1f} seconds.".format(
+        stats["products"], stats["bytes"] / 1e6, stats["seconds"])
+    if seconds_per_byte is not None:
+        netcdf_seconds = stats["bytes"] * seconds_per_byte
+        message += " As compressed NetCDF this is estimated at {:.1f} seconds, {:.1f} seconds saved.".format(
+            netcdf_seconds, netcdf_seconds - stats["seconds"])
+    log(env["General"]["log"], message, indent=1)
+
+
+def calibrate_netcdf_io(array):
+    """Measure once per process how long writing and reading an array as compressed NetCDF takes per byte."""
+    with io_stats_lock:
+        if netcdf_io["seconds_per_byte"] is not None or array.ndim != 2 or not array.size:
+            return
+    with tempfile.TemporaryDirectory() as temp_dir:
+        starttime = time.time()
+        with Dataset(os.path.join(temp_dir, "calibration.nc"), mode='w') as dst:
+            dst.createDimension('lat', array.shape[0])
+            dst.createDimension('lon', array.shape[1])
+            dst.createVariable('band', array.dtype, ('lat', 'lon'), zlib=True, complevel=6)
+            dst['band'][:] = array
+        with Dataset(os.path.join(temp_dir, "calibration.nc")) as src:
+            src['band'][:]
+        seconds_per_byte = (time.time() - starttime) / (2 * array.nbytes)
+    with io_stats_lock:
+        netcdf_io["seconds_per_byte"] = seconds_per_byte
+
+
+def to_json_value(value):
+    return value.tolist() if hasattr(value, "tolist") else value
+
+
+class NpyDimension(object):
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def isunlimited(self):
+        return False
+
+
+class NpyVariable(object):
+    """A variable of an intermediate product, its attributes are read and set like those of a netCDF4.Variable."""
+
+    def __init__(self, product_path, dimensions, dtype, attributes, data):
+        object.__setattr__(self, "_product_path", product_path)
+        object.__setattr__(self, "_dimensions", tuple(dimensions))
+        object.__setattr__(self, "_attributes", dict(attributes))
+        object.__setattr__(self, "_data", data)
+        object.__setattr__(self, "_dtype", np.dtype(dtype))
+
+    @property
+    def __dict__(self):
+        return dict(self._attributes)
+
+    def __getattr__(self, name):
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._attributes[name] = value
+
+    @property
+    def dimensions(self):
+        return self._dimensions
+
+    @property
+    def shape(self):
+        return self._data.shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def datatype(self):
+        return self._dtype
+
+    def ncattrs(self):
+        return list(self._attributes.keys())
+
+    def setncatts(self, attributes):
+        self._attributes.update(attributes)
+
+    def __getitem__(self, key):
+        starttime = time.time()
+        values = np.array(self._data[to_orthogonal_key(key)])
+        add_io(self._product_path, values.nbytes, time.time() - starttime)
+        return values
+
+    def __setitem__(self, key, values):
+        starttime = time.time()
+        values = np.ma.filled(values, self._attributes.get("_FillValue", np.nan)) if np.ma.isMaskedArray(values) \
+            else values
+        self._data[to_orthogonal_key(key)] = values
+        add_io(self._product_path, np.asarray(values).nbytes, time.time() - starttime)
+
+
+def to_orthogonal_key(key):
+    """Convert ranges in an index to slices, netCDF4 indexes ranges orthogonally while numpy combines them pointwise."""
+    if not isinstance(key, tuple):
+        key = (key, )
+    return tuple(slice(item.start, item.stop, item.step) if isinstance(item, range) else item for item in key)
+
+
+class NpyProduct(object):
+    """
+    An intermediate product. Written products are created in a temporary directory which is moved to the product path
+    when the product is closed, so interrupted processors do not leave incomplete products behind.
+    """
+
+    def __init__(self, product_path, mode='r'):
+        object.__setattr__(self, "_product_path", product_path)
+        object.__setattr__(self, "_mode", mode)
+        object.__setattr__(self, "_attributes", {})
+        object.__setattr__(self, "_starttime", time.time())
+        object.__setattr__(self, "dimensions", {})
+        object.__setattr__(self, "variables", {})
+        if mode == 'w':
+            object.__setattr__(self, "_path", "{}.incomplete".format(product_path))
+            remove_product(self._path)
+            os.makedirs(self._path)
+        elif mode == 'r':
+            object.__setattr__(self, "_path", product_path)
+            with open(os.path.join(product_path, METADATA_FILENAME), "r") as f:
+                metadata = json.load(f)
+            self._attributes.update(metadata["attributes"])
+            for name, size in metadata["dimensions"].items():
+                self.dimensions[name] = NpyDimension(size)
+            for name, variable in metadata["variables"].items():
+                data = np.load(os.path.join(product_path, VARIABLE_FILENAME.format(name)),
+                               mmap_mode='r' if len(variable["dimensions"]) >= 2 else None)
+                self.variables[name] = NpyVariable(product_path, variable["dimensions"], variable["dtype"],
+                                                   variable["attributes"], data)
+        else:
+            raise RuntimeError("Intermediate products can only be opened for reading or writing, not {}".format(mode))
+
+    @property
+    def __dict__(self):
+        return dict(self._attributes)
+
+    def __getattr__(self, name):
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._attributes[name] = value
+
+    def __getitem__(self, name):
+        return self.variables[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self._mode == 'w':
+            remove_product(self._path)
+        self.close()
+
+    def ncattrs(self):
+        return list(self._attributes.keys())
+
+    def setncatts(self, attributes):
+        self._attributes.update(attributes)
+
+    def createDimension(self, name, size=None):
+        if size is None:
+            raise RuntimeError("Intermediate products do not support unlimited dimensions.")
+        self.dimensions[name] = NpyDimension(size)
+        return self.dimensions[name]
+
+    def createVariable(self, name, datatype, dimensions=(), fill_value=None, **kwargs):
+        """Create a variable, compression and chunking arguments are ignored as intermediate products are raw."""
+        dtype = np.dtype(datatype)
+        shape = tuple(len(self.dimensions[dimension]) for dimension in dimensions)
+        if len(shape) >= 2:
+            data = np.lib.format.open_memmap(os.path.join(self._path, VARIABLE_FILENAME.format(name)), mode='w+',
+                                             dtype=dtype, shape=shape)
+        else:
+            data = np.zeros(shape, dtype=dtype)
+        attributes = {}
+        if fill_value is not None:
+            data[...] = fill_value
+            attributes["_FillValue"] = fill_value
+        self.variables[name] = NpyVariable(self._product_path, dimensions, dtype, attributes, data)
+        return self.variables[name]
+
+    def close(self):
+        if self._mode != 'w' or not os.path.isdir(self._path):
+            return
+        starttime, nbytes, largest = time.time(), 0, None
+        metadata = {"attributes": {key: to_json_value(value) for key, value in self._attributes.items()},
+                    "dimensions": {name: len(dimension) for name, dimension in self.dimensions.items()},
+                    "variables": {}}
+        for name, variable in self.variables.items():
+            if isinstance(variable._data, np.memmap):
+                variable._data.flush()
+                if largest is None or variable._data.nbytes > largest.nbytes:
+                    largest = variable._data
+            else:
+                np.save(os.path.join(self._path, VARIABLE_FILENAME.format(name)), variable._data)
+            nbytes += variable._data.nbytes
+            metadata["variables"][name] = {
+                "dimensions": list(variable.dimensions), "dtype": variable.dtype.str,
+                "attributes": {key: to_json_value(value) for key, value in variable.__dict__.items()}}
+        with open(os.path.join(self._path, METADATA_FILENAME), "w") as f:
+            json.dump(metadata, f, indent=1)
+        remove_product(self._product_path)
+        os.replace(self._path, self._product_path)
+        add_io(self._product_path, nbytes, time.time() - starttime, product=True)
+        if largest is not None:
+            calibrate_netcdf_io(np.array(largest))
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local state of the near-real-time daemon, stored in a SQLite file. It remembers when each lake was last polled and
+which products have been seen, scheduled and processed, how often their processing failed, and derives latency
+metrics per lake from it.
+"""
+
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from utils.product_fun import get_sensing_time
+
+PRODUCT_STATES = ["scheduled", "done", "failed"]
+
+
+class NRTState(object):
+    """Poll times and products per lake. Lakes are identified by the name of their parameter file."""
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+        with closing(self.connect()) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS polls (lake TEXT PRIMARY KEY, last_poll REAL NOT NULL)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS products (lake TEXT NOT NULL, product_name TEXT NOT NULL, "
+                "download_request TEXT NOT NULL, product_group TEXT NOT NULL, sensing_time REAL, first_seen REAL, "
+                "processed REAL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (lake, product_name))")
+            # state files of earlier versions do not count the failed attempts
+            if "attempts" not in [row[1] for row in connection.execute("PRAGMA table_info(products)")]:
+                connection.execute("ALTER TABLE products ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+    def connect(self):
+        return sqlite3.connect(self.state_file, timeout=60, isolation_level=None)
+
+    def get_last_poll(self, lake):
+        """Return the time of the last poll of a lake in seconds since the epoch, or None if it was never polled."""
+        with closing(self.connect()) as connection:
+            row = connection.execute("SELECT last_poll FROM polls WHERE lake = ?", (lake, )).fetchone()
+        return None if row is None else row[0]
+
+    def set_last_poll(self, lake, last_poll):
+        with closing(self.connect()) as connection:
+            connection.execute("INSERT OR REPLACE INTO polls (lake, last_poll) VALUES (?, ?)", (lake, last_poll))
+
+    def get_product_names(self, lake):
+        with closing(self.connect()) as connection:
+            return set(row[0] for row in connection.execute("SELECT product_name FROM products WHERE lake = ?",
+                                                            (lake, )))
+
+    def get_group_products(self, lake, product_group):
+        """Return the download requests and product names of all known products of a product group."""
+        with closing(self.connect()) as connection:
+            rows = connection.execute("SELECT download_request, product_name FROM products WHERE lake = ? AND "
+                                      "product_group = ? ORDER BY product_name", (lake, product_group)).fetchall()
+        return [json.loads(row[0]) for row in rows], [row[1] for row in rows]
+
+    def add_product(self, lake, product_name, download_request, product_group):
+        with closing(self.connect()) as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO products (lake, product_name, download_request, product_group, sensing_time, "
+                "first_seen, status) VALUES (?, ?, ?, ?, ?, ?, 'scheduled')",
+                (lake, product_name, json.dumps(download_request), product_group, get_sensing_time(product_name),
+                 time.time()))
+
+    def get_pending_groups(self, lake, max_attempts):
+        """Return the product groups of a lake with products which are scheduled (also by a daemon which was stopped),
+        or which failed fewer than max_attempts times."""
+        with closing(self.connect()) as connection:
+            return set(row[0] for row in connection.execute(
+                "SELECT DISTINCT product_group FROM products WHERE lake = ? AND (status = 'scheduled' OR "
+                "(status = 'failed' AND attempts < ?))", (lake, max_attempts)))
+
+    def set_products_status(self, lake, product_names, status):
+        """Set the status of products after they have been processed, counting the failed attempts."""
+        with closing(self.connect()) as connection:
+            connection.executemany(
+                "UPDATE products SET status = ?, processed = ?, attempts = attempts + ? WHERE lake = ? AND "
+                "product_name = ?", [(status, time.time(), 1 if status == "failed" else 0, lake, product_name)
+                                     for product_name in product_names])
+
+    def get_latency_metrics(self):
+        """
+        Return the mean and maximum latencies in minutes per lake, from sensing to the first search result
+        (discovery), from the first search result to the end of processing (processing) and in total.
+        """
+        metrics = {}
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                "SELECT lake, COUNT(*), AVG(first_seen - sensing_time), MAX(first_seen - sensing_time), "
+                "AVG(processed - first_seen), MAX(processed - first_seen), AVG(processed - sensing_time), "
+                "MAX(processed - sensing_time) FROM products WHERE status = 'done' GROUP BY lake").fetchall()
+        for row in rows:
+            minutes = [None if seconds is None else seconds / 60 for seconds in row[2:]]
+            metrics[row[0]] = {
+                "products": row[1],
+                "discovery": {"mean": minutes[0], "max": minutes[1]},
+                "processing": {"mean": minutes[2], "max": minutes[3]},
+                "total": {"mean": minutes[4], "max": minutes[5]}
+            }
+        return metrics
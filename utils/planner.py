@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Pre-flight planning of the resources of a run, enabled with 'preflight=True' in the General section of the environment
+file. After the search and the filters, the disk space and memory the run needs are estimated from the products to
+download, the resolution, the area of the perimeter and the configured processors. The run fails right away if the L1
+or L2 roots cannot hold its products, instead of hours later. Otherwise the number of parallel downloads, processors
+and adapters given to the run are treated as upper limits, and the planner picks the largest values (and the largest
+GPT cache size up to the configured one) that fit into the free disk space and the available memory. Each GPT JVM is
+budgeted with at least its full heap (-Xmx in gpt.vmoptions), since a smaller cache does not keep it from growing.
+"""
+
+import math
+import os
+import shutil
+
+from dias_apis.selective import is_product_available
+from dias_apis.unzip import is_streaming_enabled
+from utils.auxil import get_gpt_heap_size, log
+from utils.product_fun import get_lons_lats
+
+# Estimated size in bytes of the zip of an L1 product, by sensor and dataset, used if the API does not return the size
+PRODUCT_SIZES = {"OLCI_EFR": 700e6, "OLCI_ERR": 200e6, "MSI": 800e6, "MSI-L2A": 1100e6, "OLI_TIRS": 1000e6}
+# Ratio of the size of an extracted product to the size of its zip
+EXTRACTION_RATIO = 1.1
+# Estimated number of float32 bands in the output of a processor
+OUTPUT_BANDS = 32
+# Ratio of the size of a compressed NetCDF output to its uncompressed size
+NETCDF_RATIO = 0.5
+# Ratio of the memory used by a python processor or adapter to the size of its uncompressed output
+PYTHON_MEMORY_RATIO = 3
+# Memory in bytes used by a GPT JVM in addition to its tile cache
+GPT_OVERHEAD = 1.5e9
+# Smallest GPT cache size in bytes the planner gives to a processor
+MIN_GPT_CACHE = 1e9
+# Share of the free disk space and available memory which is kept free for other users of the machine
+RESERVE = 0.1
+# Mean radius of the earth in metres, to estimate the area of the perimeter
+EARTH_RADIUS = 6371000
+
+
+def is_preflight_enabled(env):
+    return "preflight" in env["General"] and env["General"]["preflight"] == "True"
+
+
+def plan_resources(env, params, download_groups, l1product_path_groups, l2_path, max_parallel_downloads,
+                   max_parallel_processors, max_parallel_adapters):
+    """Return the number of parallel downloads, processors and adapters and the GPT cache size for a run. Raises a
+    RuntimeError if the run does not fit on the disks."""
+    log(env["General"]["log"], "Planning the resources of the run.")
+    l1product_paths = [path for group in sorted(l1product_path_groups.keys()) for path in l1product_path_groups[group]]
+    download_sizes = []
+    if env['DIAS']['readonly'] != "True":
+        for group in sorted(download_groups.keys()):
+            for download_request, l1product_path in zip(download_groups[group], l1product_path_groups[group]):
+                if not is_product_available(l1product_path, download_request):
+                    download_sizes.append(get_product_size(params, download_request))
+    output_size = get_output_size(params)
+    processor_names = list(filter(None, params['General']['processors'].replace(" ", "").split(",")))
+    stored_ratio = 1 if params['General'].get('intermediate', "netcdf") == "npy" else NETCDF_RATIO
+    l2_size = len(l1product_paths) * len(processor_names) * output_size * stored_ratio
+
+    # disk space: all products are kept, every running download needs room for its zip until it is extracted
+    l1_root, l2_root = get_existing_path(env['DIAS']['l1_path'].split("{")[0]), get_existing_path(l2_path)
+    l1_free, l2_free = [shutil.disk_usage(root).free * (1 - RESERVE) for root in [l1_root, l2_root]]
+    l1_size = sum(download_sizes) * EXTRACTION_RATIO
+    if l2_size > l2_free:
+        raise RuntimeError("Not enough disk space for the outputs of the run on {}: {:.1f} GB needed, {:.1f} GB "
+                           "free.".format(l2_root, l2_size / 1e9, l2_free / 1e9))
+    if os.stat(l1_root).st_dev == os.stat(l2_root).st_dev:
+        l1_free -= l2_size
+    transient_size = 0 if is_streaming_enabled(env) else max(download_sizes, default=0)
+    if download_sizes and l1_size + transient_size > l1_free:
+        raise RuntimeError("Not enough disk space for the products of the run on {}: {:.1f} GB needed, {:.1f} GB "
+                           "free.".format(l1_root, (l1_size + transient_size) / 1e9, l1_free / 1e9))
+    downloads = min(max_parallel_downloads, max(1, len(download_sizes)))
+    if transient_size:
+        downloads = max(1, min(downloads, int((l1_free - l1_size) // transient_size)))
+
+    # memory: every processor may run a GPT JVM, adapters and python processors hold their outputs in memory
+    gpt_cache_size = env['General']['gpt_cache_size']
+    gpt_cache = parse_memory_size(gpt_cache_size)
+    try:
+        heap_size = get_gpt_heap_size(env)
+    except OSError:
+        heap_size = ""
+    # every JVM may grow to its full heap (-Xmx in gpt.vmoptions), whatever its cache size
+    heap = heap_size * 1e9 if heap_size else 0
+    if heap and heap < gpt_cache:
+        gpt_cache = heap
+    min_cache = min(MIN_GPT_CACHE, gpt_cache)
+    python_memory = output_size * PYTHON_MEMORY_RATIO
+    processors = min(max_parallel_processors, max(1, len(l1product_path_groups)), os.cpu_count() or 1)
+    adapters = min(max_parallel_adapters, max(1, len(l1product_path_groups)))
+    memory = get_available_memory()
+    if memory is None:
+        log(env["General"]["log"], "Could not read the available memory, keeping the parallelism.", indent=1)
+    else:
+        memory *= 1 - RESERVE
+        # prefer more parallel processors with a smaller cache, as long as the cache does not drop below the minimum
+        for processors in range(processors, 0, -1):
+            processor_memory = (memory - python_memory) / processors
+            if processor_memory >= max(heap, min_cache + GPT_OVERHEAD, python_memory):
+                break
+        else:
+            log(env["General"]["log"], "The available memory ({:.1f} GB) is below the needs of a single processor, "
+                                       "lower -Xmx in gpt.vmoptions.".format(memory / 1e9), indent=1)
+        planned_cache = max(min_cache, min(gpt_cache, processor_memory - GPT_OVERHEAD))
+        if planned_cache < parse_memory_size(gpt_cache_size):
+            gpt_cache_size = "{}M".format(int(planned_cache // 1e6))
+        adapters_memory = memory - processors * max(heap, planned_cache + GPT_OVERHEAD, python_memory)
+        if python_memory:
+            adapters = max(1, min(adapters, int(adapters_memory // python_memory)))
+
+    log(env["General"]["log"], "{} products to download ({:.1f} GB), {:.1f} GB of outputs.".format(
+        len(download_sizes), l1_size / 1e9, l2_size / 1e9), indent=1)
+    log(env["General"]["log"], "Planned {} parallel downloads, {} processors and {} adapters with a GPT cache size of "
+                               "{}.".format(downloads, processors, adapters, gpt_cache_size), indent=1)
+    return downloads, processors, adapters, gpt_cache_size
+
+
+def get_product_size(params, download_request):
+    """Return the size of the zip of a product, from the download request if the API returned it."""
+    if str(download_request.get('size', "")).isdigit():
+        return int(download_request['size'])
+    sensor = params['General']['sensor']
+    if sensor == "OLCI":
+        return PRODUCT_SIZES["OLCI_EFR" if int(params['General']['resolution']) < 1000 else "OLCI_ERR"]
+    return PRODUCT_SIZES.get(sensor, max(PRODUCT_SIZES.values()))
+
+
+def get_output_size(params):
+    """Return the uncompressed size in bytes of the output of one processor for one product."""
+    lons, lats = get_lons_lats(params['General']['wkt'])
+    height = math.radians(max(lats) - min(lats)) * EARTH_RADIUS
+    width = math.radians(max(lons) - min(lons)) * EARTH_RADIUS * math.cos(math.radians((max(lats) + min(lats)) / 2))
+    pixels = math.ceil(width / float(params['General']['resolution'])) * \
+        math.ceil(height / float(params['General']['resolution']))
+    return pixels * OUTPUT_BANDS * 4
+
+
+def get_existing_path(path):
+    """Return the path or its closest existing parent directory."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def parse_memory_size(size):
+    """Parse a size like '8G' or '512M' (as in the GPT options) to bytes."""
+    size = size.strip().upper()
+    units = {"K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12}
+    if size and size[-1] in units:
+        return float(size[:-1]) * units[size[-1]]
+    return float(size)
+
+
+def get_available_memory():
+    """Return the available memory in bytes, or None if it cannot be read."""
+    try:
+        with open("/proc/meminfo", "rt") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
@@ -3,6 +3,7 @@
 
 """This module bundles utility functions regarding satellite products."""
 
+import json
 import numpy as np
 import os
 import re
@@ -11,7 +12,7 @@ from math import ceil, floor
 
 import pandas as pd
 from haversine import haversine
-from datetime import datetime
+from datetime import datetime, timezone
 
 from netCDF4 import Dataset
 
@@ -86,13 +87,13 @@ def filter_for_timeliness(download_requests, product_names, env):
     s3_products = []
     for i in range(len(product_names)):
         tmp = product_names[i]
-        uuid = download_requests[i]["uuid"]
         if "S3A_" in tmp or "S3B_" in tmp:
             sensing_start, sensing_end, product_creation, satellite = parse_s3_name(tmp)
-            s3_products.append({"name": tmp, "uuid": uuid, "sensing_start": sensing_start, "sensing_end": sensing_end,
-                                "product_creation": product_creation, "satellite": satellite})
+            s3_products.append({"name": tmp, "download_request": download_requests[i], "sensing_start": sensing_start,
+                                "sensing_end": sensing_end, "product_creation": product_creation,
+                                "satellite": satellite})
         else:
-            s3_products.append({"name": tmp, "uuid": uuid})
+            s3_products.append({"name": tmp, "download_request": download_requests[i]})
     filtered_download_requests = []
     filtered_product_names = []
     for j in range(len(s3_products)):
@@ -104,12 +105,12 @@ def filter_for_timeliness(download_requests, product_names, env):
             creation.sort(reverse=True)
             if s3_products[j]['product_creation'] == creation[0]:
                 filtered_product_names.append(s3_products[j]["name"])
-                filtered_download_requests.append({"uuid": s3_products[j]["uuid"]})
+                filtered_download_requests.append(s3_products[j]["download_request"])
             else:
                 log(env["General"]["log"], "Removed superseded file: {}).".format(s3_products[j]["name"]))
         else:
             filtered_product_names.append(s3_products[j]["name"])
-            filtered_download_requests.append({"uuid": s3_products[j]["uuid"]})
+            filtered_download_requests.append(s3_products[j]["download_request"])
 
     return filtered_download_requests, filtered_product_names
 
@@ -153,6 +154,15 @@ def get_sensing_datetime_from_product_name(product_name):
     return re.findall(r"\d{8}", product_name)[0] + "T" + re.findall(r"\d{6}", product_name)[1]
 
 
+def get_sensing_time(product_name):
+    """Return the sensing start of a product in seconds since the epoch, or None if it is not in the product name."""
+    try:
+        sensing = datetime.strptime(get_sensing_datetime_from_product_name(product_name), r"%Y%m%dT%H%M%S")
+    except (IndexError, ValueError):
+        return None
+    return sensing.replace(tzinfo=timezone.utc).timestamp()
+
+
 def get_l1product_path(env, product_name):
     """Fills the placeholders in the configured DIAS path with actual values."""
     if product_name.startswith("S3A") or product_name.startswith("S3B"):
@@ -227,6 +237,59 @@ def get_band_names_from_nc(nc):
     return bands
 
 
+def get_metadata_sidecar_path(product_file):
+    """Returns the path of the json metadata sidecar of a product file."""
+    return "{}.json".format(product_file)
+
+
+def write_product_metadata(product_file):
+    """
+    Writes a json sidecar next to a product file with its band names, shape, data types, bounds and valid pixel
+    expression, so that later steps do not need to reopen the product. Returns the metadata.
+    """
+    with Dataset(product_file) as nc:
+        _, width, height = get_name_width_height_from_nc(nc, product_file)
+        try:
+            valid_pixel_expression = get_valid_pe_from_nc(nc)
+        except RuntimeError:
+            valid_pixel_expression = None
+        dtypes = {}
+        for var in nc.variables:
+            if len(nc.variables[var].shape) == 2:
+                dtypes[var] = str(nc.variables[var].dtype)
+        bounds = None
+        try:
+            lat_name = 'lat' if 'lat' in nc.variables else 'latitude'
+            lon_name = 'lon' if 'lon' in nc.variables else 'longitude'
+            lats, lons = nc.variables[lat_name][:], nc.variables[lon_name][:]
+            bounds = {'south': float(np.nanmin(lats)), 'east': float(np.nanmax(lons)),
+                      'north': float(np.nanmax(lats)), 'west': float(np.nanmin(lons))}
+        except KeyError:
+            pass
+        metadata = {
+            'bands': get_band_names_from_nc(nc),
+            'width': width,
+            'height': height,
+            'dtypes': dtypes,
+            'bounds': bounds,
+            'valid_pixel_expression': valid_pixel_expression
+        }
+    sidecar = get_metadata_sidecar_path(product_file)
+    with open(sidecar + ".incomplete", "w") as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(sidecar + ".incomplete", sidecar)
+    return metadata
+
+
+def read_product_metadata(product_file):
+    """Returns the metadata of a product from its json sidecar. The sidecar is (re)written if missing or outdated."""
+    sidecar = get_metadata_sidecar_path(product_file)
+    if os.path.isfile(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(product_file):
+        with open(sidecar, "r") as f:
+            return json.load(f)
+    return write_product_metadata(product_file)
+
+
 def get_name_width_height_from_nc(nc, product_file=None):
     """Returns the height and the width of a given product."""
     for var in nc.variables:
@@ -236,6 +299,14 @@ def get_name_width_height_from_nc(nc, product_file=None):
     raise RuntimeWarning('Could not read width and height from product {}.'.format(product_file))
 
 
+def nearest_index(axis, value):
+    """Return the index of the axis value closest to value, or None if value is more than half a step outside."""
+    half_step = abs(float(axis[1]) - float(axis[0])) / 2 if len(axis) > 1 else 0
+    if value < np.min(axis) - half_step or value > np.max(axis) + half_step:
+        return None
+    return int(np.argmin(np.abs(axis - value)))
+
+
 def get_pixel_pos(longitudes, latitudes, lon, lat, x=None, y=None, step=None):
     """
     Returns the coordinates of the pixel [x, y] which cover a certain geo location (lon/lat).
@@ -0,0 +1,247 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Provenance of processor and mosaic outputs, used by runs with 'synchronise=provenance'. The provenance of an output is a
+hash over the params it depends on, the code and graph templates of its processor, a fingerprint of its L1 product and
+the provenance of its inputs. It is stored next to the outputs in a '_provenance' folder, together with a hash of the
+graphs rendered into the '_reproducibility' folder, which is part of the provenance seen by downstream steps. Existing
+outputs whose provenance or rendered graphs changed are removed before their processor runs, so only they and their
+downstream dependents are recomputed.
+
+Outputs derived from L2 products by adapters (quicklooks, Datalakes files) have a record as well, with a hash over the
+params section and code of the adapter and the fingerprints of its input files, which change whenever an upstream
+output is written again. They are removed and recomputed if an input was regenerated. The station files of the pixel
+extraction and the composites keep the fingerprints of their inputs themselves and replace what a regenerated input
+contributed.
+
+The L1 fingerprint is a hash of the manifest of the product (which lists the checksums of its files), or of the names,
+sizes and modification times of its files if it has no manifest, instead of a hash of all its data.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+from threading import Lock
+
+from utils.auxil import log
+from utils.product_fun import get_metadata_sidecar_path
+
+# The name of the folder in the output folder in which provenance records are stored
+PROVENANCE_DIR = "_provenance"
+# A pattern for the name of a provenance record (completed with the step name and the product name)
+PROVENANCE_FILENAME = "{}_{}.json"
+# Keys of the General params section which change the outputs of all processors
+GENERAL_KEYS = ["sensor", "resolution", "wkt"]
+# Files of a processor which are part of its code version
+CODE_PATTERNS = ["*.py", "*.xml", "*.properties"]
+# Manifests of L1 products which identify their content
+MANIFEST_PATTERNS = ["xfdumanifest.xml", "manifest.safe", "*_MTL.txt"]
+
+code_versions, code_versions_lock = {}, Lock()
+l1_fingerprints, l1_fingerprints_lock = {}, Lock()
+
+
+def is_provenance_enabled(params):
+    return "synchronise" in params["General"] and params["General"]["synchronise"] == "provenance"
+
+
+def get_code_version(processor):
+    """Return a hash over the code and graph templates of a processor, computed once per run."""
+    with code_versions_lock:
+        if processor not in code_versions:
+            root = os.path.dirname(os.path.dirname(__file__))
+            folders = [os.path.join(root, "processors", processor.lower()),
+                       os.path.join(root, "adapters", processor.lower())]
+            processor_dir = next((folder for folder in folders if os.path.isdir(folder)),
+                                 os.path.join(root, processor.lower()))
+            md5 = hashlib.md5()
+            for pattern in CODE_PATTERNS:
+                for code_file in sorted(glob.glob(os.path.join(processor_dir, pattern))):
+                    md5.update(os.path.basename(code_file).encode())
+                    with open(code_file, "rb") as f:
+                        md5.update(f.read())
+            code_versions[processor] = md5.hexdigest()
+        return code_versions[processor]
+
+
+def get_l1_fingerprint(l1product_path):
+    """Return a hash of the manifest of a L1 product, or of the names, sizes and modification times of its files if it
+    has none, computed once per run."""
+    with l1_fingerprints_lock:
+        if l1product_path not in l1_fingerprints:
+            md5 = hashlib.md5()
+            manifests = [manifest for pattern in MANIFEST_PATTERNS
+                         for manifest in sorted(glob.glob(os.path.join(l1product_path, pattern)))]
+            if manifests:
+                with open(manifests[0], "rb") as f:
+                    md5.update(f.read())
+            elif os.path.isfile(l1product_path):
+                md5.update("{}".format(os.stat(l1product_path).st_size).encode())
+            else:
+                for folder, _, files in sorted(os.walk(l1product_path)):
+                    for file in sorted(files):
+                        stat = os.stat(os.path.join(folder, file))
+                        md5.update("{}:{}:{}".format(os.path.relpath(os.path.join(folder, file), l1product_path),
+                                                     stat.st_size, int(stat.st_mtime)).encode())
+            l1_fingerprints[l1product_path] = md5.hexdigest()
+        return l1_fingerprints[l1product_path]
+
+
+def get_file_fingerprint(path):
+    """Return a hash of the size and modification time of a file, or of all files of a folder, which changes whenever
+    it is written again."""
+    md5 = hashlib.md5()
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        md5.update("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode())
+    else:
+        for folder, _, files in sorted(os.walk(path)):
+            for file in sorted(files):
+                stat = os.stat(os.path.join(folder, file))
+                md5.update("{}:{}:{}".format(os.path.relpath(os.path.join(folder, file), path), stat.st_size,
+                                             stat.st_mtime_ns).encode())
+    return md5.hexdigest()
+
+
+def get_record_file(l2_path, step, product_name):
+    return os.path.join(l2_path, PROVENANCE_DIR, PROVENANCE_FILENAME.format(step, product_name))
+
+
+def read_provenance_hash(l2_path, step, product_name):
+    """Return the provenance hash recorded for a step and product, or None if there is no record."""
+    record_file = get_record_file(l2_path, step, product_name)
+    if not os.path.isfile(record_file):
+        return None
+    with open(record_file, "r") as f:
+        return json.load(f)["hash"]
+
+
+def get_provenance(params, step, product_name, inputs, l2_path, l1product_path=None):
+    """
+    Compute the provenance of a step (a processor or 'MOSAIC') on a product. The inputs are (step, product name) tuples
+    of the outputs which were available to this step, the L1 product is given for steps which read it.
+    """
+    components = {
+        "l1": get_l1_fingerprint(l1product_path) if l1product_path is not None and os.path.exists(l1product_path)
+        else None,
+        "general": {key: params["General"][key] for key in GENERAL_KEYS if key in params["General"]},
+        "params": dict(params[step]) if params.has_section(step) else {},
+        "code": get_code_version(step),
+        "inputs": {"{}_{}".format(input_step, input_product_name): read_provenance_hash(l2_path, input_step,
+                                                                                         input_product_name)
+                   for input_step, input_product_name in inputs},
+        "product": product_name
+    }
+    components["hash"] = hashlib.md5(json.dumps(components, sort_keys=True).encode()).hexdigest()
+    return components
+
+
+def invalidate_changed_output(env, l2_path, step, product_name, provenance):
+    """
+    Remove the output of a step if its provenance changed. Outputs without provenance record are kept, their
+    provenance is recorded after the step skipped them.
+    """
+    record_file = get_record_file(l2_path, step, product_name)
+    if not os.path.isfile(record_file):
+        return
+    with open(record_file, "r") as f:
+        record = json.load(f)
+    if not record.get("output_file"):
+        return
+    graph_changed = record.get("graph") != get_graph_hash(record["output_file"])
+    if record.get("provenance_hash", record["hash"]) == provenance["hash"] and not graph_changed:
+        return
+    changed = [key for key in ["general", "params", "code", "l1", "inputs"] if record.get(key) != provenance[key]]
+    changed += ["graph"] if graph_changed else []
+    log(env["General"]["log"], "Provenance of {} changed ({}), removing: {}".format(
+        step, ", ".join(changed), record["output_file"]), indent=1)
+    remove_output(record["output_file"])
+    if set(changed) - {"inputs", "l1", "graph"}:
+        # graphs in _reproducibility are only written if missing, they must be written again with the new params
+        for gpt_xml_file in get_graph_files(record["output_file"]):
+            os.remove(gpt_xml_file)
+    os.remove(record_file)
+
+
+def get_graph_files(output_file):
+    return sorted(glob.glob(os.path.join(os.path.dirname(output_file), "_reproducibility", "*.xml")))
+
+
+def get_graph_hash(output_file):
+    """Return a hash over the graphs in the _reproducibility folder next to an output."""
+    md5 = hashlib.md5()
+    for gpt_xml_file in get_graph_files(output_file):
+        with open(gpt_xml_file, "rb") as f:
+            md5.update(f.read())
+    return md5.hexdigest()
+
+
+def remove_output(output_file):
+    if os.path.isdir(output_file):
+        shutil.rmtree(output_file)
+    elif os.path.isfile(output_file):
+        os.remove(output_file)
+    if os.path.isfile(get_metadata_sidecar_path(output_file)):
+        os.remove(get_metadata_sidecar_path(output_file))
+
+
+def write_provenance(l2_path, step, product_name, provenance, output_file):
+    """Record the provenance of the output of a step. The recorded hash, which downstream steps read, also covers the
+    rendered graphs."""
+    record_file = get_record_file(l2_path, step, product_name)
+    os.makedirs(os.path.dirname(record_file), exist_ok=True)
+    graph = get_graph_hash(output_file)
+    record = dict(provenance, output_file=output_file, graph=graph, provenance_hash=provenance["hash"],
+                  hash=hashlib.md5((provenance["hash"] + graph).encode()).hexdigest())
+    temp_file = "{}.incomplete".format(record_file)
+    with open(temp_file, "w") as f:
+        json.dump(record, f, indent=1, sort_keys=True)
+    os.replace(temp_file, record_file)
+
+
+def get_derived_provenance(params, step, input_files):
+    """Compute the provenance of an output which an adapter derived from the given L2 product files."""
+    components = {
+        "params": dict(params[step]) if params.has_section(step) else {},
+        "code": get_code_version(step),
+        "inputs": {os.path.basename(input_file): get_file_fingerprint(input_file) for input_file in input_files
+                   if os.path.exists(input_file)}
+    }
+    components["hash"] = hashlib.md5(json.dumps(components, sort_keys=True).encode()).hexdigest()
+    return components
+
+
+def invalidate_derived_output(env, params, l2_path, step, output_file, input_files):
+    """
+    Remove an output of an adapter if its params, code or inputs changed. Returns the provenance to record once the
+    adapter wrote the output, or None if provenance is not enabled.
+    """
+    if not is_provenance_enabled(params):
+        return None
+    provenance = get_derived_provenance(params, step, input_files)
+    record_file = get_record_file(l2_path, step, os.path.basename(output_file))
+    if os.path.isfile(record_file):
+        with open(record_file, "r") as f:
+            record = json.load(f)
+        if record["hash"] != provenance["hash"]:
+            changed = [key for key in ["params", "code", "inputs"] if record.get(key) != provenance[key]]
+            log(env["General"]["log"], "Provenance of {} changed ({}), removing: {}".format(
+                step, ", ".join(changed), output_file), indent=1)
+            remove_output(output_file)
+            os.remove(record_file)
+    return provenance
+
+
+def write_derived_provenance(l2_path, step, output_file, provenance):
+    """Record the provenance of an output of an adapter, if provenance is enabled and the output was written."""
+    if provenance is None or not os.path.exists(output_file):
+        return
+    record_file = get_record_file(l2_path, step, os.path.basename(output_file))
+    os.makedirs(os.path.dirname(record_file), exist_ok=True)
+    temp_file = "{}.incomplete".format(record_file)
+    with open(temp_file, "w") as f:
+        json.dump(dict(provenance, output_file=output_file), f, indent=1, sort_keys=True)
+    os.replace(temp_file, record_file)
@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This module bundles utility functions shared by the quicklook adapters."""
+
+import io
+import os
+from collections import OrderedDict
+from threading import RLock
+
+import matplotlib.pyplot as plt
+from PIL import Image
+
+# Output formats supported for quicklooks
+QL_FORMATS = ["pdf", "png", "webp"]
+# Default output format and resolution of quicklooks
+DEFAULT_QL_FORMAT = "pdf"
+DEFAULT_QL_DPI = 300
+# Maximum number of figure templates kept open at the same time
+MAX_FIGURE_TEMPLATES = 8
+
+# Matplotlib is not thread-safe, all renderings of cached figure templates are serialised with this lock
+render_lock = RLock()
+figure_templates = OrderedDict()
+
+
+def get_ql_format(params, params_section):
+    """Read the output format and the dpi for quicklooks from the given params section."""
+    ql_format, dpi = DEFAULT_QL_FORMAT, DEFAULT_QL_DPI
+    if params.has_section(params_section):
+        ql_format = params[params_section].get("format", DEFAULT_QL_FORMAT).strip().lower() or DEFAULT_QL_FORMAT
+        dpi = int(params[params_section].get("dpi", DEFAULT_QL_DPI) or DEFAULT_QL_DPI)
+    if ql_format not in QL_FORMATS:
+        raise RuntimeError("Unsupported quicklook format {}, use one of: {}".format(ql_format, ", ".join(QL_FORMATS)))
+    return ql_format, dpi
+
+
+def get_figure_template(key, create):
+    """
+    Return the figure template cached under the given key, or create it with create() on first use. A template is a
+    dictionary holding at least the figure under 'fig'. Must be called while holding the render_lock.
+    """
+    if key in figure_templates:
+        figure_templates.move_to_end(key)
+        return figure_templates[key]
+    template = create()
+    figure_templates[key] = template
+    while len(figure_templates) > MAX_FIGURE_TEMPLATES:
+        _, evicted = figure_templates.popitem(last=False)
+        plt.close(evicted["fig"])
+    return template
+
+
+def save_figure(fig, output_file, ql_format=DEFAULT_QL_FORMAT, dpi=DEFAULT_QL_DPI, **kwargs):
+    """Save a figure as pdf, png or webp. WebP files are encoded with Pillow from a rendered png."""
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    if ql_format == "webp":
+        with io.BytesIO() as buffer:
+            fig.savefig(buffer, format="png", dpi=dpi, **kwargs)
+            buffer.seek(0)
+            with Image.open(buffer) as img:
+                img.save(output_file, format="WEBP")
+    else:
+        fig.savefig(output_file, format=ql_format, dpi=dpi, **kwargs)
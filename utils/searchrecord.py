@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Recording and replay of search results, set with 'search' in the General section of the params. With 'record', the
+download requests and product names found by the remote API are saved in the _reproducibility folder of the output
+folder. With 'replay' (or the --search replay option), later runs read them from there instead of searching again, so
+they process exactly the same products even if the API has reprocessed products since. The default 'live' searches
+without recording. The search mode is always taken from the current params file, also when the other params are read
+from the output folder.
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from utils.auxil import log
+
+# Modes of the search
+SEARCH_MODES = ["live", "record", "replay"]
+DEFAULT_SEARCH_MODE = "live"
+# The name of the file of the recorded search in the _reproducibility folder of the output folder
+SEARCH_RECORD_FILENAME = "search_results.json"
+# Keys of the General section of the params which define a search
+QUERY_KEYS = ["remote_dias_api", "start", "end", "sensor", "resolution", "wkt"]
+
+
+def get_search_mode(params):
+    search_mode = params["General"].get("search", DEFAULT_SEARCH_MODE).strip().lower()
+    if search_mode not in SEARCH_MODES:
+        raise RuntimeError("Unknown search mode {}, use one of: {}".format(search_mode, ", ".join(SEARCH_MODES)))
+    return search_mode
+
+
+def get_search_record_file(l2_path):
+    return os.path.join(l2_path, "_reproducibility", SEARCH_RECORD_FILENAME)
+
+
+def get_checksum(products):
+    return hashlib.sha256(json.dumps(products, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def record_search(env, params, l2_path, download_requests, product_names):
+    """Save the result of a search, with the query it answers and a checksum of the products."""
+    products = [{"name": product_name, "download_request": download_request}
+                for download_request, product_name in zip(download_requests, product_names)]
+    record = {
+        "query": {key: params["General"][key] for key in QUERY_KEYS},
+        "recorded": datetime.utcnow().strftime(r"%Y-%m-%dT%H:%M:%SZ"),
+        "products": products,
+        "checksum": get_checksum(products)
+    }
+    record_file = get_search_record_file(l2_path)
+    os.makedirs(os.path.dirname(record_file), exist_ok=True)
+    with open("{}.incomplete".format(record_file), "w") as f:
+        json.dump(record, f, indent=1)
+    os.replace("{}.incomplete".format(record_file), record_file)
+    log(env["General"]["log"], "Recorded {} products of the search to {}.".format(len(products), record_file))
+
+
+def replay_search(env, params, l2_path):
+    """Return the download requests and product names of a recorded search. Raises a RuntimeError if there is no
+    recording of the same query or if it has been altered."""
+    record_file = get_search_record_file(l2_path)
+    if not os.path.isfile(record_file):
+        raise RuntimeError("Cannot replay the search, there is no recording at {}.".format(record_file))
+    with open(record_file, "r") as f:
+        record = json.load(f)
+    if record["checksum"] != get_checksum(record["products"]):
+        raise RuntimeError("Cannot replay the search, the recording {} has been altered.".format(record_file))
+    changed = [key for key in QUERY_KEYS if record["query"].get(key) != params["General"][key]]
+    if changed:
+        raise RuntimeError("Cannot replay the search, the recording {} is of another query ({} changed).".format(
+            record_file, ", ".join(changed)))
+    log(env["General"]["log"], "Replaying {} products of the search recorded at {}.".format(
+        len(record["products"]), record["recorded"]))
+    return [product["download_request"] for product in record["products"]], \
+        [product["name"] for product in record["products"]]
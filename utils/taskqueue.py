@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A task queue stored in a SQLite file, used to distribute product groups over workers on several nodes. The file must
+be on a filesystem which is shared by all nodes and supports file locking. Workers claim tasks, send heartbeats while
+processing them, and tasks of workers whose heartbeat stopped are handed out again.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import time
+from contextlib import closing
+
+# Seconds between two heartbeats of a worker
+HEARTBEAT_INTERVAL = 30
+# Seconds without heartbeat after which the task of a worker is reclaimed
+STALE_AFTER = 5 * HEARTBEAT_INTERVAL
+# Number of times a task is handed out before it is marked as failed
+MAX_TASK_ATTEMPTS = 3
+# Seconds to wait for the lock of the queue file
+LOCK_TIMEOUT = 60
+
+TASK_STATES = ["pending", "running", "done", "failed"]
+
+
+def get_worker_name():
+    """Return a name for this worker which is unique over all nodes."""
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+class TaskQueue(object):
+    """A queue of json serialisable tasks in a SQLite file. Each task has a unique key, adding it twice is a no-op."""
+
+    def __init__(self, queue_file):
+        self.queue_file = queue_file
+        os.makedirs(os.path.dirname(os.path.abspath(queue_file)), exist_ok=True)
+        with closing(self.connect()) as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, "
+                "payload TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending', worker TEXT, heartbeat REAL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, error TEXT)")
+
+    def connect(self):
+        # the default journal mode is used on purpose, wal mode does not work on network filesystems
+        return sqlite3.connect(self.queue_file, timeout=LOCK_TIMEOUT, isolation_level=None)
+
+    def add(self, key, payload):
+        """Add a task, returns False if a task with this key already exists."""
+        with closing(self.connect()) as connection:
+            cursor = connection.execute("INSERT OR IGNORE INTO tasks (key, payload) VALUES (?, ?)",
+                                        (key, json.dumps(payload)))
+            return cursor.rowcount == 1
+
+    def claim(self, worker, stale_after=STALE_AFTER, max_attempts=MAX_TASK_ATTEMPTS):
+        """
+        Claim the oldest pending task for a worker, after reclaiming tasks of dead workers. Returns a tuple
+        (task_id, key, payload), or None if no task is pending.
+        """
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            stale = time.time() - stale_after
+            connection.execute("UPDATE tasks SET status = 'failed', "
+                               "error = 'Worker ' || worker || ' stopped responding' "
+                               "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?", (stale, max_attempts))
+            connection.execute("UPDATE tasks SET status = 'pending', worker = NULL "
+                               "WHERE status = 'running' AND heartbeat < ?", (stale, ))
+            row = connection.execute("SELECT id, key, payload FROM tasks WHERE status = 'pending' "
+                                     "ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                connection.execute("UPDATE tasks SET status = 'running', worker = ?, heartbeat = ?, "
+                                   "attempts = attempts + 1 WHERE id = ?", (worker, time.time(), row[0]))
+            connection.execute("COMMIT")
+        except (Exception, ):
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+        return None if row is None else (row[0], row[1], json.loads(row[2]))
+
+    def heartbeat(self, task_id, worker):
+        """Update the heartbeat of a running task. Returns False if the task has been reclaimed from this worker."""
+        with closing(self.connect()) as connection:
+            cursor = connection.execute("UPDATE tasks SET heartbeat = ? WHERE id = ? AND worker = ? AND "
+                                        "status = 'running'", (time.time(), task_id, worker))
+            return cursor.rowcount == 1
+
+    def complete(self, task_id, worker, succeeded=True, error=None):
+        """Mark a task of a worker as done or failed."""
+        with closing(self.connect()) as connection:
+            connection.execute("UPDATE tasks SET status = ?, error = ? WHERE id = ? AND worker = ?",
+                               ("done" if succeeded else "failed", error, task_id, worker))
+
+    def counts(self):
+        """Return the number of tasks in each state."""
+        counts = dict.fromkeys(TASK_STATES, 0)
+        with closing(self.connect()) as connection:
+            for status, count in connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status"):
+                counts[status] = count
+        return counts
@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Append-only pixel time-series store. Each processor run appends the configured bands of its outputs to one NetCDF cube
+per lake, processor and band, with time as the first (unlimited) dimension. The cubes are chunked as small spatial tiles
+over many dates, so the history of a point or a window is a single chunked read of one file instead of opening every L2
+product. All products of a cube must be on the common grid of the perimeter.
+"""
+
+import os
+from datetime import datetime, timezone
+from threading import Lock
+
+import numpy as np
+from netCDF4 import Dataset
+
+from utils.auxil import log
+from utils.intermediate import is_intermediate
+from utils.product_fun import get_sensing_time, nearest_index
+
+# Key of the params section which lists the bands to store per processor
+PARAMS_SECTION = "TIMESERIES"
+# A pattern for the name of a store file (completed with processor and band name)
+STORE_FILENAME = "{}_{}.nc"
+# Number of dates per chunk of a store
+TIME_CHUNK = 64
+# Edge length in pixels of the spatial tiles of a chunk
+SPACE_CHUNK = 32
+# Units of the time variable of the stores
+TIME_UNITS = "seconds since 1970-01-01 00:00:00"
+
+store_locks, store_locks_lock = {}, Lock()
+
+
+def is_timeseries_enabled(env, params):
+    return params.has_section(PARAMS_SECTION) and "timeseries_path" in env["DIAS"]
+
+
+def get_store_bands(params, processor):
+    """Return the bands of a processor which are appended to the store."""
+    if not params.has_section(PARAMS_SECTION) or processor.lower() not in params[PARAMS_SECTION]:
+        return []
+    return list(filter(None, params[PARAMS_SECTION][processor.lower()].replace(" ", "").split(",")))
+
+
+def get_store_file(env, params, processor, band):
+    return os.path.join(env["DIAS"]["timeseries_path"], params["General"]["wkt_name"],
+                        STORE_FILENAME.format(processor, band))
+
+
+def get_store_lock(store_file):
+    with store_locks_lock:
+        return store_locks.setdefault(store_file, Lock())
+
+
+def append_products(env, params, l2product_files):
+    """Append the configured bands of the outputs of a product group to their stores."""
+    for processor, product_file in sorted(l2product_files.items()):
+        if not isinstance(product_file, str) or not product_file or is_intermediate(product_file):
+            continue
+        for band in get_store_bands(params, processor):
+            store_file = get_store_file(env, params, processor, band)
+            if append_product(env, store_file, product_file, band):
+                log(env["General"]["log"], "Appended {} of {} to {}.".format(
+                    band, os.path.basename(product_file), store_file), indent=1)
+
+
+def append_product(env, store_file, product_file, band):
+    """Append a band of a product to a store. Returns False if the product is already stored or cannot be stored."""
+    product_name = os.path.basename(product_file)
+    sensing_time = get_sensing_time(product_name)
+    if sensing_time is None:
+        log(env["General"]["log"], "Cannot store {}, no sensing time in the product name.".format(product_name),
+            indent=1)
+        return False
+    with Dataset(product_file) as src:
+        if band not in src.variables:
+            log(env["General"]["log"], "Cannot store {}, band {} is missing.".format(product_name, band), indent=1)
+            return False
+        values = np.ma.filled(src.variables[band][:].astype(np.float32), np.nan)
+        lat, lon = src.variables['lat'][:], src.variables['lon'][:]
+        units = getattr(src.variables[band], "units", "")
+
+    with get_store_lock(store_file):
+        if not os.path.isfile(store_file):
+            create_store(store_file, band, lat, lon, units)
+        with Dataset(store_file, mode='r+') as dst:
+            if dst.variables[band].shape[1:] != values.shape or not np.allclose(dst['lat'][:], lat) or \
+                    not np.allclose(dst['lon'][:], lon):
+                log(env["General"]["log"], "Cannot store {}, it is not on the grid of {}.".format(
+                    product_name, store_file), indent=1)
+                return False
+            if product_name in set(dst['product'][:]):
+                return False
+            index = len(dst.dimensions['time'])
+            dst['time'][index] = sensing_time
+            dst['product'][index] = product_name
+            dst[band][index, :, :] = values
+    return True
+
+
+def create_store(store_file, band, lat, lon, units):
+    os.makedirs(os.path.dirname(store_file), exist_ok=True)
+    temp_file = "{}.incomplete".format(store_file)
+    with Dataset(temp_file, mode='w') as dst:
+        dst.createDimension('time', None)
+        dst.createDimension('lat', len(lat))
+        dst.createDimension('lon', len(lon))
+        time = dst.createVariable('time', 'f8', ('time', ))
+        time.units = TIME_UNITS
+        dst.createVariable('product', str, ('time', ))
+        for name, values in [('lat', lat), ('lon', lon)]:
+            dst.createVariable(name, 'f8', (name, ))
+            dst[name][:] = values
+        chunks = (TIME_CHUNK, min(SPACE_CHUNK, len(lat)), min(SPACE_CHUNK, len(lon)))
+        variable = dst.createVariable(band, 'f4', ('time', 'lat', 'lon'), fill_value=np.nan, zlib=True, complevel=6,
+                                      chunksizes=chunks)
+        variable.units = units
+    os.replace(temp_file, store_file)
+
+
+def read_point_history(store_file, lat, lon):
+    """Return the sensing times, product names and values of the pixel covering (lat, lon), sorted by time."""
+    times, products, windows = read_window_history(store_file, lat, lon, 1)
+    return times, products, windows[:, 0, 0]
+
+
+def read_window_history(store_file, lat, lon, window_size):
+    """
+    Return the sensing times, product names and windows (time, row, col) around the pixel covering (lat, lon), sorted
+    by time. Invalid pixels are NaN. Raises a RuntimeError if the point is not covered by the store.
+    """
+    with Dataset(store_file) as src:
+        band = [name for name, variable in src.variables.items() if variable.dimensions == ('time', 'lat', 'lon')][0]
+        row, col = nearest_index(src['lat'][:], lat), nearest_index(src['lon'][:], lon)
+        if row is None or col is None:
+            raise RuntimeError("Point {}, {} is not covered by {}.".format(lat, lon, store_file))
+        half = window_size // 2
+        height, width = src[band].shape[1:]
+        windows = np.ma.filled(src[band][:, max(0, row - half):min(height, row + half + 1),
+                               max(0, col - half):min(width, col + half + 1)].astype(np.float64), np.nan)
+        times, products = np.asarray(src['time'][:]), np.asarray(src['product'][:])
+    order = np.argsort(times, kind="stable")
+    times = [datetime.fromtimestamp(t, timezone.utc).replace(tzinfo=None) for t in times[order]]
+    return times, list(products[order]), windows[order]